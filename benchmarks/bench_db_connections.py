@@ -0,0 +1,66 @@
+"""
+Micro-benchmark: per-call overhead of the old open/close-per-query pattern versus
+the pooled per-thread connection used by modules.db_utils.
+
+Run from the repository root:
+    python -m benchmarks.bench_db_connections [iterations]
+"""
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from modules import db_utils
+
+logger = logging.getLogger("modules.db_utils")
+
+
+def legacy_get_or_create_user(db_path, user_id):
+    # Mirrors the pre-pool get_db_connection() + get_or_create_user() round trip.
+    db_dir = os.path.dirname(db_path)
+    logger.info(f"Attempting to connect to database at: {db_path}")
+    logger.info(f"Database directory is: {db_dir}")
+    logger.info(f"Database directory exists: {os.path.exists(db_dir)}")
+    if not os.path.exists(db_dir):
+        os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, balance_cents, transaction_count FROM users WHERE user_id = ?", (user_id,))
+    user = cursor.fetchone()
+    conn.close()
+    return user
+
+
+def _time_calls(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    # Route INFO logs to /dev/null so the cost of formatting/emitting them is measured without flooding the console.
+    logging.basicConfig(level=logging.INFO, handlers=[logging.FileHandler(os.devnull)])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bench.db')
+        db_utils.DATABASE_NAME = db_path
+        db_utils.initialize_database()
+        db_utils.get_or_create_user(1)
+
+        before_us = _time_calls(lambda: legacy_get_or_create_user(db_path, 1), iterations)
+        after_us = _time_calls(lambda: db_utils.get_or_create_user(1), iterations)
+        db_utils.close_db_connections()
+
+    print(f"iterations:                {iterations}")
+    print(f"before (connect per call): {before_us:8.1f} us/call")
+    print(f"after  (pooled):           {after_us:8.1f} us/call")
+    print(f"speedup:                   {before_us / after_us:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Micro-benchmark: per-request latency of module-level requests.get (new TCP + TLS handshake every call)
+versus the shared keep-alive sessions of modules.http_sessions, against a local HTTPS stand-in.
+Needs the openssl command line tool for the throwaway self-signed certificate.
+
+Run from the repository root:
+    python -m benchmarks.bench_http_sessions [requests] [threads]
+"""
+import http.server
+import json
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from modules import http_sessions
+
+RESPONSE_BODY = json.dumps({'height': 850000, 'txs': []}).encode()
+
+
+class _StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, like the real providers
+    disable_nagle_algorithm = True # Headers and body are separate writes; avoid delayed-ACK stalls
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(RESPONSE_BODY)))
+        self.end_headers()
+        self.wfile.write(RESPONSE_BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _make_certificate(tmp_dir):
+    cert_path, key_path = os.path.join(tmp_dir, 'cert.pem'), os.path.join(tmp_dir, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-keyout', key_path, '-out', cert_path, '-subj', '/CN=127.0.0.1',
+                    '-addext', 'subjectAltName=IP:127.0.0.1'],
+                   check=True, capture_output=True)
+    return cert_path, key_path
+
+
+def _start_server(cert_path, key_path):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _StandInHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _time_requests(get, total, threads):
+    latencies = []
+    def one(_):
+        start = time.perf_counter()
+        get().raise_for_status()
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return (sum(latencies) / len(latencies) * 1e3, latencies[int(len(latencies) * 0.95)] * 1e3, total / elapsed)
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cert_path, key_path = _make_certificate(tmp_dir)
+        server = _start_server(cert_path, key_path)
+        url = f"https://127.0.0.1:{server.server_address[1]}/blocks/tip/height"
+        timeout = http_sessions.get_timeout('blockstream')
+        session = http_sessions.get_session('bench')
+        try:
+            results = [
+                ("requests.get, new connection", _time_requests(
+                    lambda: requests.get(url, timeout=timeout, verify=cert_path), total, threads)),
+                ("shared keep-alive session", _time_requests(
+                    lambda: session.get(url, timeout=timeout, verify=cert_path), total, threads)),
+            ]
+        finally:
+            http_sessions.close_sessions()
+            server.shutdown()
+
+    print(f"requests: {total}, client threads: {threads}, pool size: {http_sessions.get_pool_size('bench')}")
+    for label, (mean_ms, p95_ms, rps) in results:
+        print(f"{label:30s}: mean {mean_ms:7.2f} ms   p95 {p95_ms:7.2f} ms   {rps:8.1f} req/s")
+
+
+if __name__ == '__main__':
+    main()
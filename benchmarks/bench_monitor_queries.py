@@ -0,0 +1,130 @@
+"""
+Micro-benchmark: payment monitor and expiry queries on ISO-text timestamps (the old schema) versus
+INTEGER epoch seconds with (status, next_check_at) / (status, expires_at) indexes.
+
+Run from the repository root:
+    python -m benchmarks.bench_monitor_queries [pending_rows] [iterations]
+"""
+import datetime
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+from modules import db_utils
+
+MONITORING_SHARE = 0.5 # The rest are finished ('processed' / 'expired') rows still in the hot table
+EXPIRED_SHARE_OF_MONITORING = 0.1
+
+# Old layout: ISO text times and the indexes of migration 2.
+LEGACY_TABLE_SQL = """
+    CREATE TABLE legacy_pending_payments (
+        payment_id INTEGER PRIMARY KEY,
+        status TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        last_checked_at TEXT,
+        expires_at TEXT NOT NULL
+    )
+"""
+LEGACY_INDEX_SQL = (
+    "CREATE INDEX legacy_status_expires ON legacy_pending_payments (status, expires_at)",
+    "CREATE INDEX legacy_status_created ON legacy_pending_payments (status, created_at)",
+)
+LEGACY_MONITOR_SQL = """
+    SELECT * FROM legacy_pending_payments
+    WHERE status = 'monitoring' AND datetime('now', 'utc') < expires_at
+    ORDER BY last_checked_at ASC NULLS FIRST, created_at ASC
+    LIMIT 100
+"""
+LEGACY_STALE_SQL = """
+    SELECT payment_id FROM legacy_pending_payments
+    WHERE status = 'monitoring' AND datetime('now', 'utc') >= expires_at
+    ORDER BY created_at ASC
+    LIMIT 100
+"""
+MONITOR_SQL = """
+    SELECT * FROM pending_crypto_payments
+    WHERE status = 'monitoring' AND next_check_at <= ? AND expires_at > ?
+    ORDER BY next_check_at ASC
+    LIMIT 100
+"""
+STALE_SQL = """
+    SELECT payment_id FROM pending_crypto_payments
+    WHERE status = 'monitoring' AND expires_at <= ?
+    ORDER BY expires_at ASC
+    LIMIT 100
+"""
+
+
+def _seed(conn, rows: int):
+    rng = random.Random(42)
+    now = int(time.time())
+    legacy, current = [], []
+    for payment_id in range(1, rows + 1):
+        monitoring = rng.random() < MONITORING_SHARE
+        status = 'monitoring' if monitoring else rng.choice(('processed', 'expired'))
+        created_at = now - rng.randint(0, 30 * 86400)
+        expired = not monitoring or rng.random() < EXPIRED_SHARE_OF_MONITORING
+        expires_at = now - rng.randint(1, 3600) if expired else now + rng.randint(60, 3600)
+        last_checked_at = now - rng.randint(0, 600)
+        legacy.append((payment_id, status, *(datetime.datetime.utcfromtimestamp(t).isoformat()
+                                              for t in (created_at, last_checked_at, expires_at))))
+        current.append((payment_id, payment_id, payment_id, f"bench-{payment_id}", 'BTC', status,
+                        created_at, last_checked_at, last_checked_at + db_utils.MONITOR_RECHECK_SECONDS, expires_at))
+    conn.execute(LEGACY_TABLE_SQL)
+    conn.executemany("INSERT INTO legacy_pending_payments VALUES (?, ?, ?, ?, ?)", legacy)
+    for sql in LEGACY_INDEX_SQL:
+        conn.execute(sql)
+    conn.executemany("""
+        INSERT INTO pending_crypto_payments (payment_id, transaction_id, user_id, address, coin_symbol, status,
+                                             created_at, last_checked_at, next_check_at, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, current)
+    conn.commit()
+    conn.execute("ANALYZE")
+
+
+def _time_calls(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e3
+
+
+def _plan(conn, sql, params=()):
+    return "; ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_utils.DATABASE_NAME = os.path.join(tmp_dir, 'bench.db')
+        db_utils.ARCHIVE_DATABASE_NAME = os.path.join(tmp_dir, 'bench_archive.db')
+        db_utils.initialize_database()
+        with db_utils.db_connection() as conn:
+            _seed(conn, rows)
+            now = int(time.time())
+            results = [
+                ("monitor, ISO text", _time_calls(lambda: conn.execute(LEGACY_MONITOR_SQL).fetchall(), iterations),
+                 _plan(conn, LEGACY_MONITOR_SQL)),
+                ("monitor, epoch", _time_calls(lambda: db_utils.get_pending_payments_to_monitor(100), iterations),
+                 _plan(conn, MONITOR_SQL, (now, now))),
+                ("expiry,  ISO text", _time_calls(lambda: conn.execute(LEGACY_STALE_SQL).fetchall(), iterations),
+                 _plan(conn, LEGACY_STALE_SQL)),
+                ("expiry,  epoch", _time_calls(lambda: db_utils.get_stale_monitoring_payments(100), iterations),
+                 _plan(conn, STALE_SQL, (now,))),
+            ]
+        db_utils.close_db_connections()
+
+    print(f"pending rows: {rows} ({MONITORING_SHARE:.0%} monitoring), iterations: {iterations}, LIMIT 100")
+    for label, ms, plan in results:
+        print(f"{label}: {ms:8.3f} ms/query    plan: {plan}")
+
+
+if __name__ == '__main__':
+    main()
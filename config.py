@@ -64,18 +64,75 @@ USDT_TRC20_CONTRACT_ADDRESS = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
 # You can uncomment and adjust these values. If they remain commented or are not present,
 # the bot will use the default values specified in bot.py via getattr().
 
+# JOB_WORKER_THREADS = 3 # Worker threads running background jobs (payment checks, expiry, backups...) from the jobs table.
+# JOB_POLL_SECONDS = 1.0 # How often idle job workers look for due jobs.
+# JOB_STOP_TIMEOUT_SECONDS = 60 # On shutdown, how long to wait for running jobs to finish before closing the database.
 # SCHEDULER_INIT_DELAY_TICKET_EXPIRY_SECONDS = 10  # Initial delay (seconds) before the first ticket expiration check.
 # SCHEDULER_INTERVAL_TICKET_EXPIRY_SECONDS = 3600 # Interval (seconds) between ticket expiration checks (e.g., 1 hour).
-# SCHEDULER_INIT_DELAY_ITEM_SYNC_SECONDS = 20    # Initial delay (seconds) before the first item availability sync.
-# SCHEDULER_INTERVAL_ITEM_SYNC_SECONDS = 3600  # Interval (seconds) between item availability syncs (e.g., 1 hour).
+# TICKET_EXPIRY_HOURS = 24 # Open tickets without a new message for this many hours are auto-expired.
+# BULK_SEND_MESSAGES_PER_SECOND = 25 # Pace of batched notifications (e.g. auto-expiry notices); Telegram allows ~30/s.
 # SCHEDULER_INIT_DELAY_PAYMENT_CHECK_SECONDS = 30 # Initial delay (seconds) before the first pending crypto payment check.
 # SCHEDULER_INTERVAL_PAYMENT_CHECK_SECONDS = 120 # Interval (seconds) between pending crypto payment checks (e.g., 2 minutes).
 # SCHEDULER_INIT_DELAY_PROCESS_CONFIRMED_SECONDS = 15 # Initial delay (seconds) before first processing of confirmed payments.
 # SCHEDULER_INTERVAL_PROCESS_CONFIRMED_SECONDS = 60 # Interval (seconds) for processing confirmed payments (e.g., 1 minute).
+# PAYMENT_RECHECK_DELAY_SECONDS = 30 # After an on-demand check finds no confirmed payment yet, it is rechecked once this much later.
 # SCHEDULER_INIT_DELAY_EXPIRE_PAYMENTS_SECONDS = 60 # Initial delay (seconds) before first check for expiring stale payments.
 # SCHEDULER_INTERVAL_EXPIRE_PAYMENTS_SECONDS = 300 # Interval (seconds) for expiring stale payments (e.g., 5 minutes).
-
-# --- Blockchain API Call Delays (Defaults used in modules if not set here) ---
-# This can help manage rate limiting if you are using public API endpoints without keys.
-# BLOCKCHAIN_API_CALL_DELAY_SECONDS = 2.0 # General delay (seconds) between calls in payment_monitor loops to different APIs.
-                                         # Individual API modules might have their own specific internal delays or logic.
+# SCHEDULER_INIT_DELAY_BALANCE_SNAPSHOT_SECONDS = 120 # Initial delay (seconds) before the first balance snapshot run.
+# SCHEDULER_INTERVAL_BALANCE_SNAPSHOT_SECONDS = 3600 # Interval (seconds) between balance snapshot runs (e.g., 1 hour).
+# LEDGER_SNAPSHOT_MIN_ENTRIES = 20 # A user gets a new balance snapshot once this many ledger entries follow their last one.
+# SCHEDULER_INIT_DELAY_ARCHIVE_SECONDS = 300 # Initial delay (seconds) before the first archival run.
+# SCHEDULER_INTERVAL_ARCHIVE_SECONDS = 86400 # Interval (seconds) between archival runs (e.g., 1 day).
+# ARCHIVE_DATABASE_NAME = "data/database/archive.db" # Archive file for finished transactions (default: archive.db next to DATABASE_NAME).
+# ARCHIVE_AFTER_DAYS = 90 # Finished transactions untouched for this many days are moved to the archive.
+# ARCHIVE_BATCH_SIZE = 500 # Transactions moved per write transaction.
+# SCHEDULER_INIT_DELAY_BACKUP_SECONDS = 600 # Initial delay (seconds) before the first online backup.
+# SCHEDULER_INTERVAL_BACKUP_SECONDS = 21600 # Interval (seconds) between online backups (e.g., 6 hours).
+# SCHEDULER_INIT_DELAY_DB_MAINTENANCE_SECONDS = 900 # Initial delay (seconds) before the first checkpoint/vacuum pass.
+# SCHEDULER_INTERVAL_DB_MAINTENANCE_SECONDS = 600 # Interval (seconds) between checkpoint/vacuum passes; busy passes are skipped.
+# BACKUP_DIR = "data/database/backups" # Where compressed snapshots go (default: backups/ next to DATABASE_NAME).
+# BACKUP_KEEP = 7 # Snapshots kept per database file; older ones are deleted.
+# BACKUP_PAGES_PER_STEP = 256 # Pages copied per online-backup step; writers wait at most one step.
+# BACKUP_STEP_SLEEP_SECONDS = 0.05 # Pause between backup steps.
+# INCREMENTAL_VACUUM_MIN_FREE_PAGES = 1024 # Free pages needed before an incremental vacuum runs.
+# INCREMENTAL_VACUUM_PAGES_PER_RUN = 2048 # Upper bound of pages released per maintenance pass.
+# DB_QUERY_METRICS_ENABLED = False # Time every query (per statement and per calling function); view with /dbstats.
+# DB_SLOW_QUERY_MS = 200 # With metrics enabled, statements at least this slow (ms) are logged as warnings.
+# DB_METRICS_DUMP_PATH = "data/db_metrics.json" # Where /dbstats dump (and bot shutdown) write the metrics as JSON.
+# FINALIZATION_CLAIM_TIMEOUT_SECONDS = 600 # A payment claimed for finalization but never started is re-queued after this long.
+# ROW_CACHE_SIZE = 512 # Transaction / pending-payment rows kept in the in-process LRU cache (0 disables it).
+# ASYNC_DB_READER_THREADS = 4 # Reader threads behind modules.async_db (writes always use one dedicated thread).
+
+# --- External API Rate Limits (Defaults used in modules/rate_limiter.py if not set here) ---
+# Every call to Blockstream, BlockCypher, TronGrid and CoinGecko takes a token from that provider's bucket,
+# shared by the monitor, job workers and handlers. A 429 (or 503 with Retry-After) pauses the provider's bucket
+# for the Retry-After time.
+# API_RATE_LIMITS = {'blockstream': (5.0, 5), 'blockcypher': (3.0, 3), 'trongrid': (10.0, 10), 'coingecko': (0.5, 5)}
+#                   # provider -> (requests per second, burst); only the providers listed here are overridden.
+# API_RATE_LIMIT_MAX_WAIT_SECONDS = 30 # A call that cannot get a token within this long fails like a 429 instead of waiting.
+# API_RATE_LIMIT_DEFAULT_BACKOFF_SECONDS = 10 # Pause after a 429 that carries no Retry-After header.
+# HTTP_TIMEOUTS = {'blockstream': (5, 15), 'blockcypher': (5, 20), 'trongrid': (5, 15), 'coingecko': (5, 10)}
+#                 # provider -> (connect, read) timeout in seconds; only the providers listed here are overridden.
+# HTTP_POOL_MAXSIZE = 10 # Fixed keep-alive pool size for every provider. Unset, each pool is MONITOR_PROVIDER_CONCURRENCY for its coin + 2.
+# CHAIN_TIP_TTL_SECONDS = 30 # BTC confirmations use a cached chain tip height, refetched after this many seconds.
+# CHAIN_TIP_MAX_STALE_SECONDS = 600 # If refetching fails, the last known tip is used for up to this long.
+
+# --- Payment Monitor Write Batching (Defaults used in payment_monitor.py if not set here) ---
+# The monitor buffers per-payment bookkeeping writes (last_checked_at, confirmations, status) and flushes
+# them in one transaction when either limit is reached, at the end of every cycle, and on shutdown.
+# MONITOR_WRITE_BATCH_SIZE = 200     # Flush once this many writes are queued.
+# MONITOR_WRITE_FLUSH_SECONDS = 10.0 # Flush once the oldest queued write is this old (seconds).
+# MONITOR_RECHECK_SECONDS = 60 # A monitored payment is queried from the blockchain APIs again no sooner than this (seconds).
+
+# --- Payment Monitor Concurrency (Defaults used in payment_monitor.py if not set here) ---
+# Addresses are checked on a thread pool. Each coin's provider gets its own limit of parallel calls; the request
+# rate itself is governed by API_RATE_LIMITS.
+# MONITOR_PROVIDER_CONCURRENCY = {'BTC': 3, 'LTC': 2, 'USDT_TRX': 3} # Parallel API calls per coin (Blockstream / BlockCypher / TronGrid).
+# MONITOR_TARGET_CYCLE_SECONDS = 60 # A monitor cycle keeps checking due payments for at most this long, then logs a warning if it fell behind.
+# MONITOR_BATCH_SIZE = 100 # Due payments read per batch within a cycle.
+# LTC_BATCH_SIZE = 20 # LTC addresses per BlockCypher batch request (default 20 with BLOCKCYPHER_API_TOKEN, else 3, the keyless limit).
+
+# --- Database Connection Pool (Defaults used in db_utils.py if not set here) ---
+# Each worker thread keeps one long-lived SQLite connection (WAL journaling, synchronous=NORMAL).
+# DB_BUSY_TIMEOUT_MS = 5000     # How long (milliseconds) a connection waits on a locked database before raising.
+# DB_CACHED_STATEMENTS = 256    # Number of prepared statements cached per connection.
@@ -4,12 +4,13 @@ import os
 import logging
 import datetime
 
-from modules.db_utils import get_or_create_user, get_user_transaction_history
+from modules.db_utils import get_or_create_user
 from modules.message_utils import send_or_edit_message, delete_message
 from modules import text_utils
 from modules import db_utils
+from modules import money
 import config
-from handlers.utils import format_transaction_history_display, TX_HISTORY_PAGE_SIZE # Ensure this is available
+from handlers.utils import format_transaction_history_display, get_tx_history_page, TX_HISTORY_PAGE_SIZE
 from modules.text_utils import escape_md # Import escape_md
 
 logger = logging.getLogger(__name__)
@@ -25,7 +26,7 @@ def handle_account_callback(bot_instance, clear_user_state, get_user_state, upda
     try:
         user_data = get_or_create_user(user_id)
         # Access data from sqlite3.Row object using column name
-        balance = user_data['balance']
+        balance_cents = user_data['balance_cents']
         transaction_count = user_data['transaction_count']
 
         # Fetch recent transactions for a quick overview (e.g., last 3-5)
@@ -37,7 +38,7 @@ def handle_account_callback(bot_instance, clear_user_state, get_user_state, upda
 
         account_info_text = (
             f"👤 Your Account\n\n"
-            f"💰 Balance: {balance:.2f} EUR\n"
+            f"💰 Balance: {money.format_eur(balance_cents)} EUR\n"
             f"📊 Total Transactions: {transaction_count}\n\n"
             # f"{formatted_recent_txs['text'] if recent_transactions else 'No recent transactions.'}\n\n" # If showing recent
             f"Select an option below:"
@@ -77,36 +78,40 @@ def handle_view_full_history_callback(bot_instance, clear_user_state, get_user_s
     existing_message_id = call.message.message_id
 
     try:
-        page_data = call.data.split('view_tx_history_page_')
-        if len(page_data) < 2 or not page_data[1].isdigit():
+        # Callback data: view_tx_history_page_<page>[_<cursor>], see handlers.utils.get_tx_history_page
+        page_data = call.data[len('view_tx_history_page_'):].split('_', 1)
+        if not page_data[0].isdigit():
             logger.warning(f"Invalid page number in callback data: {call.data} for user {user_id}")
             bot_instance.answer_callback_query(call.id, "Error: Invalid page number.", show_alert=True)
             return
-        page = int(page_data[1])
-        if page < 1: page = 1 # Ensure page is at least 1
+        page = int(page_data[0])
+        cursor = page_data[1] if len(page_data) > 1 else None
+        if page < 1 or cursor is None: page = 1 # Without a cursor this is always the newest page
 
-        logger.info(f"User {user_id} requested transaction history page {page}.")
+        logger.info(f"User {user_id} requested transaction history page {page} (cursor {cursor}).")
         update_user_state(user_id, 'current_tx_history_page', page)
 
         user_data = get_or_create_user(user_id) # To get total_transactions
-        total_transactions = user_data.get('transactions_count', 0)
+        total_transactions = user_data['transaction_count'] if user_data else 0
 
-        transactions = get_user_transaction_history(user_id, page=page, page_size=DEFAULT_PAGE_SIZE)
+        transactions, newer_cursor, older_cursor = get_tx_history_page(user_id, cursor)
 
-        if not transactions and page > 1: # User might be trying to access a page that no longer exists after items were deleted
+        if not transactions and cursor is not None: # The anchor transaction may no longer be on this page
             logger.info(f"No transactions on page {page} for user {user_id}, redirecting to page 1.")
             page = 1
             update_user_state(user_id, 'current_tx_history_page', page)
-            transactions = get_user_transaction_history(user_id, page=page, page_size=DEFAULT_PAGE_SIZE)
+            transactions, newer_cursor, older_cursor = get_tx_history_page(user_id, None)
 
-        display_data = format_transaction_history_display(transactions, page, DEFAULT_PAGE_SIZE, total_transactions)
+        total_pages = max(1, -(-(total_transactions or 0) // DEFAULT_PAGE_SIZE))
+        header = escape_md(f"Transaction History (Page {page}/{max(total_pages, page)})")
+        text = f"*{header}*{format_transaction_history_display(transactions)}"
 
         markup = types.InlineKeyboardMarkup(row_width=2)
         nav_buttons = []
-        if display_data['has_previous_page']:
-            nav_buttons.append(types.InlineKeyboardButton("⬅️ Previous", callback_data=f"view_tx_history_page_{page-1}"))
-        if display_data['has_next_page']:
-            nav_buttons.append(types.InlineKeyboardButton("Next ➡️", callback_data=f"view_tx_history_page_{page+1}"))
+        if newer_cursor and page > 1:
+            nav_buttons.append(types.InlineKeyboardButton("⬅️ Previous", callback_data=f"view_tx_history_page_{page-1}_{newer_cursor}"))
+        if older_cursor:
+            nav_buttons.append(types.InlineKeyboardButton("Next ➡️", callback_data=f"view_tx_history_page_{page+1}_{older_cursor}"))
 
         if nav_buttons:
             markup.add(*nav_buttons) # Unpack if list is not empty
@@ -115,7 +120,7 @@ def handle_view_full_history_callback(bot_instance, clear_user_state, get_user_s
         markup.add(types.InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="back_to_main"))
 
         sent_message_id = send_or_edit_message(
-            bot_instance, chat_id, escape_md(display_data['text']),
+            bot_instance, chat_id, text,
             reply_markup=markup,
             existing_message_id=existing_message_id,
             parse_mode="MarkdownV2"
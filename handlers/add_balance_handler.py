@@ -2,18 +2,17 @@
 import logging
 import os
 import datetime
-from decimal import Decimal, ROUND_UP
 
 from telebot import types
 
 from modules.db_utils import (
-    get_or_create_user, update_user_balance, record_transaction,
+    get_or_create_user, credit_balance, record_transaction,
     update_transaction_status, get_pending_payment_by_transaction_id,
     update_pending_payment_status, get_next_address_index,
     create_pending_payment, update_main_transaction_for_hd_payment,
-    get_transaction_by_id, increment_user_transaction_count
+    get_transaction_by_id, increment_user_transaction_count, from_epoch
 )
-from modules import hd_wallet_utils, exchange_rate_utils, payment_monitor
+from modules import hd_wallet_utils, exchange_rate_utils, payment_monitor, money, job_queue
 from modules.message_utils import send_or_edit_message, delete_message
 from modules.text_utils import escape_md # Import escape_md
 import config
@@ -68,31 +67,30 @@ def handle_amount_input_for_add_balance(bot_instance, clear_user_state, get_user
     existing_message_id = get_user_state(user_id, 'last_bot_message_id')
 
     try:
-        float_amount_str = message_text.strip().replace(',', '.')
-        requested_eur_decimal = Decimal(float_amount_str).quantize(Decimal('0.01'))
+        requested_cents = money.eur_to_cents(message_text)
 
-        if requested_eur_decimal <= Decimal('0.00'):
+        if requested_cents <= 0:
             raise ValueError("Amount must be positive.")
-        if requested_eur_decimal > Decimal('5000.00'): # Max top-up
+        if requested_cents > 5000 * money.CENTS_PER_EUR: # Max top-up
              raise ValueError("Maximum top-up amount is 5000 EUR.")
 
         try:
             # Access ADD_BALANCE_SERVICE_FEE_EUR from config directly
-            service_fee_decimal = Decimal(str(config.ADD_BALANCE_SERVICE_FEE_EUR)).quantize(Decimal('0.01'))
-        except (AttributeError, ValueError, TypeError):
+            service_fee_cents = money.eur_to_cents(config.ADD_BALANCE_SERVICE_FEE_EUR)
+        except (AttributeError, ValueError):
             logger.critical(f"ADD_BALANCE_SERVICE_FEE_EUR ('{getattr(config, 'ADD_BALANCE_SERVICE_FEE_EUR', 'NOT SET')}') is not valid. Defaulting to 0.0.")
-            service_fee_decimal = Decimal('0.00')
+            service_fee_cents = 0
 
-        total_due_eur_decimal = requested_eur_decimal + service_fee_decimal
+        total_due_cents = requested_cents + service_fee_cents
 
-        update_user_state(user_id, 'add_balance_requested_eur', float(requested_eur_decimal))
-        update_user_state(user_id, 'add_balance_total_due_eur', float(total_due_eur_decimal))
+        update_user_state(user_id, 'add_balance_requested_cents', requested_cents)
+        update_user_state(user_id, 'add_balance_total_due_cents', total_due_cents)
         update_user_state(user_id, 'current_flow', 'add_balance_awaiting_payment_method')
 
         # Construct the raw confirmation text first
-        raw_confirmation_text = (f"Amount to Add: {requested_eur_decimal:.2f} EUR\n"
-                                 f"Service Fee: {service_fee_decimal:.2f} EUR\n"
-                                 f"Total Due: {total_due_eur_decimal:.2f} EUR\n\n"
+        raw_confirmation_text = (f"Amount to Add: {money.format_eur(requested_cents)} EUR\n"
+                                 f"Service Fee: {money.format_eur(service_fee_cents)} EUR\n"
+                                 f"Total Due: {money.format_eur(total_due_cents)} EUR\n\n"
                                  f"Please select your preferred payment method.") # Removed pre-escaped backslash
 
         markup_select_payment = types.InlineKeyboardMarkup(row_width=1)
@@ -150,10 +148,10 @@ def handle_pay_balance_crypto_callback(bot_instance, clear_user_state, get_user_
         bot_instance.answer_callback_query(call.id, "Error processing your selection.", show_alert=True)
         return
 
-    requested_eur_float = get_user_state(user_id, 'add_balance_requested_eur')
-    total_due_eur_float = get_user_state(user_id, 'add_balance_total_due_eur')
+    requested_cents = get_user_state(user_id, 'add_balance_requested_cents')
+    total_due_cents = get_user_state(user_id, 'add_balance_total_due_cents')
 
-    if requested_eur_float is None or total_due_eur_float is None:
+    if requested_cents is None or total_due_cents is None:
        logger.warning(f"Missing session data for pay_balance (HD Wallet) for user {user_id}.")
        error_text = "Your session seems to have expired or some data is missing. Please start over."
        markup_error = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="back_to_main"))
@@ -174,11 +172,11 @@ def handle_pay_balance_crypto_callback(bot_instance, clear_user_state, get_user_
     current_message_id_for_invoice = ack_msg.message_id if isinstance(ack_msg, types.Message) else original_message_id
 
 
-    transaction_notes = f"User adding {requested_eur_float:.2f} EUR to balance. Total due: {total_due_eur_float:.2f} EUR via {crypto_currency_selected}."
+    transaction_notes = f"User adding {money.format_eur(requested_cents)} EUR to balance. Total due: {money.format_eur(total_due_cents)} EUR via {crypto_currency_selected}."
     main_transaction_id = record_transaction(
         user_id=user_id, type='balance_top_up',
-        eur_amount=total_due_eur_float,
-        original_add_balance_amount=requested_eur_float, # Store the original amount user wanted to add
+        eur_amount_cents=total_due_cents,
+        original_add_balance_cents=requested_cents, # Store the original amount user wanted to add
         payment_status='pending_address_generation',
         notes=transaction_notes
     )
@@ -218,12 +216,8 @@ def handle_pay_balance_crypto_callback(bot_instance, clear_user_state, get_user_
         update_transaction_status(main_transaction_id, 'error_exchange_rate')
         return
 
-    precision_map = {"BTC": 8, "LTC": 8, "USDT": 6}
-    num_decimals = precision_map.get(display_coin_symbol, 8)
-    total_due_eur_decimal = Decimal(str(total_due_eur_float))
-    expected_crypto_amount_decimal_hr = (total_due_eur_decimal / rate).quantize(Decimal('1e-' + str(num_decimals)), rounding=ROUND_UP)
-    smallest_unit_multiplier = Decimal('1e-' + str(num_decimals))
-    expected_crypto_amount_smallest_unit_str = str(int(expected_crypto_amount_decimal_hr * smallest_unit_multiplier))
+    expected_crypto_units = money.eur_cents_to_crypto_units(total_due_cents, rate, display_coin_symbol)
+    expected_crypto_amount_decimal_hr = money.units_to_crypto(expected_crypto_units, display_coin_symbol)
 
     payment_window_minutes = getattr(config, 'PAYMENT_WINDOW_MINUTES', 60)
     expires_at_dt = datetime.datetime.utcnow() + datetime.timedelta(minutes=payment_window_minutes)
@@ -250,23 +244,14 @@ def handle_pay_balance_crypto_callback(bot_instance, clear_user_state, get_user_
         unique_address = existing_pending_payment['address']
         db_coin_symbol_for_pending = existing_pending_payment['coin_symbol']
         network_for_db = existing_pending_payment['network']
-        expected_crypto_amount_smallest_unit_str = existing_pending_payment['expected_crypto_amount']
-        expires_at_dt = datetime.datetime.fromisoformat(existing_pending_payment['expires_at']) # Assuming ISO format storage
+        expected_crypto_units = existing_pending_payment['expected_crypto_units']
+        expires_at_dt = from_epoch(existing_pending_payment['expires_at'])
         pending_payment_id = existing_pending_payment['payment_id'] # Keep track of the ID
 
         # Need to recalculate expected_crypto_amount_decimal_hr for display if needed,
         # or fetch it from the main transaction if stored there.
         # For now, let's assume the main transaction has the human-readable amount.
-        main_tx_details = get_transaction_by_id(main_transaction_id)
-        if main_tx_details and main_tx_details['crypto_amount']:
-             expected_crypto_amount_decimal_hr = Decimal(main_tx_details['crypto_amount'])
-        else:
-             # Fallback: attempt to convert smallest unit back (might lose precision)
-             precision_map = {"BTC": 8, "LTC": 8, "USDT_TRX": 6} # Use DB symbol for lookup
-             num_decimals = precision_map.get(db_coin_symbol_for_pending, 8)
-             smallest_unit_multiplier = Decimal('1e-' + str(num_decimals))
-             expected_crypto_amount_decimal_hr = Decimal(expected_crypto_amount_smallest_unit_str) / smallest_unit_multiplier
-             logger.warning(f"HD Wallet: Reconstructed human-readable amount for tx {main_transaction_id} from smallest unit. Precision loss possible.")
+        expected_crypto_amount_decimal_hr = money.units_to_crypto(expected_crypto_units, db_coin_symbol_for_pending)
 
         # Ensure display_coin_symbol is correct based on db_coin_symbol_for_pending
         display_coin_symbol = "USDT" if db_coin_symbol_for_pending == "USDT_TRX" else db_coin_symbol_for_pending
@@ -282,16 +267,16 @@ def handle_pay_balance_crypto_callback(bot_instance, clear_user_state, get_user_
            address=unique_address, # unique_address was generated earlier
            coin_symbol=db_coin_symbol_for_pending,
            network=network_for_db,
-           expected_crypto_amount=expected_crypto_amount_smallest_unit_str, # calculated earlier
+           expected_crypto_units=expected_crypto_units, # calculated earlier
            expires_at=expires_at_dt, # calculated earlier
-           paid_from_balance_eur=0.0
+           paid_from_balance_cents=0
         )
         if not pending_payment_id:
            logger.error(f"HD Wallet: Failed to create pending_crypto_payment for add balance main_tx {main_transaction_id} (user {user_id}).")
            update_transaction_status(main_transaction_id, 'error_creating_pending_payment')
            send_or_edit_message(bot_instance, chat_id, escape_md("Error preparing payment record. Please try again or contact support."), existing_message_id=current_message_id_for_invoice)
            return # Exit if creation failed
-        logger.debug(f"handle_pay_balance_crypto_callback: Created new pending payment {pending_payment_id} for tx {main_transaction_id}. Address: {unique_address}, Expected Amount (smallest unit): {expected_crypto_amount_smallest_unit_str}")
+        logger.debug(f"handle_pay_balance_crypto_callback: Created new pending payment {pending_payment_id} for tx {main_transaction_id}. Address: {unique_address}, Expected Amount (smallest unit): {expected_crypto_units}")
 
 
     # Proceed with generating QR code and sending invoice using the obtained/reused details
@@ -306,15 +291,13 @@ def handle_pay_balance_crypto_callback(bot_instance, clear_user_state, get_user_
     except Exception as e_qr_gen:
         logger.error(f"HD Wallet (add balance): QR code generation failed for {unique_address} (user {user_id}, tx {main_transaction_id}): {e_qr_gen}")
 
-    requested_eur_decimal_for_display = Decimal(str(requested_eur_float)).quantize(Decimal('0.01')) # Convert float to Decimal for display
-    service_fee_display = total_due_eur_decimal - requested_eur_decimal_for_display
     # Construct the raw invoice text first - removed pre-escaped characters
-    # Decimal amounts are formatted directly, escape_md will handle periods
+    # Amounts are formatted directly, escape_md will handle periods
     raw_invoice_text = (
         f"🧾 INVOICE - Add Balance\n\n"
-        f"Amount to Add: {requested_eur_decimal_for_display:.2f} EUR\n"
-        f"Service Fee: {service_fee_display:.2f} EUR\n"
-        f"Total Due: {total_due_eur_decimal:.2f} EUR\n\n"
+        f"Amount to Add: {money.format_eur(requested_cents)} EUR\n"
+        f"Service Fee: {money.format_eur(total_due_cents - requested_cents)} EUR\n"
+        f"Total Due: {money.format_eur(total_due_cents)} EUR\n\n"
         f"🏦 Payment Details\n"
         f"Currency: {display_coin_symbol}\n"
         f"Network: {network_for_db}\n"
@@ -638,9 +621,10 @@ def handle_check_add_balance_payment_callback(bot_instance, clear_user_state, ge
         if newly_confirmed and status_info == 'confirmed_unprocessed':
             logger.info(f"On-demand check for add balance tx {transaction_id} (user {user_id}) resulted in new confirmation. Processing...")
             bot_instance.send_message(chat_id, escape_md("✅ Payment detected! Processing your balance update..."))
-            payment_monitor.process_confirmed_payments(bot_instance)
+            job_queue.run_soon('process_confirmed_payments')
         else:
             logger.info(f"On-demand check for add balance tx {transaction_id} (user {user_id}): newly_confirmed={newly_confirmed}, status_info='{status_info}'")
+            payment_monitor.schedule_payment_recheck(transaction_id, status_info)
             pending_payment_latest = get_pending_payment_by_transaction_id(transaction_id)
 
             current_invoice_text = call.message.caption if call.message.photo else call.message.text
@@ -888,11 +872,11 @@ def handle_execute_change_payment_callback(bot_instance, clear_user_state, get_u
 
     # 4. Redirect the user back to the payment method selection step
     # This is essentially the state after handle_amount_input_for_add_balance.
-    # We need the requested_eur_float and total_due_eur_float from state.
-    requested_eur_float = get_user_state(user_id, 'add_balance_requested_eur')
-    total_due_eur_float = get_user_state(user_id, 'add_balance_total_due_eur')
+    # We need the requested and total due amounts (cents) from state.
+    requested_cents = get_user_state(user_id, 'add_balance_requested_cents')
+    total_due_cents = get_user_state(user_id, 'add_balance_total_due_cents')
 
-    if requested_eur_float is None or total_due_eur_float is None:
+    if requested_cents is None or total_due_cents is None:
        logger.warning(f"Missing session data for execute_change_payment for user {user_id}. Returning to main menu.")
        clear_user_state(user_id)
        welcome_text, markup = get_main_menu_text_and_markup()
@@ -902,13 +886,11 @@ def handle_execute_change_payment_callback(bot_instance, clear_user_state, get_u
     update_user_state(user_id, 'current_flow', 'add_balance_awaiting_payment_method') # Set flow state
 
     # Re-send the payment method selection message
-    requested_eur_decimal = Decimal(str(requested_eur_float)).quantize(Decimal('0.01'))
-    total_due_eur_decimal = Decimal(str(total_due_eur_float)).quantize(Decimal('0.01'))
-    service_fee_decimal = total_due_eur_decimal - requested_eur_decimal # Recalculate fee for display
+    service_fee_cents = total_due_cents - requested_cents # Recalculate fee for display
 
-    confirmation_text = (f"Amount to Add: {requested_eur_decimal:.2f} EUR\n"
-                        f"Service Fee: {service_fee_decimal:.2f} EUR\n"
-                        f"Total Due: {total_due_eur_decimal:.2f} EUR\n\n"
+    confirmation_text = (f"Amount to Add: {money.format_eur(requested_cents)} EUR\n"
+                        f"Service Fee: {money.format_eur(service_fee_cents)} EUR\n"
+                        f"Total Due: {money.format_eur(total_due_cents)} EUR\n\n"
                         f"Please select your preferred payment method.") # Removed bolding around amounts
 
     markup_select_payment = types.InlineKeyboardMarkup(row_width=1)
@@ -965,32 +947,17 @@ def handle_cancel_change_payment_callback(bot_instance, clear_user_state, get_us
 
 # --- Payment Finalization Function (called by payment_monitor) ---
 def finalize_successful_top_up(bot_instance, main_transaction_id: int, user_id: int,
-                               original_add_balance_amount_str: str, # From main_transaction.original_add_balance_amount
-                               received_crypto_amount_str: str,
+                               original_add_balance_cents: int, # From main_transaction.original_add_balance_cents
+                               received_crypto_units: int,
                                coin_symbol: str,
                                blockchain_tx_id: str
                                ) -> bool:
-    logger.info(f"Finalizing successful top-up for user {user_id}, main_tx_id {main_transaction_id}. Amount: {original_add_balance_amount_str}")
+    logger.info(f"Finalizing successful top-up for user {user_id}, main_tx_id {main_transaction_id}. Amount: {money.format_eur(original_add_balance_cents)}")
     chat_id = user_id
 
     try:
-        try:
-            original_add_balance_amount_decimal = Decimal(original_add_balance_amount_str).quantize(Decimal('0.01'))
-        except Exception as e_dec:
-            logger.error(f"finalize_successful_top_up: Invalid amount format '{original_add_balance_amount_str}' for tx {main_transaction_id}. Error: {e_dec}")
-            update_transaction_status(main_transaction_id, 'error_finalizing_data')
-            return False
-
-        user_data = get_or_create_user(user_id)
-        if not user_data:
-            logger.error(f"finalize_successful_top_up: Failed to get/create user {user_id} for tx {main_transaction_id}.")
-            update_transaction_status(main_transaction_id, 'error_finalizing_user_data')
-            return False
-
-        current_balance_decimal = Decimal(str(user_data['balance'])).quantize(Decimal('0.01'))
-        new_balance_decimal = current_balance_decimal + original_add_balance_amount_decimal
-
-        if not update_user_balance(user_id, float(new_balance_decimal), increment_transactions=True): # Main transaction already created, this increments user's total count
+        new_balance_cents = credit_balance(user_id, original_add_balance_cents, 'balance_top_up', transaction_id=main_transaction_id, increment_transactions=True) # Main transaction already created, this increments user's total count
+        if new_balance_cents is None:
             logger.error(f"finalize_successful_top_up: Failed to update balance for user {user_id}, tx {main_transaction_id}.")
             update_transaction_status(main_transaction_id, 'error_finalizing_balance_update')
             return False
@@ -999,8 +966,8 @@ def finalize_successful_top_up(bot_instance, main_transaction_id: int, user_id:
             logger.warning(f"finalize_successful_top_up: Failed to update main transaction {main_transaction_id} status to completed, but balance was updated for user {user_id}.")
 
         success_text = (f"✅ Payment confirmed for Transaction ID {main_transaction_id}\\!\n"
-                        f"Your balance has been updated by *{escape_md(f'{original_add_balance_amount_decimal:.2f}')} EUR*\\.\n\n"
-                        f"New balance: *{escape_md(f'{new_balance_decimal:.2f}')} EUR*")
+                        f"Your balance has been updated by *{escape_md(money.format_eur(original_add_balance_cents))} EUR*\\.\n\n"
+                        f"New balance: *{escape_md(money.format_eur(new_balance_cents))} EUR*")
 
         markup_main_menu = types.InlineKeyboardMarkup()
         markup_main_menu.add(types.InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="back_to_main"))
@@ -1020,7 +987,7 @@ def finalize_successful_top_up(bot_instance, main_transaction_id: int, user_id:
 
         sent_msg = bot_instance.send_message(chat_id, escape_md(success_text), reply_markup=markup_main_menu, parse_mode="MarkdownV2")
         update_user_state(user_id, 'last_bot_message_id', sent_msg.message_id) # Store the new message ID
-        logger.info(f"finalize_successful_top_up: Successfully processed top-up for user {user_id}, tx {main_transaction_id}. New balance: {new_balance_decimal:.2f} EUR.")
+        logger.info(f"finalize_successful_top_up: Successfully processed top-up for user {user_id}, tx {main_transaction_id}. New balance: {money.format_eur(new_balance_cents)} EUR.")
         return True
 
     except sqlite3.Error as e_sql:
@@ -1,9 +1,9 @@
 import telebot
 from telebot import types
-import json
 import datetime
 import os
 import logging
+import time
 from decimal import Decimal
 
 # from bot import bot, get_user_state, update_user_state, clear_user_state # Removed
@@ -12,14 +12,16 @@ from modules.db_utils import (
     get_all_open_tickets_admin, get_ticket_details_by_id, # Assuming these are still needed for ticket system
     add_message_to_ticket, update_ticket_status,
     update_admin_ticket_view_message_id,
-    get_or_create_user, get_user_transaction_history
+    get_or_create_user
 )
 from modules import file_system_utils
 from modules.message_utils import send_or_edit_message, delete_message
 from modules.text_utils import escape_md
 import config
 from modules import db_utils
-from handlers.utils import format_transaction_history_display, TX_HISTORY_PAGE_SIZE
+from modules import money
+from modules import db_metrics
+from handlers.utils import format_transaction_history_display, get_tx_history_page
 
 
 logger = logging.getLogger(__name__)
@@ -27,27 +29,26 @@ logger = logging.getLogger(__name__)
 TICKETS_PER_PAGE = 5
 ITEMS_PER_PAGE_ADMIN = 5
 USERS_PER_PAGE_ADMIN = 10
+SEARCH_RESULTS_PER_PAGE_ADMIN = 8
 
 
 # --- Admin Support Ticket Management ---
 def format_ticket_summary_for_list(ticket):
-    messages = json.loads(ticket['messages_json']) if ticket['messages_json'] else []
-    first_message_snippet = "No messages yet."
-    if messages:
-        first_message_obj = messages[0]
-        text_snippet = escape_md(first_message_obj['text'][:40])
-        if len(first_message_obj['text']) > 40: text_snippet += "..."
-        first_message_snippet = f"_{text_snippet}_"
-
-    last_active_dt = datetime.datetime.fromisoformat(ticket['last_message_at'])
+    last_message_snippet = "No messages yet."
+    if ticket['last_message_preview']:
+        text_snippet = escape_md(ticket['last_message_preview'][:40])
+        if len(ticket['last_message_preview']) > 40: text_snippet += "..."
+        last_message_snippet = f"_{text_snippet}_"
+
+    last_active_dt = db_utils.from_epoch(ticket['last_message_at'])
     last_active_str = escape_md(last_active_dt.strftime("%Y-%m-%d %H:%M UTC"))
     status_escaped = escape_md(ticket['status'])
 
     return (
         f"Ticket ID: `{ticket['ticket_id']}` (User: `{ticket['user_id']}`)\n"
         f"Status: *{status_escaped}*\n"
-        f"Last Update: _{last_active_str}_\n"
-        f"Snippet: {first_message_snippet}"
+        f"Last Update: _{last_active_str}_ \\({ticket['message_count']} messages\\)\n"
+        f"Last Message: {last_message_snippet}"
     )
 
 # Note: Removed @bot decorators from all ticket and user management handlers below.
@@ -156,16 +157,16 @@ def handle_admin_view_ticket_callback(bot_instance, clear_user_state_fn, get_use
     update_user_state_fn(admin_id, 'admin_current_ticket_id', ticket_id)
     update_user_state_fn(admin_id, 'admin_flow', 'viewing_ticket') # For reply context
 
-    messages_list = json.loads(ticket['messages_json']) if ticket['messages_json'] else []
+    messages_list = db_utils.get_ticket_messages(ticket_id)
     conversation_history = [f"📜 *Conversation for Ticket \\#{ticket_id}* (User ID: `{ticket['user_id']}`)"]
     conversation_history.append(f"Status: *{escape_md(ticket['status'].replace('_', ' ').title())}*")
 
     for msg_data in messages_list:
-        sender = escape_md(msg_data.get('sender', 'System').title())
-        text = escape_md(msg_data.get('text', ''))
+        sender = escape_md((msg_data['sender'] or 'System').title())
+        text = escape_md(msg_data['text'])
         ts_str = "Unknown time"
         try:
-            ts_dt = datetime.datetime.fromisoformat(msg_data.get('timestamp'))
+            ts_dt = datetime.datetime.fromisoformat(msg_data['created_at'])
             ts_str = escape_md(ts_dt.strftime('%Y-%m-%d %H:%M:%S UTC'))
         except: pass
         conversation_history.append(f"\n*{sender}* ({ts_str}):\n{text}")
@@ -665,7 +666,9 @@ def handle_admin_add_item_execute(bot_instance, clear_user_state_fn, get_user_st
 
 # --- Admin User Management ---
 # (Keeping user management for now, as it's not directly conflicting with FS item management)
-def command_view_users(bot_instance, clear_user_state_fn, get_user_state_fn, update_user_state_fn, message, page=0):
+def command_view_users(bot_instance, clear_user_state_fn, get_user_state_fn, update_user_state_fn, message, page=0,
+                       after_user_id=0, before_user_id=None):
+    # Pages are keyset-based: after_user_id/before_user_id anchor the page, page is only the displayed number.
     admin_id = message.from_user.id
     chat_id = message.chat.id
     logger.info(f"Admin {admin_id} requested /viewusers, page {page}.")
@@ -683,7 +686,18 @@ def command_view_users(bot_instance, clear_user_state_fn, get_user_state_fn, upd
     elif hasattr(message, 'message') and message.message:
         existing_list_msg_id = message.message.message_id
 
-    users_list, total_users = db_utils.get_all_users_admin(limit=USERS_PER_PAGE_ADMIN, offset=page * USERS_PER_PAGE_ADMIN)
+    # One look-ahead row tells whether another page exists in the direction being paged.
+    users_list, total_users = db_utils.get_all_users_admin(limit=USERS_PER_PAGE_ADMIN + 1, after_user_id=after_user_id,
+                                                           before_user_id=before_user_id)
+    has_more = len(users_list) > USERS_PER_PAGE_ADMIN
+    if before_user_id is not None:
+        users_list = users_list[-USERS_PER_PAGE_ADMIN:]
+        has_previous, has_next = has_more, True
+    else:
+        users_list = users_list[:USERS_PER_PAGE_ADMIN]
+        has_previous, has_next = page > 0, has_more
+    if not has_previous:
+        page = 0
 
     if not users_list and total_users == 0:
         if existing_list_msg_id:
@@ -702,16 +716,18 @@ def command_view_users(bot_instance, clear_user_state_fn, get_user_state_fn, upd
     else:
         for user_row in users_list:
             user_id_to_view = user_row['user_id']
-            user_info_line = (f"ID: `{user_id_to_view}` B: *{user_row['balance']:.2f}€* Txs: *{user_row['transaction_count']}*")
+            user_info_line = (f"ID: `{user_id_to_view}` B: *{money.format_eur(user_row['balance_cents'])}€* Txs: *{user_row['transaction_count']}*")
             markup.add(types.InlineKeyboardButton(user_info_line, callback_data=f"admin_view_user_details_{user_id_to_view}"))
 
+    # Callback data: admin_users_page_<page>_a<user_id> (users after it) or _b<user_id> (users before it)
+    first_user_id = users_list[0]['user_id'] if users_list else after_user_id
     nav_buttons_row = []
-    if page > 0:
-        nav_buttons_row.append(types.InlineKeyboardButton("⬅️ Previous", callback_data=f"admin_users_page_{page - 1}"))
+    if has_previous and users_list:
+        nav_buttons_row.append(types.InlineKeyboardButton("⬅️ Previous", callback_data=f"admin_users_page_{page - 1}_b{first_user_id}"))
     if (total_users > USERS_PER_PAGE_ADMIN) and not (page == 0 and total_users <= USERS_PER_PAGE_ADMIN) :
-         nav_buttons_row.append(types.InlineKeyboardButton(f"📄 {page+1}", callback_data=f"admin_users_page_{page}"))
-    if (page + 1) * USERS_PER_PAGE_ADMIN < total_users:
-        nav_buttons_row.append(types.InlineKeyboardButton("Next ➡️", callback_data=f"admin_users_page_{page + 1}"))
+         nav_buttons_row.append(types.InlineKeyboardButton(f"📄 {page+1}", callback_data=f"admin_users_page_{page}_a{first_user_id - 1}"))
+    if has_next and users_list:
+        nav_buttons_row.append(types.InlineKeyboardButton("Next ➡️", callback_data=f"admin_users_page_{page + 1}_a{users_list[-1]['user_id']}"))
 
     if nav_buttons_row:
         markup.row(*nav_buttons_row)
@@ -723,29 +739,47 @@ def command_view_users(bot_instance, clear_user_state_fn, get_user_state_fn, upd
     if sent_msg:
         update_user_state_fn(admin_id, 'admin_user_list_main_msg_id', sent_msg.message_id)
     update_user_state_fn(admin_id, 'admin_user_list_current_page', page)
+    update_user_state_fn(admin_id, 'admin_user_list_after_user_id', first_user_id - 1 if users_list else 0)
 
 
 def callback_view_users_page(bot_instance, clear_user_state_fn, get_user_state_fn, update_user_state_fn, call):
     admin_id = call.from_user.id
+    after_user_id, before_user_id = 0, None
     try:
-        page = int(call.data.split('_')[-1])
+        parts = call.data[len('admin_users_page_'):].split('_')
+        page = int(parts[0])
+        if len(parts) > 1:
+            anchor = int(parts[1][1:])
+            if parts[1][0] == 'b':
+                before_user_id = anchor
+            elif parts[1][0] == 'a':
+                after_user_id = anchor
+            else:
+                raise ValueError(parts[1])
+        else:
+            page = 0 # Legacy buttons without an anchor restart from the first page
     except (IndexError, ValueError):
         bot_instance.answer_callback_query(call.id, "Invalid page number.", show_alert=True)
         return
 
     bot_instance.answer_callback_query(call.id)
-    command_view_users(bot_instance, clear_user_state_fn, get_user_state_fn, update_user_state_fn, call, page=page)
+    command_view_users(bot_instance, clear_user_state_fn, get_user_state_fn, update_user_state_fn, call, page=page,
+                       after_user_id=after_user_id, before_user_id=before_user_id)
 
 def handle_admin_view_user_details_callback(bot_instance, clear_user_state_fn, get_user_state_fn, update_user_state_fn, call, page=0):
     admin_id = call.from_user.id
     chat_id = call.message.chat.id
     target_user_id = None # Initialize
+    tx_cursor = None
 
     if call.data.startswith('admin_view_user_details_page_'):
+        # admin_view_user_details_page_<user_id>_<page>_<cursor>, see handlers.utils.get_tx_history_page
         try:
             parts = call.data.split('_')
             target_user_id = int(parts[4])
             page = int(parts[5])
+            tx_cursor = parts[6] if len(parts) > 6 else None
+            if tx_cursor is None: page = 0
             update_user_state_fn(admin_id, 'admin_viewing_user_id', target_user_id)
             update_user_state_fn(admin_id, 'admin_viewing_user_tx_page', page)
         except (IndexError, ValueError):
@@ -771,7 +805,9 @@ def handle_admin_view_user_details_callback(bot_instance, clear_user_state_fn, g
     if not user_data:
         bot_instance.answer_callback_query(call.id, "User not found.", show_alert=True)
         user_list_page = get_user_state_fn(admin_id, 'admin_user_list_current_page', 0)
-        command_view_users(bot_instance, clear_user_state_fn, get_user_state_fn, update_user_state_fn, call, page=user_list_page)
+        user_list_after = get_user_state_fn(admin_id, 'admin_user_list_after_user_id', 0)
+        command_view_users(bot_instance, clear_user_state_fn, get_user_state_fn, update_user_state_fn, call, page=user_list_page,
+                           after_user_id=user_list_after)
         return
 
     # Delete the main user list message or previous detail view message
@@ -785,29 +821,26 @@ def handle_admin_view_user_details_callback(bot_instance, clear_user_state_fn, g
     update_user_state_fn(admin_id, 'admin_view_user_details_msg_id', None)
 
 
-    balance = user_data['balance']
+    balance_cents = user_data['balance_cents']
     total_user_transactions = user_data['transaction_count']
 
     user_info_text = (
         f"👤 *User Details: ID `{target_user_id}`*\n\n"
-        f"Current Balance: *{balance:.2f} EUR*\n"
+        f"Current Balance: *{money.format_eur(balance_cents)} EUR*\n"
         f"Total Transactions: *{total_user_transactions}*"
     )
 
-    offset = page * TX_HISTORY_PAGE_SIZE
-    transactions = get_user_transaction_history(target_user_id, limit=TX_HISTORY_PAGE_SIZE, offset=offset)
+    transactions, newer_cursor, older_cursor = get_tx_history_page(target_user_id, tx_cursor)
     history_text_formatted = format_transaction_history_display(transactions)
 
     full_user_detail_text = user_info_text + history_text_formatted
 
     markup = types.InlineKeyboardMarkup(row_width=2)
     nav_buttons = []
-    if page > 0:
-        nav_buttons.append(types.InlineKeyboardButton("⬅️ Prev TXs", callback_data=f"admin_view_user_details_page_{target_user_id}_{page - 1}"))
-
-    total_tx_pages_for_user = (total_user_transactions + TX_HISTORY_PAGE_SIZE - 1) // TX_HISTORY_PAGE_SIZE
-    if (page + 1) * TX_HISTORY_PAGE_SIZE < total_user_transactions:
-        nav_buttons.append(types.InlineKeyboardButton("Next TXs ➡️", callback_data=f"admin_view_user_details_page_{target_user_id}_{page + 1}"))
+    if newer_cursor and page > 0:
+        nav_buttons.append(types.InlineKeyboardButton("⬅️ Prev TXs", callback_data=f"admin_view_user_details_page_{target_user_id}_{page - 1}_{newer_cursor}"))
+    if older_cursor:
+        nav_buttons.append(types.InlineKeyboardButton("Next TXs ➡️", callback_data=f"admin_view_user_details_page_{target_user_id}_{page + 1}_{older_cursor}"))
 
     if nav_buttons:
         markup.row(*nav_buttons)
@@ -828,14 +861,157 @@ def handle_admin_back_to_user_list_callback(bot_instance, clear_user_state_fn, g
         update_user_state_fn(admin_id, 'admin_view_user_details_msg_id', None)
 
     page = get_user_state_fn(admin_id, 'admin_user_list_current_page', 0)
+    after_user_id = get_user_state_fn(admin_id, 'admin_user_list_after_user_id', 0)
     # Clear specific user view states, but keep admin_user_list_current_page
     update_user_state_fn(admin_id, 'admin_viewing_user_id', None)
     update_user_state_fn(admin_id, 'admin_viewing_user_tx_page', None)
     update_user_state_fn(admin_id, 'admin_flow', None) # Reset general admin flow
 
-    command_view_users(bot_instance, clear_user_state_fn, get_user_state_fn, update_user_state_fn, call, page=page)
+    command_view_users(bot_instance, clear_user_state_fn, get_user_state_fn, update_user_state_fn, call, page=page,
+                       after_user_id=after_user_id)
     bot_instance.answer_callback_query(call.id)
 
 
+
+# --- Admin Search ---
+def _send_admin_search_results(bot_instance, update_user_state_fn, admin_id, chat_id, query_text, page=0, existing_message_id=None):
+    started = time.perf_counter()
+    # One look-ahead row tells whether a next page exists.
+    hits = db_utils.search_admin(query_text, limit=SEARCH_RESULTS_PER_PAGE_ADMIN + 1, offset=page * SEARCH_RESULTS_PER_PAGE_ADMIN)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    has_next = len(hits) > SEARCH_RESULTS_PER_PAGE_ADMIN
+    hits = hits[:SEARCH_RESULTS_PER_PAGE_ADMIN]
+
+    response_text = f"🔎 *Search:* `{escape_md(query_text[:50])}` \\(Page {page + 1}, {escape_md(f'{elapsed_ms:.0f}')} ms\\)\n\n"
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    if not hits:
+        response_text += "No matches found\\." if page == 0 else "No more matches\\."
+    for hit in hits:
+        snippet = escape_md(hit['snippet'] or '')
+        if hit['kind'] == 'ticket':
+            response_text += f"🎫 Ticket `{hit['ref_id']}` \\(User `{hit['user_id']}`\\)\n_{snippet}_\n\n"
+            markup.add(types.InlineKeyboardButton(f"👁️ Ticket #{hit['ref_id']}", callback_data=f"admin_view_ticket_{hit['ref_id']}"))
+        else:
+            response_text += f"💳 Transaction `{hit['ref_id']}` \\(User `{hit['user_id']}`\\)\n_{snippet}_\n\n"
+            markup.add(types.InlineKeyboardButton(f"👤 User {hit['user_id']} (TX #{hit['ref_id']})", callback_data=f"admin_view_user_details_{hit['user_id']}"))
+
+    nav_buttons = []
+    if page > 0: nav_buttons.append(types.InlineKeyboardButton("⬅️ Previous", callback_data=f"admin_search_page_{page - 1}"))
+    if has_next: nav_buttons.append(types.InlineKeyboardButton("Next ➡️", callback_data=f"admin_search_page_{page + 1}"))
+    if nav_buttons: markup.row(*nav_buttons)
+
+    sent_msg = send_or_edit_message(bot_instance, chat_id, response_text, reply_markup=markup,
+                                    existing_message_id=existing_message_id, parse_mode="MarkdownV2")
+    if sent_msg:
+        update_user_state_fn(admin_id, 'admin_search_msg_id', sent_msg.message_id)
+    logger.info(f"Admin {admin_id} searched {query_text!r}, page {page}: {len(hits)} hit(s) in {elapsed_ms:.1f} ms.")
+
+def command_admin_search(bot_instance, clear_user_state_fn, get_user_state_fn, update_user_state_fn, message):
+    admin_id = message.from_user.id
+    chat_id = message.chat.id
+    parts = (message.text or '').split(maxsplit=1)
+    query_text = parts[1].strip() if len(parts) > 1 else ''
+    if not query_text:
+        bot_instance.send_message(chat_id, "Usage: /search <text>\nSearches ticket messages, transaction notes, item names and blockchain transaction IDs.")
+        return
+
+    # The query is kept in state; callback data is too small to carry it.
+    update_user_state_fn(admin_id, 'admin_search_query', query_text)
+    _send_admin_search_results(bot_instance, update_user_state_fn, admin_id, chat_id, query_text)
+
+def callback_admin_search_page(bot_instance, clear_user_state_fn, get_user_state_fn, update_user_state_fn, call):
+    admin_id = call.from_user.id
+    try: page = max(0, int(call.data[len('admin_search_page_'):]))
+    except ValueError:
+        bot_instance.answer_callback_query(call.id, "Invalid page number.", show_alert=True)
+        return
+
+    query_text = get_user_state_fn(admin_id, 'admin_search_query')
+    if not query_text:
+        bot_instance.answer_callback_query(call.id, "Search expired. Please run /search again.", show_alert=True)
+        return
+
+    bot_instance.answer_callback_query(call.id)
+    _send_admin_search_results(bot_instance, update_user_state_fn, admin_id, call.message.chat.id, query_text,
+                               page=page, existing_message_id=call.message.message_id)
+
+STATS_DEFAULT_DAYS = 30
+STATS_MAX_DAYS = 366
+STATS_TOP_N = 10
+
+def command_admin_stats(bot_instance, clear_user_state_fn, get_user_state_fn, update_user_state_fn, message):
+    """/stats [days]: revenue and volume of completed transactions, read only from the daily rollups."""
+    chat_id = message.chat.id
+    parts = (message.text or '').split(maxsplit=1)
+    try: days = min(STATS_MAX_DAYS, max(1, int(parts[1]))) if len(parts) > 1 else STATS_DEFAULT_DAYS
+    except ValueError:
+        bot_instance.send_message(chat_id, "Usage: /stats [days]  (default 30)")
+        return
+
+    summary = db_utils.get_rollup_summary(days)
+    if not summary:
+        bot_instance.send_message(chat_id, "Could not load statistics. Please check the logs.")
+        return
+    if not summary['day']:
+        bot_instance.send_message(chat_id, f"No completed transactions in the last {days} day(s).")
+        return
+
+    total_count = sum(row['tx_count'] for row in summary['day'])
+    total_cents = sum(row['eur_cents'] for row in summary['day'])
+    lines = [f"Completed transactions, last {days} day(s): {total_count}, {money.format_eur(total_cents)} EUR"]
+    for dimension, title in (('type', 'By type'), ('coin', 'By coin'), ('city', 'By city'), ('day', 'By day')):
+        lines += ["", f"{title}:"]
+        lines += [f"  {row['key'] or '-'}: {row['tx_count']} / {money.format_eur(row['eur_cents'])} EUR"
+                  for row in summary[dimension][:STATS_TOP_N]]
+    # Plain text: city names and coin codes would all need MarkdownV2 escaping.
+    bot_instance.send_message(chat_id, "\n".join(lines)[:4000])
+
+DB_STATS_TOP_N = 8
+
+def _format_db_stat_line(label: str, stat: dict) -> str:
+    return (f"{label}\n  calls={stat['calls']} rows={stat['rows']} total={stat['total_ms']:.0f}ms "
+            f"avg={stat['avg_ms']:.2f}ms p95<={stat['p95_ms']}ms max={stat['max_ms']:.1f}ms")
+
+def command_admin_db_stats(bot_instance, clear_user_state_fn, get_user_state_fn, update_user_state_fn, message):
+    """/dbstats [calls|max|dump|reset]: row cache counters plus per-statement and per-function query metrics (needs DB_QUERY_METRICS_ENABLED)."""
+    chat_id = message.chat.id
+    parts = (message.text or '').split(maxsplit=1)
+    arg = parts[1].strip().lower() if len(parts) > 1 else ''
+    cache = db_utils.get_row_cache_stats()
+    cache_line = (f"Row cache: {cache['entries']}/{cache['max_entries']} rows, hits={cache['hits']} misses={cache['misses']} "
+                  f"(hit rate {cache['hit_rate']:.0%}), fresh reads={cache['bypasses']}, invalidations={cache['invalidations']}")
+
+    if not db_metrics.DB_QUERY_METRICS_ENABLED:
+        bot_instance.send_message(chat_id, f"{cache_line}\n\nQuery metrics are disabled. Set DB_QUERY_METRICS_ENABLED = True in config.py and restart the bot.")
+        return
+    if arg == 'reset':
+        db_metrics.reset()
+        bot_instance.send_message(chat_id, "Query metrics reset.")
+        return
+    if arg == 'dump':
+        try:
+            path = db_metrics.dump_metrics()
+        except OSError as e:
+            logger.exception(f"Admin {message.from_user.id}: failed to write query metrics dump.")
+            bot_instance.send_message(chat_id, f"Could not write metrics dump: {e}")
+            return
+        bot_instance.send_message(chat_id, f"Query metrics written to {path}")
+        return
+
+    order_by = {'calls': 'calls', 'max': 'max_ms'}.get(arg, 'total_ms')
+    stats = db_metrics.snapshot(limit=DB_STATS_TOP_N, order_by=order_by)
+    if not stats['callers']:
+        bot_instance.send_message(chat_id, f"{cache_line}\n\nNo queries recorded yet.")
+        return
+
+    lines = [cache_line, "", f"DB query metrics (top {DB_STATS_TOP_N} by {order_by}, slow log >= {stats['slow_query_ms']}ms)", "", "By function:"]
+    lines += [_format_db_stat_line(s['caller'], s) for s in stats['callers']]
+    lines += ["", "By statement:"]
+    lines += [_format_db_stat_line(s['sql'][:120], s) for s in stats['statements']]
+    lines += ["", "/dbstats calls | max | dump | reset"]
+    text = "\n".join(lines)
+    # Plain text on purpose: SQL is full of MarkdownV2 special characters.
+    bot_instance.send_message(chat_id, text[:4000])
+
 if __name__ == '__main__':
     logger.info("Admin Handler module loaded.")
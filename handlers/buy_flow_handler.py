@@ -4,14 +4,15 @@ import json
 import time
 import logging
 from modules.db_utils import (
-    get_or_create_user, update_user_balance, # Keep user related
+    get_or_create_user, debit_balance_if_sufficient, debit_balance_allowing_shortfall, # Keep user related
     record_transaction, update_transaction_status, # Keep transaction related
     get_pending_payment_by_transaction_id, # Keep payment related
     update_pending_payment_status, # Keep payment related
     increment_user_transaction_count, # Keep user related
     get_next_address_index, create_pending_payment, # HD Wallet specific
     update_main_transaction_for_hd_payment, # HD Wallet specific
-    get_transaction_by_id # transaction related
+    get_transaction_by_id, # transaction related
+    from_epoch # epoch-second payment times
     # Removed: get_cities_with_available_items, get_available_items_in_city,
     # get_product_details_by_id, sync_item_from_fs_to_db (these will be handled by product_fs_utils)
 )
@@ -19,11 +20,10 @@ from modules.db_utils import (
 from modules import product_fs_utils # New FS utility for products
 from modules.message_utils import send_or_edit_message, delete_message # Removed escape_markdownv2
 from modules.text_utils import escape_md # Keep escape_md import for now if it's used elsewhere with version 1 or for other purposes
-from modules import hd_wallet_utils, exchange_rate_utils, payment_monitor
+from modules import hd_wallet_utils, exchange_rate_utils, payment_monitor, money, job_queue
 import config
 import os
 import datetime # Ensure datetime is imported
-from decimal import Decimal, ROUND_UP # Ensure ROUND_UP is imported
 import sqlite3 # For specific exception handling in finalize
 
 from handlers.main_menu_handler import get_main_menu_text_and_markup # For fallbacks
@@ -352,34 +352,56 @@ def handle_size_selection_callback(bot_instance, clear_user_state, get_user_stat
 
 
     user_data = get_or_create_user(user_id)
-    item_price = Decimal(str(item_details_fs['price']))
+    item_price_cents = money.eur_to_cents(item_details_fs['price'])
     try:
-        service_fee = Decimal(str(config.SERVICE_FEE_EUR))
-    except (AttributeError, ValueError, TypeError):
-        logger.critical(f"SERVICE_FEE_EUR ('{getattr(config, 'SERVICE_FEE_EUR', 'NOT SET')}') is not a valid Decimal. Defaulting to 0.0.")
-        service_fee = Decimal('0.0')
+        service_fee_cents = money.eur_to_cents(config.SERVICE_FEE_EUR)
+    except (AttributeError, ValueError):
+        logger.critical(f"SERVICE_FEE_EUR ('{getattr(config, 'SERVICE_FEE_EUR', 'NOT SET')}') is not a valid amount. Defaulting to 0.0.")
+        service_fee_cents = 0
 
-    total_cost = item_price + service_fee
-    user_balance = Decimal(str(user_data['balance'])) if user_data and 'balance' in user_data else Decimal('0.0')
+    total_cost_cents = item_price_cents + service_fee_cents
+    user_balance_cents = user_data['balance_cents'] if user_data else 0
 
     # --- Purchase with balance logic ---
-    if user_balance >= total_cost:
-        logger.info(f"User {user_id} purchasing item from {instance_path} entirely with balance. Total: {total_cost}, Balance: {user_balance}")
+    if user_balance_cents >= total_cost_cents:
+        logger.info(f"User {user_id} purchasing item from {instance_path} entirely with balance. Total: {money.format_eur(total_cost_cents)}, Balance: {money.format_eur(user_balance_cents)}")
         update_user_state(user_id, 'current_flow', 'buy_processing_balance_payment')
-        new_balance = user_balance - total_cost
-        update_user_balance(user_id, float(new_balance), increment_transactions=True)
-
-        move_success = product_fs_utils.move_item_instance_to_purchased(instance_path, user_id)
-
         transaction_item_details_json = json.dumps({
             'city': selected_city, 'area': selected_area, 'type': selected_item_type,
-            'size': size_name, 'price': float(item_price), 'instance_path_original': instance_path
+            'size': size_name, 'price': item_details_fs['price'], 'instance_path_original': instance_path
         })
-        record_transaction(
-            user_id=user_id, # Removed product_id=None
-            item_details_json=transaction_item_details_json, # Using new field
-            type='purchase_balance', eur_amount=float(total_cost),
-            payment_status='completed' if move_success else 'completed_fs_move_error',
+        # Recorded before the debit so the ledger entry can reference it.
+        main_transaction_id = record_transaction(
+            user_id=user_id,
+            item_details_json=transaction_item_details_json,
+            type='purchase_balance', eur_amount_cents=total_cost_cents,
+            payment_status='processing_balance_payment'
+        )
+        if not main_transaction_id:
+            logger.error(f"Failed to record balance purchase transaction for user {user_id}, instance {instance_path}.")
+            send_or_edit_message(bot_instance, chat_id, escape_md("Error processing your purchase. Please try again or contact support."),
+                                 existing_message_id=existing_message_id, parse_mode="MarkdownV2")
+            update_user_state(user_id, 'current_flow', None)
+            bot_instance.answer_callback_query(call.id, "Error processing purchase.")
+            return
+
+        if debit_balance_if_sufficient(user_id, total_cost_cents, 'purchase_balance', transaction_id=main_transaction_id,
+                                       increment_transactions=True) is None:
+            # The balance changed since it was read (e.g. a concurrent purchase); nothing was debited.
+            logger.warning(f"Balance debit for user {user_id} failed at purchase time. Total: {money.format_eur(total_cost_cents)}")
+            update_transaction_status(main_transaction_id, 'failed_insufficient_balance')
+            markup = types.InlineKeyboardMarkup(row_width=1)
+            markup.add(types.InlineKeyboardButton("⬅️ Back to Size Selection", callback_data=f"select_type_{selected_item_type}"))
+            send_or_edit_message(bot_instance, chat_id, escape_md("Your balance changed while processing this purchase. Please try again."),
+                                 reply_markup=markup, existing_message_id=existing_message_id, parse_mode="MarkdownV2")
+            update_user_state(user_id, 'current_flow', None)
+            bot_instance.answer_callback_query(call.id, "Balance changed, please retry.")
+            return
+
+        move_success = product_fs_utils.move_item_instance_to_purchased(instance_path, user_id)
+
+        update_transaction_status(
+            main_transaction_id, 'completed' if move_success else 'completed_fs_move_error',
             notes=f"Paid from balance. Instance: {os.path.basename(instance_path)}. FS Move: {'OK' if move_success else 'FAIL'}"
         )
 
@@ -440,26 +462,27 @@ def handle_size_selection_callback(bot_instance, clear_user_state, get_user_stat
         return
 
     # --- External Payment Logic ---
-    paid_from_balance = Decimal('0.0')
-    amount_to_pay_externally = total_cost
+    paid_from_balance_cents = 0
+    amount_to_pay_externally_cents = total_cost_cents
 
-    if user_balance > Decimal('0.0'):
-        paid_from_balance = min(user_balance, total_cost)
-        amount_to_pay_externally = total_cost - paid_from_balance
+    if user_balance_cents > 0:
+        paid_from_balance_cents = min(user_balance_cents, total_cost_cents)
+        amount_to_pay_externally_cents = total_cost_cents - paid_from_balance_cents
 
-    if amount_to_pay_externally < Decimal('0.0'): amount_to_pay_externally = Decimal('0.0')
+    if amount_to_pay_externally_cents < 0: amount_to_pay_externally_cents = 0
 
 
-    if amount_to_pay_externally == Decimal('0.0') and total_cost > Decimal('0.0') : # Should not happen if logic above is correct
-        logger.error(f"LOGIC ERROR: amount_to_pay_externally is 0 but balance was less than total_cost. User: {user_id}, Balance: {user_balance}, Total: {total_cost}")
+    if amount_to_pay_externally_cents == 0 and total_cost_cents > 0 : # Should not happen if logic above is correct
+        logger.error(f"LOGIC ERROR: amount_to_pay_externally is 0 but balance was less than total_cost. User: {user_id}, Balance: {user_balance_cents}, Total: {total_cost_cents}")
         bot_instance.send_message(chat_id, "There was an issue calculating payment. Please try again or contact support.")
         clear_user_state(user_id) # Clear potentially corrupted state
         bot_instance.answer_callback_query(call.id, "Calculation error.")
         return
 
-    update_user_state(user_id, 'buy_amount_due_eur', float(amount_to_pay_externally))
-    update_user_state(user_id, 'buy_paid_from_balance', float(paid_from_balance))
-    update_user_state(user_id, 'buy_total_cost_eur', float(total_cost))
+    update_user_state(user_id, 'buy_amount_due_cents', amount_to_pay_externally_cents)
+    update_user_state(user_id, 'buy_paid_from_balance_cents', paid_from_balance_cents)
+    update_user_state(user_id, 'buy_total_cost_cents', total_cost_cents)
+    update_user_state(user_id, 'buy_service_fee_cents', service_fee_cents)
 
     # Clear any previous transaction context if user is re-selecting payment method for the same item
     previous_tx_id = get_user_state(user_id, 'buy_transaction_id')
@@ -475,7 +498,7 @@ def handle_size_selection_callback(bot_instance, clear_user_state, get_user_stat
 
     # Retrieve stored item details from user_state
     item_name_display = get_user_state(user_id, 'buy_selected_item_name_display', "Item")
-    item_price_from_state = get_user_state(user_id, 'buy_selected_item_price', float(item_price)) # Fallback to calculated
+    item_price_from_state = get_user_state(user_id, 'buy_selected_item_price', item_details_fs['price']) # Fallback to calculated
     item_description_from_state = get_user_state(user_id, 'buy_selected_item_description', "N/A")
     item_image_paths_from_state = get_user_state(user_id, 'buy_selected_item_image_paths', [])
     selected_city = get_user_state(user_id, 'buy_selected_city') # For back button
@@ -483,7 +506,7 @@ def handle_size_selection_callback(bot_instance, clear_user_state, get_user_stat
     selected_item_type = get_user_state(user_id, 'buy_selected_item_type')
 
 
-    logger.info(f"User {user_id} proceeding to crypto payment for item '{item_name_display}'. Amount due: {amount_to_pay_externally}, Paid from balance: {paid_from_balance}")
+    logger.info(f"User {user_id} proceeding to crypto payment for item '{item_name_display}'. Amount due: {money.format_eur(amount_to_pay_externally_cents)}, Paid from balance: {money.format_eur(paid_from_balance_cents)}")
 
     item_name_escaped = escape_md(item_name_display) # Use escape_md
     description_raw = item_description_from_state
@@ -493,8 +516,8 @@ def handle_size_selection_callback(bot_instance, clear_user_state, get_user_stat
     description_escaped = escape_md(description_raw) # Use escape_md
 
     # Format numbers for display (no escaping here, send_or_edit_message will handle it)
-    paid_from_balance_str = f"{paid_from_balance_float:.2f}"
-    amount_due_eur_str = f"{amount_due_eur_float:.2f}"
+    paid_from_balance_str = money.format_eur(paid_from_balance_cents)
+    amount_due_eur_str = money.format_eur(amount_to_pay_externally_cents)
     # expected_crypto_amount_str = f"{expected_crypto_amount_decimal_hr}" # This variable is not defined here
 
     # Escape parts that are not numbers/addresses/already escaped strings
@@ -508,13 +531,13 @@ def handle_size_selection_callback(bot_instance, clear_user_state, get_user_stat
 
     price_info_parts = [
         f"Item: *{item_name_display_escaped}*",
-        f"Original Price: *{f'{Decimal(str(item_price_from_state)):.2f}'}* EUR", # Corrected to use item_price_from_state
-        f"Service Fee: *{f'{service_fee:.2f}'}* EUR", # Corrected to use service_fee
-        f"Total Cost: *{f'{total_cost:.2f}'}* EUR", # Corrected to use total_cost
+        f"Original Price: *{money.format_eur(money.eur_to_cents(item_price_from_state))}* EUR", # Corrected to use item_price_from_state
+        f"Service Fee: *{money.format_eur(service_fee_cents)}* EUR", # Corrected to use service_fee
+        f"Total Cost: *{money.format_eur(total_cost_cents)}* EUR", # Corrected to use total_cost
     ]
 
 
-    if paid_from_balance_float > 0:
+    if paid_from_balance_cents > 0:
       price_info_parts.append(f"Paid from balance: *{paid_from_balance_str}* EUR")
     price_info_parts.append(f"Amount Due: *{amount_due_eur_str}* EUR")
 
@@ -602,9 +625,10 @@ def handle_pay_buy_crypto_callback(bot_instance, clear_user_state, get_user_stat
     # Retrieve necessary info from user_state
     selected_instance_path = get_user_state(user_id, 'buy_selected_instance_path')
     item_name_display = get_user_state(user_id, 'buy_selected_item_name_display', "Item")
-    amount_due_eur_float = get_user_state(user_id, 'buy_amount_due_eur')
-    paid_from_balance_float = get_user_state(user_id, 'buy_paid_from_balance', 0.0)
-    total_cost_eur_float = get_user_state(user_id, 'buy_total_cost_eur')
+    amount_due_cents = get_user_state(user_id, 'buy_amount_due_cents')
+    paid_from_balance_cents = get_user_state(user_id, 'buy_paid_from_balance_cents', 0)
+    total_cost_cents = get_user_state(user_id, 'buy_total_cost_cents')
+    service_fee_cents = get_user_state(user_id, 'buy_service_fee_cents', 0)
     # For "Back" button on invoice:
     selected_city = get_user_state(user_id, 'buy_selected_city')
     selected_area = get_user_state(user_id, 'buy_selected_area')
@@ -613,8 +637,8 @@ def handle_pay_buy_crypto_callback(bot_instance, clear_user_state, get_user_stat
     item_price_from_state = get_user_state(user_id, 'buy_selected_item_price') # Added to retrieve item price for display
 
 
-    if not all([selected_instance_path, item_name_display is not None, amount_due_eur_float is not None,
-                total_cost_eur_float is not None, selected_city, selected_area, selected_item_type, selected_size, item_price_from_state is not None]):
+    if not all([selected_instance_path, item_name_display is not None, amount_due_cents is not None,
+                total_cost_cents is not None, selected_city, selected_area, selected_item_type, selected_size, item_price_from_state is not None]):
         logger.warning(f"Missing session data for pay_buy_crypto for user {user_id}.")
         error_text = "Your session seems to have expired or critical information is missing. Please restart the purchase."
         markup_error = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="back_to_main"))
@@ -637,15 +661,14 @@ def handle_pay_buy_crypto_callback(bot_instance, clear_user_state, get_user_stat
         'instance_path_original': selected_instance_path
     })
     transaction_notes = (f"User buying '{item_name_display}'. "
-                         f"Total: {total_cost_eur_float:.2f} EUR. Paid from balance: {paid_from_balance_float:.2f} EUR. "
-                         f"Due via {crypto_currency}: {amount_due_eur_float:.2f} EUR.")
+                         f"Total: {money.format_eur(total_cost_cents)} EUR. Paid from balance: {money.format_eur(paid_from_balance_cents)} EUR. "
+                         f"Due via {crypto_currency}: {money.format_eur(amount_due_cents)} EUR.")
 
     main_transaction_id = record_transaction(
         user_id=user_id, # Removed product_id=None
         item_details_json=transaction_item_details_json,
-        type='purchase_crypto', eur_amount=total_cost_eur_float, # This is the total value of the transaction
-        payment_status='pending_address_generation', notes=transaction_notes,
-        charge_id=None
+        type='purchase_crypto', eur_amount_cents=total_cost_cents, # This is the total value of the transaction
+        payment_status='pending_address_generation', notes=transaction_notes
     )
     if not main_transaction_id:
         logger.error(f"Failed to create transaction record for user {user_id}, item '{item_name_display}'.")
@@ -692,13 +715,9 @@ def handle_pay_buy_crypto_callback(bot_instance, clear_user_state, get_user_stat
         update_transaction_status(main_transaction_id, 'error_exchange_rate')
         return
 
-    precision_map = {"BTC": 8, "LTC": 8, "USDT": 6} # TODO: Move to config or coin_utils
-    num_decimals = precision_map.get(display_coin_symbol, 8)
-    amount_due_eur_decimal = Decimal(str(amount_due_eur_float))
-    expected_crypto_amount_decimal_hr = (amount_due_eur_decimal / rate).quantize(Decimal('1e-' + str(num_decimals)), rounding=ROUND_UP)
+    expected_crypto_units = money.eur_cents_to_crypto_units(amount_due_cents, rate, display_coin_symbol)
+    expected_crypto_amount_decimal_hr = money.units_to_crypto(expected_crypto_units, display_coin_symbol)
     logger.info(f"User {user_id} - Calculated expected_crypto_amount_decimal_hr: {expected_crypto_amount_decimal_hr} for {display_coin_symbol}")
-    smallest_unit_multiplier = Decimal('1e-' + str(num_decimals))
-    expected_crypto_amount_smallest_unit_str = str(int(expected_crypto_amount_decimal_hr * smallest_unit_multiplier))
 
     payment_window_minutes = getattr(config, 'PAYMENT_WINDOW_MINUTES', 60)
     expires_at_dt = datetime.datetime.utcnow() + datetime.timedelta(minutes=payment_window_minutes)
@@ -721,9 +740,9 @@ def handle_pay_buy_crypto_callback(bot_instance, clear_user_state, get_user_stat
        address=unique_address,
        coin_symbol=db_coin_symbol_for_pending,
        network=network_for_db,
-       expected_crypto_amount=expected_crypto_amount_smallest_unit_str,
+       expected_crypto_units=expected_crypto_units,
        expires_at=expires_at_dt,
-       paid_from_balance_eur=paid_from_balance_float
+       paid_from_balance_cents=paid_from_balance_cents
     )
     if not pending_payment_id:
        logger.error(f"HD Wallet: Failed to create pending_crypto_payment for main_tx {main_transaction_id} (user {user_id}, buy flow).")
@@ -744,8 +763,8 @@ def handle_pay_buy_crypto_callback(bot_instance, clear_user_state, get_user_stat
         logger.error(f"HD Wallet (buy): QR code generation failed for {unique_address} (user {user_id}, tx {main_transaction_id}): {e_qr_gen}")
 
     # Format numbers for display (no escaping here, send_or_edit_message will handle it)
-    paid_from_balance_str = f"{paid_from_balance_float:.2f}"
-    amount_due_eur_str = f"{amount_due_eur_float:.2f}"
+    paid_from_balance_str = money.format_eur(paid_from_balance_cents)
+    amount_due_eur_str = money.format_eur(amount_due_cents)
     expected_crypto_amount_str = f"{expected_crypto_amount_decimal_hr}" # Keep as Decimal string for display
 
     # Escape parts that are not numbers/addresses/already escaped strings
@@ -763,13 +782,13 @@ def handle_pay_buy_crypto_callback(bot_instance, clear_user_state, get_user_stat
 
     price_info_parts = [
         f"Item: *{item_name_display_escaped}*",
-        f"Original Price: *{f'{Decimal(str(item_price_from_state)):.2f}'}* EUR", # Corrected to use item_price_from_state
-        f"Service Fee: *{f'{service_fee:.2f}'}* EUR", # Corrected to use service_fee
-        f"Total Cost: *{f'{total_cost:.2f}'}* EUR", # Corrected to use total_cost
+        f"Original Price: *{money.format_eur(money.eur_to_cents(item_price_from_state))}* EUR", # Corrected to use item_price_from_state
+        f"Service Fee: *{money.format_eur(service_fee_cents)}* EUR", # Corrected to use service_fee
+        f"Total Cost: *{money.format_eur(total_cost_cents)}* EUR", # Corrected to use total_cost
     ]
 
 
-    if paid_from_balance_float > 0:
+    if paid_from_balance_cents > 0:
       price_info_parts.append(f"Paid from balance: *{paid_from_balance_str}* EUR")
     price_info_parts.append(f"Amount Due: *{amount_due_eur_str}* EUR")
 
@@ -909,9 +928,10 @@ def handle_buy_check_payment_callback(bot_instance, clear_user_state, get_user_s
         if newly_confirmed and status_info == 'confirmed_unprocessed':
             logger.info(f"On-demand check for buy tx {transaction_id} (user {user_id}) resulted in new confirmation. Processing...")
             bot_instance.send_message(chat_id, "✅ Payment detected! Processing your purchase...")
-            payment_monitor.process_confirmed_payments(bot_instance) # This will call finalize
+            job_queue.run_soon('process_confirmed_payments') # A job worker finalizes it right away
         else:
             logger.info(f"On-demand check for buy tx {transaction_id} (user {user_id}): newly_confirmed={newly_confirmed}, status_info='{status_info}'")
+            payment_monitor.schedule_payment_recheck(transaction_id, status_info)
             pending_payment_latest = get_pending_payment_by_transaction_id(transaction_id) # Refresh data
 
             # current_invoice_text = call.message.caption if call.message.photo else call.message.text
@@ -947,8 +967,10 @@ def handle_buy_check_payment_callback(bot_instance, clear_user_state, get_user_s
                 expiry_message_segment = "The original payment window has passed."
                 if expires_at_val:
                     try:
-                        # Assuming expires_at_val is a datetime string or datetime object
-                        if isinstance(expires_at_val, str):
+                        # Stored as epoch seconds; older callers may still hand over a datetime string or object
+                        if isinstance(expires_at_val, int):
+                            expires_at_dt_obj = from_epoch(expires_at_val)
+                        elif isinstance(expires_at_val, str):
                             # Attempt to parse if it's a string, common formats
                             try:
                                 expires_at_dt_obj = datetime.datetime.fromisoformat(expires_at_val.replace('Z', '+00:00'))
@@ -998,7 +1020,9 @@ def handle_buy_check_payment_callback(bot_instance, clear_user_state, get_user_s
                     expires_at_val_countdown = pending_payment_latest['expires_at']
                     expires_at_dt_obj_countdown = None
                     # Robust parsing of expires_at_val_countdown
-                    if isinstance(expires_at_val_countdown, str):
+                    if isinstance(expires_at_val_countdown, int): # Epoch seconds, as stored
+                        expires_at_dt_obj_countdown = from_epoch(expires_at_val_countdown)
+                    elif isinstance(expires_at_val_countdown, str):
                         try:
                             if expires_at_val_countdown.endswith('Z'):
                                 expires_at_dt_obj_countdown = datetime.datetime.fromisoformat(expires_at_val_countdown.replace('Z', '+00:00'))
@@ -1147,15 +1171,15 @@ def handle_cancel_buy_payment_callback(bot_instance, clear_user_state, get_user_
 # and product_fs_utils for moving the item.
 def finalize_successful_crypto_purchase(bot_instance, main_transaction_id: int, user_id: int,
                                         # product_id: int, # No longer using product_id directly from DB
-                                        paid_from_balance_eur_str: str,
-                                        received_crypto_amount_str: str,
+                                        paid_from_balance_cents: int,
+                                        received_crypto_units: int,
                                         coin_symbol: str,
                                         blockchain_tx_id: str
                                         ) -> bool:
     logger.info(f"Finalizing successful crypto purchase for user {user_id}, main_tx_id {main_transaction_id}.")
     chat_id = user_id # Assuming direct message to user
 
-    transaction_details = get_transaction_by_id(main_transaction_id)
+    transaction_details = get_transaction_by_id(main_transaction_id, fresh=True) # Never finalize from a cached row
     if not transaction_details:
         logger.error(f"finalize_successful_crypto_purchase: CRITICAL - Main transaction {main_transaction_id} not found.")
         # Cannot notify user as we don't have chat_id if user_id is not chat_id
@@ -1184,29 +1208,13 @@ def finalize_successful_crypto_purchase(bot_instance, main_transaction_id: int,
         update_transaction_status(main_transaction_id, 'completed_fulfillment_error')
         return False
 
-    try:
-        paid_from_balance_eur = Decimal(paid_from_balance_eur_str)
-    except Exception as e_conv:
-        logger.error(f"finalize_successful_crypto_purchase: Invalid paid_from_balance_eur_str '{paid_from_balance_eur_str}' for tx {main_transaction_id}. Error: {e_conv}")
-        update_transaction_status(main_transaction_id, 'error_finalizing_data') # This status might need to be specific
-        bot_instance.send_message(chat_id, f"Payment confirmed for {escape_md(item_display_name)}, TXID {main_transaction_id}. There was an issue with payment data. Please contact support.") # Use escape_md
-        return False
-
     try:
         # 1. Adjust user balance if part of the payment was from balance
-        if paid_from_balance_eur > Decimal('0.0'):
-            user_current_data = get_or_create_user(user_id)
-            if not user_current_data: # Should not happen if user exists for transaction
-                logger.error(f"finalize_successful_crypto_purchase: Failed to get/create user {user_id} for tx {main_transaction_id} while adjusting balance.")
-                update_transaction_status(main_transaction_id, 'error_finalizing_user_data')
-                bot_instance.send_message(chat_id, f"Payment confirmed for {escape_md(item_display_name)}, TXID {main_transaction_id}. User data error during finalization. Please contact support.") # Use escape_md
-                return False
-
-            current_balance_decimal = Decimal(str(user_current_data['balance']))
-            new_user_balance_decimal = current_balance_decimal - paid_from_balance_eur
-
-            if not update_user_balance(user_id, float(new_user_balance_decimal), increment_transactions=False): # Transaction already recorded, just adjust balance
-                logger.error(f"finalize_successful_crypto_purchase: Failed to update balance for user {user_id} (tx {main_transaction_id}) after partial balance payment.")
+        if paid_from_balance_cents > 0:
+            # Transaction already recorded, just adjust balance. The crypto part is confirmed and cannot be retried, so
+            # the order is delivered even if the balance was spent meanwhile; the shortfall is recorded in the ledger.
+            if debit_balance_allowing_shortfall(user_id, paid_from_balance_cents, 'purchase_crypto', transaction_id=main_transaction_id) is None:
+                logger.error(f"finalize_successful_crypto_purchase: Failed to debit {money.format_eur(paid_from_balance_cents)} EUR from user {user_id} (tx {main_transaction_id}) for partial balance payment.")
                 update_transaction_status(main_transaction_id, 'error_finalizing_balance_update')
                 bot_instance.send_message(chat_id, f"Payment confirmed for {escape_md(item_display_name)}, TXID {main_transaction_id}. Balance update error. Please contact support.") # Use escape_md
                 return False
@@ -1217,7 +1225,7 @@ def finalize_successful_crypto_purchase(bot_instance, main_transaction_id: int,
             # Continue, as payment is confirmed. Fulfillment is next.
 
         # 3. Increment user's overall transaction count for this purchase (if not already done by balance update)
-        # The `update_user_balance` in the balance purchase path does `increment_transactions=True`.
+        # The balance debit in the balance purchase path does `increment_transactions=True`.
         # For crypto, this is the place to do it.
         if not increment_user_transaction_count(user_id):
             logger.warning(f"finalize_successful_crypto_purchase: Failed to increment transaction count for user {user_id} (tx {main_transaction_id}).")
@@ -1,8 +1,53 @@
 import datetime
+import json
+import logging
+from modules import db_utils
+from modules import money
 from modules import text_utils
 
+logger = logging.getLogger(__name__)
+
 TX_HISTORY_PAGE_SIZE = 5
 
+
+# --- Transaction history keyset cursors ---
+# History pages are addressed by an anchor transaction instead of an OFFSET, so callback data
+# carries a page number (for display) plus 'o<tx_id>' (older than) or 'n<tx_id>' (newer than).
+# Telegram limits callback data to 64 bytes, which a transaction id comfortably fits in.
+
+def parse_tx_history_cursor(cursor: str | None) -> tuple[int | None, int | None]:
+    """Returns (older_than_tx_id, newer_than_tx_id) for a cursor token; (None, None) means the newest page."""
+    if not cursor or len(cursor) < 2 or not cursor[1:].isdigit():
+        return None, None
+    if cursor[0] == 'o':
+        return int(cursor[1:]), None
+    if cursor[0] == 'n':
+        return None, int(cursor[1:])
+    return None, None
+
+
+def get_tx_history_page(user_id: int, cursor: str | None) -> tuple[list, str | None, str | None]:
+    """
+    Fetches one history page for the cursor token.
+    Returns (transactions, newer_cursor, older_cursor); a cursor is None when there is no page that way.
+    """
+    older_than, newer_than = parse_tx_history_cursor(cursor)
+    transactions = db_utils.get_user_transaction_history(user_id, limit=TX_HISTORY_PAGE_SIZE + 1,
+                                                         older_than_tx_id=older_than, newer_than_tx_id=newer_than)
+    has_more = len(transactions) > TX_HISTORY_PAGE_SIZE
+    if newer_than is not None:
+        # Rows come back newest first, so the look-ahead row is the first one.
+        transactions = transactions[-TX_HISTORY_PAGE_SIZE:]
+        has_newer, has_older = has_more, True
+    else:
+        transactions = transactions[:TX_HISTORY_PAGE_SIZE]
+        has_newer, has_older = older_than is not None, has_more
+    if not transactions:
+        return [], None, None
+    newer_cursor = f"n{transactions[0]['transaction_id']}" if has_newer else None
+    older_cursor = f"o{transactions[-1]['transaction_id']}" if has_older else None
+    return transactions, newer_cursor, older_cursor
+
 def format_transaction_history_display(transactions: list) -> str:
     """Formats a list of transaction rows for display."""
     if not transactions:
@@ -28,20 +73,19 @@ def format_transaction_history_display(transactions: list) -> str:
         tx_type_display_escaped = text_utils.escape_md(tx_type_display)
         details = f"{date_str} \\- *{tx_type_display_escaped}*"
 
-        amount_to_display = tx['eur_amount']
+        amount_cents = tx['eur_amount_cents']
         sign = ""
 
         if tx['type'] == 'balance_top_up':
             if tx['payment_status'] == 'completed':
                 sign = "\\+"
-                amount_to_display = tx['original_add_balance_amount'] if tx['original_add_balance_amount'] is not None else tx['eur_amount']
+                amount_cents = tx['original_add_balance_cents'] if tx['original_add_balance_cents'] is not None else tx['eur_amount_cents']
             else:
                 sign = ""
         elif 'purchase' in tx['type']:
             sign = "\\-"
 
-        amount_to_display_abs = abs(amount_to_display if amount_to_display is not None else 0.0)
-        details += f": {sign}{amount_to_display_abs:.2f} EUR"
+        details += f": {sign}{text_utils.escape_md(money.format_eur(abs(amount_cents or 0)))} EUR"
 
         # Check for item_details_json for purchase types
         if 'purchase' in tx['type'] and tx['item_details_json']:
@@ -0,0 +1,102 @@
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from modules import db_utils
+
+logger = logging.getLogger(__name__)
+
+# --- Awaitable db_utils ---
+# For an asyncio runtime: every db_utils helper is available here as a coroutine with the same name
+# and arguments, e.g. `balance_at = await async_db.get_balance_at(user_id, as_of)`.
+# Writes are queued to one dedicated writer thread, so they never contend for SQLite's single write
+# lock among themselves. Reads run on a small thread pool and proceed concurrently under WAL. Each of
+# these threads borrows its own pooled connection from db_utils. The synchronous db_utils API is
+# untouched and keeps serving the telebot handlers.
+
+ASYNC_DB_READER_THREADS = getattr(config, 'ASYNC_DB_READER_THREADS', 4)
+
+# Helpers that only read. Everything else is treated as a write and goes through the writer queue.
+READ_HELPERS = frozenset({
+    'get_pending_payments_to_monitor', 'get_confirmed_unprocessed_payments', 'get_pending_payment_by_transaction_id',
+    'get_pending_payment_by_address', 'get_stale_monitoring_payments', 'get_balance_at', 'reconcile_user_balance',
+    'find_balance_discrepancies', 'get_transaction_by_id', 'get_open_ticket_for_user', 'get_ticket_messages',
+    'get_all_open_tickets_admin', 'get_ticket_details_by_id', 'search_admin', 'get_user_transaction_history',
+    'get_user_count', 'get_all_users_admin', 'get_rollup_summary',
+    'get_payment_finalization',
+})
+
+# Pool/lifecycle functions that make no sense as per-call coroutines.
+_NOT_EXPORTED = frozenset({'configure_db_pool', 'db_connection', 'close_db_connections', 'get_db_connection',
+                           'get_archive_path', 'print_users_table_schema', 'to_epoch', 'from_epoch'})
+
+_writer = None
+_readers = None
+_executor_thread_idents = set() # Only these threads' pooled connections are closed by shutdown()
+
+
+def _register_executor_thread():
+    _executor_thread_idents.add(threading.get_ident())
+
+
+def _executors() -> tuple[ThreadPoolExecutor, ThreadPoolExecutor]:
+    global _writer, _readers
+    if _writer is None:
+        _writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer', initializer=_register_executor_thread)
+        _readers = ThreadPoolExecutor(max_workers=max(1, ASYNC_DB_READER_THREADS), thread_name_prefix='db-reader',
+                                      initializer=_register_executor_thread)
+        logger.info(f"Async DB started: 1 writer thread, {ASYNC_DB_READER_THREADS} reader thread(s).")
+    return _writer, _readers
+
+
+async def run_write(fn, *args, **kwargs):
+    """Runs a synchronous db function on the writer thread. Writes run one at a time, in submission order."""
+    writer, _ = _executors()
+    return await asyncio.get_running_loop().run_in_executor(writer, functools.partial(fn, *args, **kwargs))
+
+
+async def run_read(fn, *args, **kwargs):
+    """Runs a synchronous, read-only db function on the reader pool."""
+    _, readers = _executors()
+    return await asyncio.get_running_loop().run_in_executor(readers, functools.partial(fn, *args, **kwargs))
+
+
+def _make_async(name: str):
+    helper = getattr(db_utils, name)
+    runner = run_read if name in READ_HELPERS else run_write
+
+    @functools.wraps(helper)
+    async def wrapper(*args, **kwargs):
+        return await runner(helper, *args, **kwargs)
+    return wrapper
+
+
+def __getattr__(name: str):
+    # Wrappers are built on first access and cached as module attributes.
+    helper = getattr(db_utils, name, None)
+    if name.startswith('_') or name in _NOT_EXPORTED or getattr(helper, '__module__', None) != db_utils.__name__:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    wrapper = _make_async(name)
+    globals()[name] = wrapper
+    return wrapper
+
+
+def shutdown(wait: bool = True):
+    """
+    Stops the writer and reader threads after their queued work and closes their pooled connections.
+    Connections of other threads (the synchronous telebot handlers) stay open. With wait=False the
+    threads may still be running, so their connections are left for process exit.
+    """
+    global _writer, _readers
+    if _writer is None:
+        return
+    _writer.shutdown(wait=wait)
+    _readers.shutdown(wait=wait)
+    _writer = _readers = None
+    if wait:
+        db_utils.close_db_connections(set(_executor_thread_idents))
+        _executor_thread_idents.clear()
+    logger.info("Async DB stopped.")
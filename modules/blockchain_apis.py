@@ -1,10 +1,13 @@
 import logging
 import requests
+import threading
 import time
 import config
-from decimal import Decimal, InvalidOperation
 import json # For JSONDecodeError
 
+from modules import http_sessions
+from modules import rate_limiter
+
 logger = logging.getLogger(__name__)
 
 # --- Custom Exceptions ---
@@ -44,19 +47,32 @@ TRONGRID_API_BASE_URL = "https://api.trongrid.io"
 REQUESTS_HEADERS = {
     'User-Agent': 'TelegramCryptoBot/1.0'
 }
-DEFAULT_TIMEOUT = 15 # seconds
-
-def _make_request(url: str, method: str = "GET", params: dict = None, headers: dict = None, data: dict = None) -> requests.Response:
-    """Makes an HTTP request and handles common errors, raising custom exceptions."""
+# Rate limiter bucket and shared HTTP session per API host (see modules/rate_limiter.py, modules/http_sessions.py).
+PROVIDER_BLOCKSTREAM = 'blockstream'
+PROVIDER_BLOCKCYPHER = 'blockcypher'
+PROVIDER_TRONGRID = 'trongrid'
+
+def _make_request(url: str, method: str = "GET", params: dict = None, headers: dict = None, data: dict = None,
+                  provider: str | None = None, rate_tokens: int = 1) -> requests.Response:
+    """
+    Makes an HTTP request and handles common errors, raising custom exceptions.
+    With a provider, the call first takes rate_tokens tokens from that provider's rate limiter bucket.
+    Calls go through the provider's shared keep-alive session.
+    """
     effective_headers = REQUESTS_HEADERS.copy()
     if headers:
         effective_headers.update(headers)
 
+    if provider and not rate_limiter.acquire(provider, tokens=rate_tokens):
+        raise BlockchainAPIRateLimitError(f"Local rate limit for '{provider}' exhausted, request not sent: {url}")
+
+    session = http_sessions.get_session(provider or 'default')
+    timeout = http_sessions.get_timeout(provider)
     try:
         if method.upper() == "GET":
-            response = requests.get(url, params=params, headers=effective_headers, timeout=DEFAULT_TIMEOUT)
+            response = session.get(url, params=params, headers=effective_headers, timeout=timeout)
         elif method.upper() == "POST":
-            response = requests.post(url, params=params, headers=effective_headers, json=data, timeout=DEFAULT_TIMEOUT)
+            response = session.post(url, params=params, headers=effective_headers, json=data, timeout=timeout)
         else:
             raise ValueError(f"Unsupported HTTP method: {method}")
 
@@ -71,6 +87,8 @@ def _make_request(url: str, method: str = "GET", params: dict = None, headers: d
     except requests.exceptions.HTTPError as e:
         status_code = e.response.status_code
         logger.error(f"API HTTPError for URL: {url}. Status: {status_code}. Response: {e.response.text[:200]}")
+        if provider and (status_code == 429 or (status_code == 503 and e.response.headers.get('Retry-After'))):
+            rate_limiter.note_rate_limited(provider, e.response.headers.get('Retry-After'))
         if status_code == 429:
             raise BlockchainAPIRateLimitError(f"Rate limit hit for: {url}", status_code=status_code, underlying_exception=e)
         elif status_code in [400, 404]: # Often indicates bad address format or not found
@@ -85,32 +103,94 @@ def _make_request(url: str, method: str = "GET", params: dict = None, headers: d
         raise BlockchainAPIError(f"Generic API request error for: {url}", underlying_exception=e)
 
 
+# --- Chain Tip Cache ---
+# Confirmations are computed locally as tip - block_height + 1. The tip height per coin is cached for
+# CHAIN_TIP_TTL_SECONDS and shared by all threads, so a monitor cycle fetches it about once instead of once
+# per address. Only one thread refreshes an expired tip; the others wait for its result. Seeing a block
+# above the cached tip (note_new_block) moves the tip forward without a request. If a refresh fails, the
+# last known tip is used for up to CHAIN_TIP_MAX_STALE_SECONDS.
+CHAIN_TIP_TTL_SECONDS = getattr(config, 'CHAIN_TIP_TTL_SECONDS', 30)
+CHAIN_TIP_MAX_STALE_SECONDS = getattr(config, 'CHAIN_TIP_MAX_STALE_SECONDS', 600)
+
+_chain_tips = {} # coin_symbol -> {'height': int, 'fetched_at': monotonic seconds}
+_chain_tip_lock = threading.Lock() # Guards _chain_tips
+_chain_tip_refresh_locks = {'BTC': threading.Lock(), 'LTC': threading.Lock()} # One refresh per coin at a time
+
+
+def _fetch_chain_tip_height(coin_symbol: str) -> int:
+    if coin_symbol == "BTC":
+        return int(_make_request(f"{BLOCKSTREAM_API_BASE_URL_BTC}/blocks/tip/height", provider=PROVIDER_BLOCKSTREAM).text)
+    params = {'token': config.BLOCKCYPHER_API_TOKEN} if config.BLOCKCYPHER_API_TOKEN else {}
+    return int(_make_request(BLOCKCYPHER_API_BASE_URL_LTC, params=params, provider=PROVIDER_BLOCKCYPHER).json()['height'])
+
+
+def _cached_chain_tip(coin_symbol: str, max_age: float) -> int | None:
+    with _chain_tip_lock:
+        tip = _chain_tips.get(coin_symbol)
+        if tip and time.monotonic() - tip['fetched_at'] < max_age:
+            return tip['height']
+    return None
+
+
+def get_chain_tip_height(coin_symbol: str) -> int | None:
+    """Cached chain tip height for the coin, refreshed after CHAIN_TIP_TTL_SECONDS. None if it cannot be determined."""
+    height = _cached_chain_tip(coin_symbol, CHAIN_TIP_TTL_SECONDS)
+    refresh_lock = _chain_tip_refresh_locks.get(coin_symbol)
+    if height is not None or refresh_lock is None:
+        return height
+    with refresh_lock:
+        height = _cached_chain_tip(coin_symbol, CHAIN_TIP_TTL_SECONDS) # Another thread may have just refreshed it
+        if height is not None:
+            return height
+        try:
+            height = _fetch_chain_tip_height(coin_symbol)
+        except Exception as e:
+            height = _cached_chain_tip(coin_symbol, CHAIN_TIP_MAX_STALE_SECONDS)
+            logger.warning(f"Could not refresh {coin_symbol} chain tip ({e}); using cached height {height}.")
+            return height
+        with _chain_tip_lock:
+            tip = _chain_tips.get(coin_symbol)
+            if tip and tip['height'] > height:
+                height = tip['height'] # Never go backwards because of a lagging API node
+            _chain_tips[coin_symbol] = {'height': height, 'fetched_at': time.monotonic()}
+        logger.debug(f"{coin_symbol} chain tip refreshed: {height}.")
+        return height
+
+
+def note_new_block(coin_symbol: str, height: int) -> int | None:
+    """New-block signal: moves a known tip up to `height` if that is higher. Returns the resulting tip (None if unknown)."""
+    with _chain_tip_lock:
+        tip = _chain_tips.get(coin_symbol)
+        if tip is None:
+            return None
+        if height > tip['height']:
+            tip.update(height=height, fetched_at=time.monotonic())
+            logger.debug(f"{coin_symbol} chain tip advanced to {height}.")
+        return tip['height']
+
+
 def get_address_transactions_btc(address: str) -> list[dict]:
     url = f"{BLOCKSTREAM_API_BASE_URL_BTC}/address/{address}/txs"
     logger.debug(f"Fetching BTC transactions for address {address} from URL: {url}")
     try:
-        response = _make_request(url)
+        response = _make_request(url, provider=PROVIDER_BLOCKSTREAM)
         raw_txs = response.json()
         processed_txs = []
 
-        # To get actual confirmations, we need the current block height.
-        # Fetching it for every call to this function might be too much.
-        # For now, if Blockstream says 'confirmed', we'll use a high number.
-        # The payment_monitor will ultimately decide based on its configured min_confirmations.
-        current_btc_height = None
-        try:
-            tip_height_url = f"{BLOCKSTREAM_API_BASE_URL_BTC}/blocks/tip/height"
-            tip_response = _make_request(tip_height_url) # Shorter timeout for this one maybe
-            current_btc_height = int(tip_response.text)
-        except Exception as e_tip:
-            logger.warning(f"Could not fetch BTC current block height: {e_tip}. Confirmations might be less accurate.")
-
+        current_btc_height = get_chain_tip_height("BTC")
+        if current_btc_height is None:
+            logger.warning("BTC chain tip unknown. Confirmations might be less accurate.")
+        else:
+            # A confirmed tx above the cached tip means a new block arrived since the last refresh.
+            newest_block = max((tx.get('status', {}).get('block_height') or 0 for tx in raw_txs), default=0)
+            if newest_block > current_btc_height:
+                current_btc_height = note_new_block("BTC", newest_block) or current_btc_height
 
         for tx in raw_txs:
-            total_value_to_address = Decimal('0')
+            total_value_to_address = 0 # smallest units
             for vout in tx.get('vout', []):
                 if vout.get('scriptpubkey_address') == address:
-                    total_value_to_address += Decimal(vout['value'])
+                    total_value_to_address += int(vout['value'])
 
             if total_value_to_address > 0:
                 tx_status = tx.get('status', {})
@@ -125,7 +205,7 @@ def get_address_transactions_btc(address: str) -> list[dict]:
 
                 processed_txs.append({
                     'txid': tx['txid'],
-                    'amount_satoshi': str(total_value_to_address),
+                    'amount_satoshi': total_value_to_address,
                     'confirmations': confirmations,
                     'block_height': tx_block_height,
                     'block_time': tx_status.get('block_time'),
@@ -142,33 +222,39 @@ def get_address_transactions_btc(address: str) -> list[dict]:
         raise BlockchainAPIError(f"Unexpected error during BTC API call for {address}", underlying_exception=e)
 
 
+def _ltc_request_params() -> dict:
+    return {'token': config.BLOCKCYPHER_API_TOKEN} if config.BLOCKCYPHER_API_TOKEN else {}
+
+
+def _parse_ltc_address_txs(address: str, data: dict) -> list[dict]:
+    """Incoming transactions of `address` from a BlockCypher /addrs/{address}/full object."""
+    processed_txs = []
+    for tx in data.get('txs', []):
+        total_value_to_address = 0 # smallest units
+        for vout in tx.get('outputs', []):
+            if address in vout.get('addresses', []):
+                total_value_to_address += int(vout['value'])
+
+        if total_value_to_address > 0:
+            confirmations = tx.get('confirmations', 0) # Blockcypher provides this directly
+            processed_txs.append({
+                'txid': tx['hash'],
+                'amount_litoshi': total_value_to_address,
+                'confirmations': confirmations,
+                'block_height': tx.get('block_height'),
+                'received_time': tx.get('received'),
+            })
+    return processed_txs
+
+
 def get_address_transactions_ltc(address: str) -> list[dict]:
     url = f"{BLOCKCYPHER_API_BASE_URL_LTC}/addrs/{address}/full?limit=50"
-    params = {}
-    if config.BLOCKCYPHER_API_TOKEN:
-        params['token'] = config.BLOCKCYPHER_API_TOKEN
+    params = _ltc_request_params()
 
     logger.debug(f"Fetching LTC transactions for address {address} from BlockCypher.")
     try:
-        response = _make_request(url, params=params)
-        data = response.json()
-        processed_txs = []
-
-        for tx in data.get('txs', []):
-            total_value_to_address = Decimal('0')
-            for vout in tx.get('outputs', []):
-                if address in vout.get('addresses', []):
-                    total_value_to_address += Decimal(vout['value'])
-
-            if total_value_to_address > 0:
-                confirmations = tx.get('confirmations', 0) # Blockcypher provides this directly
-                processed_txs.append({
-                    'txid': tx['hash'],
-                    'amount_litoshi': str(total_value_to_address),
-                    'confirmations': confirmations,
-                    'block_height': tx.get('block_height'),
-                    'received_time': tx.get('received'),
-                })
+        response = _make_request(url, params=params, provider=PROVIDER_BLOCKCYPHER)
+        processed_txs = _parse_ltc_address_txs(address, response.json())
         logger.info(f"Found {len(processed_txs)} incoming LTC transactions for address {address}.")
         return processed_txs
     except json.JSONDecodeError as e:
@@ -181,6 +267,54 @@ def get_address_transactions_ltc(address: str) -> list[dict]:
         raise BlockchainAPIError(f"Unexpected error during LTC API call for {address}", underlying_exception=e)
 
 
+# BlockCypher answers /addrs/{a1};{a2};.../full with one JSON object per address, and counts each address
+# against the rate limit, so a batch takes one limiter token per address (a batch larger than the burst
+# leaves the bucket in debt). Without a token BlockCypher accepts only 3 addresses per batch.
+LTC_BATCH_SIZE = getattr(config, 'LTC_BATCH_SIZE', 20 if config.BLOCKCYPHER_API_TOKEN else 3)
+
+def get_address_transactions_ltc_batch(addresses: list[str]) -> dict[str, list[dict] | BlockchainAPIError]:
+    """
+    Incoming LTC transactions for several addresses in one BlockCypher request per LTC_BATCH_SIZE addresses.
+    Returns {address: transactions, or the BlockchainAPIError for that address}. Addresses missing from a
+    batch answer (or answered with an error) are retried one by one with get_address_transactions_ltc();
+    a batch that fails as a whole is retried one by one too, unless it was rate limited.
+    """
+    results = {}
+    unique_addresses = list(dict.fromkeys(addresses))
+    for start in range(0, len(unique_addresses), LTC_BATCH_SIZE):
+        batch = unique_addresses[start:start + LTC_BATCH_SIZE]
+        if len(batch) == 1:
+            retry = batch
+        else:
+            url = f"{BLOCKCYPHER_API_BASE_URL_LTC}/addrs/{';'.join(batch)}/full?limit=50"
+            logger.debug(f"Fetching LTC transactions for {len(batch)} addresses in one BlockCypher batch.")
+            try:
+                response = _make_request(url, params=_ltc_request_params(), provider=PROVIDER_BLOCKCYPHER,
+                                         rate_tokens=len(batch))
+                answers = response.json()
+                if isinstance(answers, dict): # A one-address answer is not wrapped in a list
+                    answers = [answers]
+                for answer in answers:
+                    address = answer.get('address') if isinstance(answer, dict) else None
+                    if address in batch and 'error' not in answer:
+                        results[address] = _parse_ltc_address_txs(address, answer)
+            except BlockchainAPIRateLimitError as e:
+                for address in batch:
+                    results[address] = e
+                continue
+            except (BlockchainAPIError, json.JSONDecodeError, AttributeError, KeyError, TypeError, ValueError) as e:
+                logger.warning(f"LTC batch request for {len(batch)} addresses failed ({e}); falling back to single requests.")
+            retry = [address for address in batch if address not in results]
+            if retry:
+                logger.info(f"LTC batch: {len(batch) - len(retry)}/{len(batch)} addresses answered; fetching {len(retry)} one by one.")
+        for address in retry:
+            try:
+                results[address] = get_address_transactions_ltc(address)
+            except BlockchainAPIError as e:
+                results[address] = e
+    return results
+
+
 def get_trc20_transfers_usdt_trx(address: str, since_timestamp_ms: int = 0) -> list[dict]:
     url = f"{TRONGRID_API_BASE_URL}/v1/accounts/{address}/transactions/trc20"
     params = {
@@ -195,7 +329,7 @@ def get_trc20_transfers_usdt_trx(address: str, since_timestamp_ms: int = 0) -> l
 
     logger.debug(f"Fetching TRC20 USDT transactions for address {address} since {since_timestamp_ms} from TronGrid.")
     try:
-        response = _make_request(url, params=params, headers=headers)
+        response = _make_request(url, params=params, headers=headers, provider=PROVIDER_TRONGRID)
         data = response.json()
         processed_txs = []
 
@@ -0,0 +1,161 @@
+import argparse
+import contextlib
+import datetime
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+
+import config
+from modules import db_utils
+
+logger = logging.getLogger(__name__)
+
+# --- Online Backups and Space Maintenance ---
+# Backups use the sqlite3 online backup API a few pages per step, sleeping between steps, so writers
+# are only ever blocked for one small step. Each copy is integrity-checked, gzipped and rotated.
+# Maintenance checkpoints the WAL and returns free pages to the OS, but only when it can do so
+# without waiting: its connection has no busy timeout, so a busy database just means "try next run".
+#
+#     python -m modules.db_backup --backup         # one backup now
+#     python -m modules.db_backup --maintenance    # one checkpoint / incremental vacuum pass now
+#     python -m modules.db_backup --enable-incremental-vacuum   # one-time VACUUM; run with the bot stopped
+
+BACKUP_DIR = getattr(config, 'BACKUP_DIR', None) # Default: backups/ next to DATABASE_NAME
+BACKUP_KEEP = getattr(config, 'BACKUP_KEEP', 7)
+BACKUP_PAGES_PER_STEP = getattr(config, 'BACKUP_PAGES_PER_STEP', 256)
+BACKUP_STEP_SLEEP_SECONDS = getattr(config, 'BACKUP_STEP_SLEEP_SECONDS', 0.05)
+INCREMENTAL_VACUUM_MIN_FREE_PAGES = getattr(config, 'INCREMENTAL_VACUUM_MIN_FREE_PAGES', 1024)
+INCREMENTAL_VACUUM_PAGES_PER_RUN = getattr(config, 'INCREMENTAL_VACUUM_PAGES_PER_RUN', 2048)
+
+AUTO_VACUUM_INCREMENTAL = 2
+_SCHEMAS = ('main', 'archive')
+
+
+def _backup_dir() -> str:
+    return BACKUP_DIR or os.path.join(os.path.dirname(db_utils.DATABASE_NAME), 'backups')
+
+
+def _snapshot_prefix(schema: str) -> str:
+    path = db_utils.DATABASE_NAME if schema == 'main' else db_utils.get_archive_path()
+    return os.path.splitext(os.path.basename(path))[0] + '-'
+
+
+def _rotate(backup_dir: str, prefix: str, keep: int):
+    snapshots = sorted(f for f in os.listdir(backup_dir) if f.startswith(prefix) and f.endswith('.db.gz'))
+    for name in snapshots[:-keep] if keep > 0 else []:
+        os.remove(os.path.join(backup_dir, name))
+        logger.info(f"Backup rotation: removed {name}.")
+
+
+def _backup_schema(src: sqlite3.Connection, schema: str, backup_dir: str, timestamp: str) -> str | None:
+    prefix = _snapshot_prefix(schema)
+    tmp_path = os.path.join(backup_dir, f".{prefix}{timestamp}.db.tmp")
+    final_path = os.path.join(backup_dir, f"{prefix}{timestamp}.db.gz")
+    try:
+        with contextlib.closing(sqlite3.connect(tmp_path)) as dst:
+            src.backup(dst, pages=BACKUP_PAGES_PER_STEP, name=schema, sleep=BACKUP_STEP_SLEEP_SECONDS)
+            check = dst.execute("PRAGMA quick_check").fetchone()[0]
+        if check != 'ok':
+            logger.error(f"Backup of '{schema}' failed quick_check ({check}); snapshot discarded.")
+            return None
+        with open(tmp_path, 'rb') as raw, gzip.open(final_path, 'wb', compresslevel=6) as packed:
+            shutil.copyfileobj(raw, packed, length=1024 * 1024)
+        return final_path
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def backup_database(keep: int = BACKUP_KEEP) -> list[str]:
+    """Writes a compressed, integrity-checked snapshot of the main and archive databases. Returns the new file paths."""
+    backup_dir = _backup_dir()
+    os.makedirs(backup_dir, exist_ok=True)
+    timestamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    written = []
+    with contextlib.closing(db_utils.get_db_connection(create_views=False)) as src:
+        for schema in _SCHEMAS:
+            started = datetime.datetime.utcnow()
+            try:
+                path = _backup_schema(src, schema, backup_dir, timestamp)
+            except (sqlite3.Error, OSError) as e:
+                logger.exception(f"Backup of '{schema}' failed: {e}")
+                continue
+            if path:
+                written.append(path)
+                elapsed = (datetime.datetime.utcnow() - started).total_seconds()
+                logger.info(f"Backup of '{schema}' written to {path} ({os.path.getsize(path)} bytes, {elapsed:.1f}s).")
+                _rotate(backup_dir, _snapshot_prefix(schema), keep)
+    return written
+
+
+def run_maintenance() -> dict:
+    """
+    Opportunistic space maintenance for both databases: wal_checkpoint(TRUNCATE), then incremental_vacuum
+    when auto_vacuum is INCREMENTAL and enough pages are free. Never waits for a lock. Returns what was done per schema.
+    """
+    results = {}
+    with contextlib.closing(db_utils.get_db_connection(create_views=False)) as conn:
+        conn.execute("PRAGMA busy_timeout = 0")
+        for schema in _SCHEMAS:
+            result = {}
+            try:
+                busy = conn.execute(f"PRAGMA {schema}.wal_checkpoint(TRUNCATE)").fetchone()[0]
+                result['checkpoint'] = 'busy' if busy else 'truncated'
+
+                free_pages = conn.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+                result['free_pages'] = free_pages
+                if conn.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+                    result['vacuum'] = 'auto_vacuum is not INCREMENTAL'
+                elif free_pages >= INCREMENTAL_VACUUM_MIN_FREE_PAGES:
+                    conn.execute(f"PRAGMA {schema}.incremental_vacuum({int(INCREMENTAL_VACUUM_PAGES_PER_RUN)})").fetchall()
+                    result['vacuum'] = f"released up to {INCREMENTAL_VACUUM_PAGES_PER_RUN} pages"
+                else:
+                    result['vacuum'] = 'not needed'
+            except sqlite3.OperationalError as e: # SQLITE_BUSY / LOCKED: somebody is writing, try next run
+                result['skipped'] = str(e)
+            results[schema] = result
+            logger.info(f"Maintenance for '{schema}': {result}")
+    return results
+
+
+def enable_incremental_vacuum():
+    """Switches both databases to auto_vacuum=INCREMENTAL. Requires a full VACUUM; run offline with the bot stopped."""
+    with contextlib.closing(db_utils.get_db_connection(create_views=False)) as conn:
+        for schema in _SCHEMAS:
+            if conn.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+                logger.info(f"'{schema}' already uses incremental auto_vacuum.")
+                continue
+            conn.execute(f"PRAGMA {schema}.auto_vacuum = INCREMENTAL")
+            conn.execute(f"VACUUM {schema}")
+            logger.info(f"'{schema}' switched to incremental auto_vacuum.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Online database backups and space maintenance.")
+    parser.add_argument('--db', help="Path to the SQLite database (defaults to config.DATABASE_NAME).")
+    parser.add_argument('--backup', action='store_true', help="Write a compressed snapshot and rotate old ones.")
+    parser.add_argument('--maintenance', action='store_true', help="Checkpoint the WAL and run incremental vacuum if possible.")
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help="One-time switch to auto_vacuum=INCREMENTAL (runs VACUUM; stop the bot first).")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if args.db:
+        db_utils.DATABASE_NAME = args.db
+    if not (args.backup or args.maintenance or args.enable_incremental_vacuum):
+        parser.error("nothing to do; pass --backup, --maintenance and/or --enable-incremental-vacuum")
+
+    if args.enable_incremental_vacuum:
+        enable_incremental_vacuum()
+    if args.backup:
+        for path in backup_database():
+            print(f"Backup written: {path}")
+    if args.maintenance:
+        for schema, result in run_maintenance().items():
+            print(f"{schema}: {result}")
+
+
+if __name__ == '__main__':
+    main()
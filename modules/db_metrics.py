@@ -0,0 +1,196 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# --- Per-Query Latency Metrics (opt-in) ---
+# With DB_QUERY_METRICS_ENABLED, db_utils opens its connections with InstrumentedConnection, whose
+# cursors time every execute and fetch. Stats are kept per normalized SQL statement and per calling
+# function (the first frame outside this module and sqlite3): call count, rows, total/max time and a
+# latency histogram. Statements slower than DB_SLOW_QUERY_MS are logged as warnings.
+# View them with the admin /dbstats command or write them out with dump_metrics().
+
+DB_QUERY_METRICS_ENABLED = getattr(config, 'DB_QUERY_METRICS_ENABLED', False)
+DB_SLOW_QUERY_MS = getattr(config, 'DB_SLOW_QUERY_MS', 200)
+DB_METRICS_DUMP_PATH = getattr(config, 'DB_METRICS_DUMP_PATH', 'data/db_metrics.json')
+
+# Upper bounds (ms) of the histogram buckets; the last bucket is everything slower.
+HISTOGRAM_BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+_stats_lock = threading.Lock()
+_statement_stats = {} # normalized SQL -> _Stat
+_caller_stats = {}    # 'module.function' -> _Stat
+
+_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+
+class _Stat:
+    __slots__ = ('calls', 'rows', 'total_ms', 'max_ms', 'buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+
+    def add_call(self, elapsed_ms: float):
+        self.calls += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        for i, bound in enumerate(HISTOGRAM_BOUNDS_MS):
+            if elapsed_ms <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def percentile_ms(self, fraction: float) -> float:
+        """Upper bound of the histogram bucket holding the given fraction of calls (approximate)."""
+        target = fraction * self.calls
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target and count:
+                return HISTOGRAM_BOUNDS_MS[i] if i < len(HISTOGRAM_BOUNDS_MS) else self.max_ms
+        return self.max_ms
+
+    def as_dict(self) -> dict:
+        return {
+            'calls': self.calls, 'rows': self.rows,
+            'total_ms': round(self.total_ms, 3), 'avg_ms': round(self.total_ms / self.calls, 3) if self.calls else 0.0,
+            'max_ms': round(self.max_ms, 3), 'p50_ms': self.percentile_ms(0.5), 'p95_ms': self.percentile_ms(0.95),
+            'p99_ms': self.percentile_ms(0.99),
+            'histogram': {f"<={b}ms": n for b, n in zip(HISTOGRAM_BOUNDS_MS, self.buckets)} | {"slower": self.buckets[-1]},
+        }
+
+
+def normalize_sql(sql: str) -> str:
+    """Collapses whitespace, drops '--' comments and folds IN (?, ?, ...) lists so batch sizes share one entry."""
+    lines = [line.split('--', 1)[0] for line in sql.splitlines()]
+    return _PLACEHOLDER_LIST.sub('(?, ...)', ' '.join(' '.join(lines).split()))
+
+
+def _calling_function() -> str:
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_globals.get('__name__') in (__name__, 'sqlite3', 'contextlib'):
+        frame = frame.f_back
+    if frame is None:
+        return '<unknown>'
+    return f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}"
+
+
+def _record(sql_key: str, caller: str, elapsed_ms: float, rows: int, new_call: bool):
+    with _stats_lock:
+        for table, key in ((_statement_stats, sql_key), (_caller_stats, caller)):
+            stat = table.get(key)
+            if stat is None:
+                stat = table[key] = _Stat()
+            if new_call:
+                stat.add_call(elapsed_ms)
+            else: # Fetch time of an earlier call: counts towards the total but is not a new sample
+                stat.total_ms += elapsed_ms
+            stat.rows += rows
+
+
+def _warn_if_slow(sql_key: str, caller: str, elapsed_ms: float):
+    if elapsed_ms >= DB_SLOW_QUERY_MS:
+        logger.warning(f"Slow query ({elapsed_ms:.1f} ms) in {caller}: {sql_key[:300]}")
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that times execute/executemany and the fetch calls that follow them."""
+
+    def _timed_execute(self, method, sql, parameters):
+        caller = _calling_function()
+        started = time.perf_counter()
+        try:
+            return method(sql, parameters)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self._metric_key = normalize_sql(sql)
+            self._metric_caller = caller
+            self._metric_elapsed_ms = elapsed_ms
+            written = max(self.rowcount, 0) # DML rows; SELECT rows are counted as they are fetched
+            _record(self._metric_key, caller, elapsed_ms, written, new_call=True)
+            _warn_if_slow(self._metric_key, caller, elapsed_ms)
+
+    def execute(self, sql, parameters=(), /):
+        return self._timed_execute(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        return self._timed_execute(super().executemany, sql, seq_of_parameters)
+
+    def _timed_fetch(self, method, *args):
+        started = time.perf_counter()
+        result = method(*args)
+        key = getattr(self, '_metric_key', None)
+        if key is not None:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            rows = len(result) if isinstance(result, list) else (1 if result is not None else 0)
+            _record(key, self._metric_caller, elapsed_ms, rows, new_call=False)
+            self._metric_elapsed_ms += elapsed_ms
+            if self._metric_elapsed_ms - elapsed_ms < DB_SLOW_QUERY_MS:
+                _warn_if_slow(key, self._metric_caller, self._metric_elapsed_ms)
+        return result
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed_fetch(super().fetchmany, size if size is not None else self.arraysize)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors (including those made by conn.execute) are InstrumentedCursor."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=(), /):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def snapshot(limit: int | None = None, order_by: str = 'total_ms') -> dict:
+    """Stats per statement and per caller, each sorted by order_by (descending) and cut to limit entries."""
+    with _stats_lock:
+        statements = [{'sql': key, **stat.as_dict()} for key, stat in _statement_stats.items()]
+        callers = [{'caller': key, **stat.as_dict()} for key, stat in _caller_stats.items()]
+    statements.sort(key=lambda s: s[order_by], reverse=True)
+    callers.sort(key=lambda s: s[order_by], reverse=True)
+    return {'enabled': DB_QUERY_METRICS_ENABLED, 'slow_query_ms': DB_SLOW_QUERY_MS,
+            'statements': statements[:limit], 'callers': callers[:limit]}
+
+
+def reset():
+    with _stats_lock:
+        _statement_stats.clear()
+        _caller_stats.clear()
+
+
+def dump_metrics(path: str | None = None) -> str:
+    """Writes snapshot() as JSON to path (default DB_METRICS_DUMP_PATH). Returns the path written."""
+    path = path or DB_METRICS_DUMP_PATH
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'generated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), **snapshot()}, f, indent=2)
+    os.replace(tmp_path, path)
+    logger.info(f"Database query metrics written to {path}.")
+    return path
@@ -0,0 +1,624 @@
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import sqlite3
+
+from modules import db_utils
+
+logger = logging.getLogger(__name__)
+
+# --- Versioned Schema Migrations ---
+# Each migration runs exactly once, in order, inside its own transaction together with the
+# schema_version row that records it. On a current database startup costs one version lookup.
+# To change the schema, append a new (version, description, function) entry to MIGRATIONS;
+# never edit a migration that has already shipped.
+
+LEGACY_TRANSACTIONS_TEMP_TABLE = "transactions_old_for_fs_item_migration"
+
+
+def _migration_0001_baseline(cursor: sqlite3.Cursor):
+    """Baseline schema. Safe on fresh databases and on ones created by the old initialize_database()."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            balance REAL DEFAULT 0.0,
+            transaction_count INTEGER DEFAULT 0
+        )
+    ''')
+
+    # Products are managed on the filesystem.
+    cursor.execute("DROP TABLE IF EXISTS products")
+    cursor.execute("DROP TABLE IF EXISTS product_instances")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            item_details_json TEXT, -- Stores JSON of item details for purchase type
+            type TEXT NOT NULL, -- e.g., 'purchase_crypto', 'purchase_balance', 'balance_top_up'
+            eur_amount REAL NOT NULL,
+            crypto_amount TEXT, -- For crypto payments
+            currency TEXT, -- For crypto payments
+            payment_status TEXT DEFAULT 'pending' NOT NULL,
+            original_add_balance_amount REAL, -- For balance_top_up type
+            notes TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS hd_address_indices (
+            coin_symbol TEXT PRIMARY KEY,
+            last_used_index INTEGER DEFAULT -1 NOT NULL
+        )
+    ''')
+    for coin in ['BTC', 'LTC', 'TRX']:
+        cursor.execute("INSERT OR IGNORE INTO hd_address_indices (coin_symbol, last_used_index) VALUES (?, -1)", (coin,))
+
+    pending_payments_sql = '''
+        CREATE TABLE {name} (
+            payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            transaction_id INTEGER UNIQUE NOT NULL,
+            user_id INTEGER NOT NULL,
+            address TEXT UNIQUE NOT NULL,
+            coin_symbol TEXT NOT NULL,
+            network TEXT,
+            expected_crypto_amount TEXT NOT NULL,
+            received_crypto_amount TEXT,
+            status TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            last_checked_at DATETIME,
+            expires_at DATETIME NOT NULL,
+            blockchain_tx_id TEXT,
+            confirmations INTEGER DEFAULT 0 NOT NULL,
+            paid_from_balance_eur REAL DEFAULT 0.0 NOT NULL,
+            FOREIGN KEY (transaction_id) REFERENCES transactions (transaction_id) ON DELETE CASCADE,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    '''
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='pending_crypto_payments'")
+    if cursor.fetchone() is None:
+        cursor.execute(pending_payments_sql.format(name="pending_crypto_payments"))
+    else:
+        # The old boot-time rename of 'transactions' dragged this table's foreign key along with it.
+        cursor.execute("PRAGMA foreign_key_list(pending_crypto_payments)")
+        fk_targets = {row['table'] for row in cursor.fetchall()}
+        if LEGACY_TRANSACTIONS_TEMP_TABLE in fk_targets:
+            logger.info("Rebuilding 'pending_crypto_payments' so its foreign key references 'transactions' again.")
+            cursor.execute(pending_payments_sql.format(name="pending_crypto_payments_rebuild"))
+            cursor.execute("INSERT INTO pending_crypto_payments_rebuild SELECT * FROM pending_crypto_payments")
+            cursor.execute("DROP TABLE pending_crypto_payments")
+            cursor.execute("ALTER TABLE pending_crypto_payments_rebuild RENAME TO pending_crypto_payments")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_status ON pending_crypto_payments (status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_address ON pending_crypto_payments (address)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_transaction_id ON pending_crypto_payments (transaction_id)")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS support_tickets (
+            ticket_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            status TEXT DEFAULT 'open' NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_message_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            messages_json TEXT,
+            admin_chat_id INTEGER,
+            admin_ticket_view_message_id INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (LEGACY_TRANSACTIONS_TEMP_TABLE,))
+    if cursor.fetchone():
+        logger.warning(f"Table '{LEGACY_TRANSACTIONS_TEMP_TABLE}' left over from the old startup routine still holds "
+                       "transaction history. It is kept untouched; merge it into 'transactions' manually if needed.")
+
+
+def _migration_0002_query_indexes(cursor: sqlite3.Cursor):
+    """Composite indexes matching the WHERE/ORDER BY of the db_utils queries."""
+    # Transaction history: WHERE user_id = ? ORDER BY created_at DESC
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions (user_id, created_at)")
+
+    # Monitor and expiry queries: WHERE status = ? AND expires_at </>= now
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_status_expires ON pending_crypto_payments (status, expires_at)")
+    # Finalizer queue: WHERE status = 'confirmed_unprocessed' ORDER BY created_at
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_status_created ON pending_crypto_payments (status, created_at)")
+    # Superseded by the composites above, or duplicates of the UNIQUE constraint autoindexes.
+    cursor.execute("DROP INDEX IF EXISTS idx_pending_payments_status")
+    cursor.execute("DROP INDEX IF EXISTS idx_pending_payments_address")
+    cursor.execute("DROP INDEX IF EXISTS idx_pending_payments_transaction_id")
+
+    # Open ticket lookup: WHERE user_id = ? AND status = 'open' ORDER BY created_at DESC LIMIT 1
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_support_tickets_user_status_created ON support_tickets (user_id, status, created_at)")
+    # Admin open list and auto-expiry: WHERE status = 'open' [AND last_message_at < ?] ORDER BY last_message_at.
+    # user_id is included so the expiry candidate scan is answered from the index alone.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_support_tickets_status_last_message ON support_tickets (status, last_message_at, user_id)")
+
+
+def _migration_0003_user_count(cursor: sqlite3.Cursor):
+    """Row counter for users kept current by triggers, so the admin list total is a single lookup."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS row_counts (
+            table_name TEXT PRIMARY KEY,
+            row_count INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("INSERT OR REPLACE INTO row_counts (table_name, row_count) SELECT 'users', COUNT(*) FROM users")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE row_counts SET row_count = row_count + 1 WHERE table_name = 'users';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE row_counts SET row_count = row_count - 1 WHERE table_name = 'users';
+        END
+    ''')
+
+
+def _replace_column(cursor: sqlite3.Cursor, table: str, old_column: str, new_column_def: str, conversion_sql: str):
+    """Adds new_column_def, fills it from the old column with conversion_sql, then drops the old column."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    columns = {row['name'] for row in cursor.fetchall()}
+    new_column = new_column_def.split()[0]
+    if new_column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {new_column_def}")
+    if old_column in columns:
+        cursor.execute(f"UPDATE {table} SET {new_column} = {conversion_sql} WHERE {old_column} IS NOT NULL")
+        cursor.execute(f"ALTER TABLE {table} DROP COLUMN {old_column}")
+
+
+def _migration_0004_integer_money(cursor: sqlite3.Cursor):
+    """EUR amounts as INTEGER cents and crypto amounts as INTEGER smallest units (see modules.money)."""
+    _replace_column(cursor, "users", "balance",
+                    "balance_cents INTEGER NOT NULL DEFAULT 0", "CAST(ROUND(balance * 100) AS INTEGER)")
+    _replace_column(cursor, "transactions", "eur_amount",
+                    "eur_amount_cents INTEGER NOT NULL DEFAULT 0", "CAST(ROUND(eur_amount * 100) AS INTEGER)")
+    _replace_column(cursor, "transactions", "original_add_balance_amount",
+                    "original_add_balance_cents INTEGER", "CAST(ROUND(original_add_balance_amount * 100) AS INTEGER)")
+    _replace_column(cursor, "pending_crypto_payments", "paid_from_balance_eur",
+                    "paid_from_balance_cents INTEGER NOT NULL DEFAULT 0", "CAST(ROUND(paid_from_balance_eur * 100) AS INTEGER)")
+    # Both were already smallest-unit amounts, just stored as TEXT.
+    _replace_column(cursor, "pending_crypto_payments", "expected_crypto_amount",
+                    "expected_crypto_units INTEGER NOT NULL DEFAULT 0", "CAST(expected_crypto_amount AS INTEGER)")
+    _replace_column(cursor, "pending_crypto_payments", "received_crypto_amount",
+                    "received_crypto_units INTEGER", "CAST(received_crypto_amount AS INTEGER)")
+
+
+def _migration_0005_balance_ledger(cursor: sqlite3.Cursor):
+    """
+    Append-only ledger of balance changes plus periodic per-user snapshots. users.balance_cents stays
+    the materialized running total; db_utils writes the ledger row in the same transaction as the balance.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ledger_entries (
+            entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            delta_cents INTEGER NOT NULL,
+            balance_after_cents INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            transaction_id INTEGER,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            FOREIGN KEY (transaction_id) REFERENCES transactions (transaction_id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ledger_entries_user_entry ON ledger_entries (user_id, entry_id)")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_ledger_entries_no_update BEFORE UPDATE ON ledger_entries
+        BEGIN
+            SELECT RAISE(ABORT, 'ledger_entries is append-only');
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_ledger_entries_no_delete BEFORE DELETE ON ledger_entries
+        BEGIN
+            SELECT RAISE(ABORT, 'ledger_entries is append-only');
+        END
+    ''')
+
+    # balance_cents is the user's balance after applying every entry up to and including last_entry_id.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS balance_snapshots (
+            snapshot_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            last_entry_id INTEGER NOT NULL,
+            balance_cents INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_balance_snapshots_user_entry ON balance_snapshots (user_id, last_entry_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_balance_snapshots_user_created ON balance_snapshots (user_id, created_at)")
+
+    # Balances that predate the ledger get one opening entry so entries always sum to users.balance_cents.
+    cursor.execute('''
+        INSERT INTO ledger_entries (user_id, delta_cents, balance_after_cents, reason, created_at)
+        SELECT user_id, balance_cents, balance_cents, 'opening_balance', ?
+        FROM users
+        WHERE balance_cents != 0
+    ''', (datetime.datetime.utcnow().isoformat(),))
+
+
+def _migration_0006_ticket_messages(cursor: sqlite3.Cursor):
+    """
+    One row per ticket message instead of the support_tickets.messages_json blob, so adding a message is a
+    single INSERT. support_tickets keeps message_count and last_message_preview for the list views.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ticket_messages (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ticket_id INTEGER NOT NULL,
+            sender TEXT NOT NULL, -- 'user' or 'admin'
+            text TEXT NOT NULL,
+            user_tg_message_id INTEGER,
+            admin_tg_message_id INTEGER,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (ticket_id) REFERENCES support_tickets (ticket_id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ticket_messages_ticket_created ON ticket_messages (ticket_id, created_at)")
+
+    cursor.execute("PRAGMA table_info(support_tickets)")
+    columns = {row['name'] for row in cursor.fetchall()}
+    if 'message_count' not in columns:
+        cursor.execute("ALTER TABLE support_tickets ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+    if 'last_message_preview' not in columns:
+        cursor.execute("ALTER TABLE support_tickets ADD COLUMN last_message_preview TEXT")
+    if 'messages_json' not in columns:
+        return
+
+    cursor.execute("SELECT ticket_id, created_at, messages_json FROM support_tickets WHERE messages_json IS NOT NULL")
+    for ticket in cursor.fetchall():
+        try:
+            messages = json.loads(ticket['messages_json']) or []
+        except json.JSONDecodeError:
+            logger.warning(f"Ticket {ticket['ticket_id']} has malformed messages_json; keeping it verbatim as one message.")
+            messages = [{'sender': 'user', 'text': ticket['messages_json']}]
+        cursor.executemany('''
+            INSERT INTO ticket_messages (ticket_id, sender, text, user_tg_message_id, admin_tg_message_id, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(ticket['ticket_id'], m.get('sender', 'user'), m.get('text', ''), m.get('user_tg_message_id'),
+               m.get('admin_tg_message_id'), m.get('timestamp') or ticket['created_at'])
+              for m in messages if isinstance(m, dict)])
+    cursor.execute('''
+        UPDATE support_tickets
+        SET message_count = (SELECT COUNT(*) FROM ticket_messages tm WHERE tm.ticket_id = support_tickets.ticket_id),
+            last_message_preview = (
+                SELECT substr(tm.text, 1, 100) FROM ticket_messages tm
+                WHERE tm.ticket_id = support_tickets.ticket_id
+                ORDER BY tm.created_at DESC, tm.message_id DESC LIMIT 1
+            )
+    ''')
+    cursor.execute("ALTER TABLE support_tickets DROP COLUMN messages_json")
+
+
+# Search document of each transaction: notes, item name from item_details_json, blockchain txid of its payment.
+_TRANSACTIONS_FTS_ROWS_SQL = '''
+    INSERT INTO transactions_fts (rowid, notes, item_name, blockchain_tx_id)
+    SELECT t.transaction_id,
+           COALESCE(t.notes, ''),
+           CASE WHEN json_valid(t.item_details_json) THEN
+               trim(COALESCE(json_extract(t.item_details_json, '$.type'), '') || ' ' ||
+                    COALESCE(json_extract(t.item_details_json, '$.size'), '') || ' ' ||
+                    COALESCE(json_extract(t.item_details_json, '$.city'), '') || ' ' ||
+                    COALESCE(json_extract(t.item_details_json, '$.area'), ''))
+           ELSE '' END,
+           COALESCE((SELECT p.blockchain_tx_id FROM pending_crypto_payments p WHERE p.transaction_id = t.transaction_id), '')
+    FROM transactions t
+'''
+
+# Trigger body rebuilding one row; {id} is the NEW. column holding the transaction id.
+_TRANSACTIONS_FTS_REFRESH_SQL = (
+    "DELETE FROM transactions_fts WHERE rowid = {id};" + _TRANSACTIONS_FTS_ROWS_SQL + "WHERE t.transaction_id = {id};"
+)
+
+
+def _migration_0007_search_index(cursor: sqlite3.Cursor):
+    """
+    FTS5 indexes for the admin /search command, kept in sync by triggers: ticket message text
+    (rowid = message_id) and transaction notes, item names and blockchain txids (rowid = transaction_id).
+    """
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS ticket_messages_fts
+        USING fts5(text, tokenize = 'unicode61 remove_diacritics 2')
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_ticket_messages_fts_insert AFTER INSERT ON ticket_messages
+        BEGIN
+            INSERT INTO ticket_messages_fts (rowid, text) VALUES (NEW.message_id, NEW.text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_ticket_messages_fts_delete AFTER DELETE ON ticket_messages
+        BEGIN
+            DELETE FROM ticket_messages_fts WHERE rowid = OLD.message_id;
+        END
+    ''')
+    cursor.execute("INSERT INTO ticket_messages_fts (rowid, text) SELECT message_id, text FROM ticket_messages")
+
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts
+        USING fts5(notes, item_name, blockchain_tx_id, tokenize = 'unicode61 remove_diacritics 2')
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_fts_insert AFTER INSERT ON transactions
+        BEGIN
+            {_TRANSACTIONS_FTS_REFRESH_SQL.format(id='NEW.transaction_id')}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_fts_update AFTER UPDATE OF notes, item_details_json ON transactions
+        WHEN NEW.notes IS NOT OLD.notes OR NEW.item_details_json IS NOT OLD.item_details_json
+        BEGIN
+            {_TRANSACTIONS_FTS_REFRESH_SQL.format(id='NEW.transaction_id')}
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_fts_delete AFTER DELETE ON transactions
+        BEGIN
+            DELETE FROM transactions_fts WHERE rowid = OLD.transaction_id;
+        END
+    ''')
+    # The monitor rewrites blockchain_tx_id on every check; only a changed value touches the index.
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_pending_payments_fts_txid AFTER UPDATE OF blockchain_tx_id ON pending_crypto_payments
+        WHEN NEW.blockchain_tx_id IS NOT OLD.blockchain_tx_id
+        BEGIN
+            {_TRANSACTIONS_FTS_REFRESH_SQL.format(id='NEW.transaction_id')}
+        END
+    ''')
+    cursor.execute(_TRANSACTIONS_FTS_ROWS_SQL)
+
+
+def _migration_0008_archival(cursor: sqlite3.Cursor):
+    """Support for moving finished transactions and payments to the attached archive database (see db_utils)."""
+    # Archiver candidates: WHERE payment_status IN (...) AND updated_at < cutoff
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_status_updated ON transactions (payment_status, updated_at)")
+    # Only the archiver deletes transactions. Their search rows stay so archived history remains searchable.
+    cursor.execute("DROP TRIGGER IF EXISTS trg_transactions_fts_delete")
+
+
+# Rollup key of a transaction row aliased/named {t}: type, coin (balance purchases have no currency) and city.
+_ROLLUP_KEY_SQL = """
+    {t}.type,
+    COALESCE({t}.currency, 'balance'),
+    CASE WHEN json_valid({t}.item_details_json) THEN COALESCE(json_extract({t}.item_details_json, '$.city'), '') ELSE '' END
+"""
+# Every 'completed*' status means the payment was taken, including fulfilment errors.
+_ROLLUP_UPSERT_SQL = """
+    ON CONFLICT (day, type, coin, city) DO UPDATE SET
+        tx_count = tx_count + excluded.tx_count,
+        eur_cents = eur_cents + excluded.eur_cents
+"""
+
+def _migration_0009_daily_rollups(cursor: sqlite3.Cursor):
+    """
+    daily_rollups: completed transactions per (day, type, coin, city), maintained by triggers in the same
+    transaction as the status change, so dashboards read O(days) rows instead of scanning transactions.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_rollups (
+            day TEXT NOT NULL,
+            type TEXT NOT NULL,
+            coin TEXT NOT NULL,
+            city TEXT NOT NULL,
+            tx_count INTEGER NOT NULL DEFAULT 0,
+            eur_cents INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, type, coin, city)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_rollup_update
+        AFTER UPDATE OF payment_status ON transactions
+        WHEN NEW.payment_status LIKE 'completed%' AND OLD.payment_status NOT LIKE 'completed%'
+        BEGIN
+            INSERT INTO daily_rollups (day, type, coin, city, tx_count, eur_cents)
+            VALUES (date('now'), {_ROLLUP_KEY_SQL.format(t='NEW')}, 1, NEW.eur_amount_cents)
+            {_ROLLUP_UPSERT_SQL};
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_rollup_insert
+        AFTER INSERT ON transactions
+        WHEN NEW.payment_status LIKE 'completed%'
+        BEGIN
+            INSERT INTO daily_rollups (day, type, coin, city, tx_count, eur_cents)
+            VALUES (date('now'), {_ROLLUP_KEY_SQL.format(t='NEW')}, 1, NEW.eur_amount_cents)
+            {_ROLLUP_UPSERT_SQL};
+        END
+    """)
+    # Backfill from hot and archived history, dated by the last status change.
+    for table in ('main.transactions', 'archive.transactions'):
+        cursor.execute(f"""
+            INSERT INTO daily_rollups (day, type, coin, city, tx_count, eur_cents)
+            SELECT date(t.updated_at), {_ROLLUP_KEY_SQL.format(t='t')}, COUNT(*), SUM(t.eur_amount_cents)
+            FROM {table} t
+            WHERE t.payment_status LIKE 'completed%'
+            GROUP BY 1, 2, 3, 4
+            {_ROLLUP_UPSERT_SQL}
+        """)
+
+
+def _migration_0010_payment_finalizations(cursor: sqlite3.Cursor):
+    """
+    Idempotency record for payment finalization: a row is inserted before any side effect (balance
+    credit, item move) and can only be inserted once per payment_id, whichever worker gets there first.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS payment_finalizations (
+            payment_id INTEGER PRIMARY KEY,
+            transaction_id INTEGER NOT NULL,
+            started_at TEXT NOT NULL,
+            finished_at TEXT,
+            outcome TEXT -- Final pending_crypto_payments.status; NULL while running or after a crash mid-way
+        )
+    """)
+
+
+def _migration_0011_jobs(cursor: sqlite3.Cursor):
+    """Durable job queue drained by modules.job_queue workers. Times are Unix epoch seconds."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{}', -- JSON object passed to the handler
+            state TEXT NOT NULL DEFAULT 'queued', -- 'queued' or 'dead' (gave up after max_attempts)
+            run_at REAL NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 100, -- Lower runs first
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 5,
+            lease_seconds INTEGER NOT NULL DEFAULT 300,
+            lease_owner TEXT,
+            lease_expires_at REAL,
+            last_error TEXT,
+            dedupe_key TEXT UNIQUE, -- At most one queued job per key (recurring jobs, follow-up rechecks)
+            created_at REAL NOT NULL
+        )
+    """)
+    # Claim: WHERE state = 'queued' AND run_at <= now ORDER BY priority, run_at
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state_run_at ON jobs (state, run_at)")
+
+
+# Time columns stored as INTEGER Unix epoch seconds (UTC) from migration 12 on: (table, column, new definition).
+_EPOCH_COLUMNS = (
+    ("pending_crypto_payments", "created_at", "created_at INTEGER NOT NULL DEFAULT 0"),
+    ("pending_crypto_payments", "last_checked_at", "last_checked_at INTEGER"),
+    ("pending_crypto_payments", "expires_at", "expires_at INTEGER NOT NULL DEFAULT 0"),
+    ("support_tickets", "created_at", "created_at INTEGER NOT NULL DEFAULT 0"),
+    ("support_tickets", "last_message_at", "last_message_at INTEGER NOT NULL DEFAULT 0"),
+)
+_ISO_TO_EPOCH_SQL = "COALESCE(CAST(strftime('%s', {column}) AS INTEGER), 0)"
+
+def _migration_0012_epoch_timestamps(cursor: sqlite3.Cursor):
+    """
+    Payment and ticket times as INTEGER epoch seconds instead of ISO text, so the monitor and expiry queries
+    compare plain integers on (status, time) indexes. Adds pending_crypto_payments.next_check_at, the time the
+    monitor should next query the blockchain for a payment.
+    """
+    # Indexes on the converted columns would block DROP COLUMN; they are recreated below.
+    for index in ("idx_pending_payments_status_expires", "idx_pending_payments_status_created",
+                  "idx_support_tickets_user_status_created", "idx_support_tickets_status_last_message"):
+        cursor.execute(f"DROP INDEX IF EXISTS {index}")
+    for table, column, column_def in _EPOCH_COLUMNS:
+        cursor.execute(f"ALTER TABLE {table} RENAME COLUMN {column} TO {column}_iso")
+        _replace_column(cursor, table, f"{column}_iso", column_def, _ISO_TO_EPOCH_SQL.format(column=f"{column}_iso"))
+
+    cursor.execute("ALTER TABLE pending_crypto_payments ADD COLUMN next_check_at INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("UPDATE pending_crypto_payments SET next_check_at = COALESCE(last_checked_at, 0)")
+
+    # Monitor: WHERE status = 'monitoring' AND next_check_at <= now ORDER BY next_check_at
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_status_next_check ON pending_crypto_payments (status, next_check_at)")
+    # Expiry: WHERE status = 'monitoring' AND expires_at <= now ORDER BY expires_at
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_status_expires ON pending_crypto_payments (status, expires_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_status_created ON pending_crypto_payments (status, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_support_tickets_user_status_created ON support_tickets (user_id, status, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_support_tickets_status_last_message ON support_tickets (status, last_message_at, user_id)")
+
+    # Archived payments keep their column names; convert their values in place.
+    for column in ("created_at", "last_checked_at", "expires_at"):
+        cursor.execute(f"UPDATE archive.pending_crypto_payments SET {column} = {_ISO_TO_EPOCH_SQL.format(column=column)} "
+                       f"WHERE typeof({column}) = 'text'")
+
+
+# Ordered registry: (version, description, function taking a cursor).
+MIGRATIONS = [
+    (1, "Baseline schema", _migration_0001_baseline),
+    (2, "Composite indexes for db_utils queries", _migration_0002_query_indexes),
+    (3, "Trigger-maintained user count", _migration_0003_user_count),
+    (4, "Integer money columns", _migration_0004_integer_money),
+    (5, "Balance ledger and snapshots", _migration_0005_balance_ledger),
+    (6, "Normalized ticket messages", _migration_0006_ticket_messages),
+    (7, "Full-text search indexes", _migration_0007_search_index),
+    (8, "Hot/cold archival support", _migration_0008_archival),
+    (9, "Daily revenue/volume rollups", _migration_0009_daily_rollups),
+    (10, "Payment finalization idempotency", _migration_0010_payment_finalizations),
+    (11, "Durable job queue", _migration_0011_jobs),
+    (12, "Epoch-second payment and ticket timestamps", _migration_0012_epoch_timestamps),
+]
+
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    try:
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except sqlite3.OperationalError: # schema_version does not exist yet
+        return 0
+    return row[0] or 0
+
+
+def get_pending_migrations(conn: sqlite3.Connection) -> list[tuple]:
+    current_version = get_schema_version(conn)
+    return [m for m in MIGRATIONS if m[0] > current_version]
+
+
+def run_pending_migrations() -> int:
+    """
+    Applies every migration newer than the database's schema version. Returns the resulting version.
+    Raises sqlite3.Error if a migration fails; that migration is rolled back and later ones are not attempted.
+    """
+    # A dedicated connection without the pool's TEMP views, which ALTER TABLE would re-validate against a half-migrated schema.
+    with contextlib.closing(db_utils.get_db_connection(create_views=False)) as conn:
+        current_version = get_schema_version(conn)
+        if current_version >= LATEST_SCHEMA_VERSION:
+            logger.debug(f"Database schema is current (version {current_version}).")
+            return current_version
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TEXT NOT NULL
+            )
+        ''')
+        for version, description, migration_fn in MIGRATIONS:
+            if version <= current_version:
+                continue
+            logger.info(f"Applying schema migration {version}: {description}...")
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                migration_fn(conn.cursor())
+                conn.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                             (version, description, datetime.datetime.utcnow().isoformat()))
+                conn.commit()
+            except sqlite3.Error:
+                logger.exception(f"Schema migration {version} ({description}) failed. Rolling back.")
+                conn.rollback()
+                raise
+            current_version = version
+        logger.info(f"Database schema migrated to version {current_version}.")
+        return current_version
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending database schema migrations offline.")
+    parser.add_argument('--db', help="Path to the SQLite database (defaults to config.DATABASE_NAME).")
+    parser.add_argument('--status', action='store_true', help="Only show the current version and pending migrations.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if args.db:
+        db_utils.DATABASE_NAME = args.db
+
+    with db_utils.db_connection() as conn:
+        current_version = get_schema_version(conn)
+        pending = get_pending_migrations(conn)
+    print(f"Database: {db_utils.DATABASE_NAME}")
+    print(f"Schema version: {current_version} (latest: {LATEST_SCHEMA_VERSION})")
+    for version, description, _ in pending:
+        print(f"  pending: {version} - {description}")
+
+    if not args.status and pending:
+        new_version = run_pending_migrations()
+        print(f"Migrated to schema version {new_version}.")
+    db_utils.close_db_connections()
+
+
+if __name__ == '__main__':
+    main()
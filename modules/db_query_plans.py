@@ -0,0 +1,200 @@
+import datetime
+import logging
+import os
+import sys
+import tempfile
+
+from modules import db_utils
+
+logger = logging.getLogger(__name__)
+
+# --- EXPLAIN QUERY PLAN regression check ---
+# Runs every db_utils helper against a freshly migrated, seeded database, captures the SQL each
+# one actually issues (via the connection's trace callback), and EXPLAINs it. Any statement whose
+# plan contains a full table scan fails the check.
+#
+#     python -m modules.db_query_plans        # exit status 1 if any query scans a table
+#
+# When adding a db_utils helper, add a call to _exercise_db_utils() so its queries are covered.
+
+SEED_USERS = 200
+SEED_TRANSACTIONS_PER_USER = 5
+
+# Statements that are allowed to scan, matched by prefix of the normalized SQL, with the reason.
+ALLOWED_SCANS = {
+    "SELECT k, v FROM 'main'.":
+        "FTS5 internal: reads its few-row *_config shadow table the first time a connection uses a full-text table.",
+    "INSERT INTO balance_snapshots (user_id, last_entry_id, balance_cents, created_at) SELECT u.user_id":
+        "Periodic snapshot job visits every user once; ledger reads are index range seeks past each user's latest snapshot.",
+    "SELECT u.user_id, u.balance_cents, COALESCE(bs.balance_cents, 0) + COALESCE((":
+        "Ledger audit visits every user once; ledger reads are index range seeks past each user's latest snapshot.",
+}
+
+_EXPLAINABLE_PREFIXES = ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH', 'REPLACE')
+
+
+def _normalize_sql(sql: str) -> str:
+    # Drop '--' comments so collapsing whitespace cannot swallow the rest of the statement.
+    lines = [line.split('--', 1)[0] for line in sql.splitlines()]
+    return ' '.join(' '.join(lines).split())
+
+
+def _seed_database():
+    now = datetime.datetime.utcnow()
+    with db_utils.db_connection() as conn:
+        conn.executemany("INSERT INTO users (user_id, balance_cents, transaction_count) VALUES (?, 0, 0)",
+                         [(user_id,) for user_id in range(1, SEED_USERS + 1)])
+        conn.executemany("""
+            INSERT INTO transactions (user_id, type, eur_amount_cents, payment_status, created_at, updated_at)
+            VALUES (?, 'balance_top_up', 1000, 'completed', ?, ?)
+        """, [(user_id, (now - datetime.timedelta(minutes=n)).isoformat(), now.isoformat())
+              for user_id in range(1, SEED_USERS + 1) for n in range(SEED_TRANSACTIONS_PER_USER)])
+        conn.executemany("""
+            INSERT INTO support_tickets (user_id, status, created_at, last_message_at, message_count)
+            VALUES (?, ?, ?, ?, 0)
+        """, [(user_id, 'open' if user_id % 3 else 'closed_by_user', db_utils.to_epoch(now), db_utils.to_epoch(now))
+              for user_id in range(1, SEED_USERS + 1)])
+        conn.commit()
+
+
+def _exercise_db_utils():
+    """Calls every db_utils helper at least once so its statements show up in the trace."""
+    now = datetime.datetime.utcnow()
+    user_id = 1
+    db_utils.get_or_create_user(user_id)
+    db_utils.get_or_create_user(SEED_USERS + 1)
+    db_utils.get_next_address_index('BTC')
+    tx_id = db_utils.record_transaction(user_id, 'balance_top_up', 1000, original_add_balance_cents=1000)
+    db_utils.update_main_transaction_for_hd_payment(tx_id, 'awaiting_payment', '1000', 'BTC')
+    db_utils.get_transaction_by_id(tx_id)
+    payment_id = db_utils.create_pending_payment(tx_id, user_id, 'plan-check-address', 'BTC', 'BTC', 1000,
+                                                 now + datetime.timedelta(hours=1))
+    db_utils.get_pending_payments_to_monitor()
+    db_utils.update_pending_payment_check_details(payment_id, 1, 1000, 'txid')
+    db_utils.update_pending_payment_check_details(payment_id, 1)
+    now_epoch = db_utils.to_epoch(now)
+    db_utils.apply_pending_payment_updates([(now_epoch, now_epoch + 60, 1, None, None, payment_id)],
+                                           [('confirmed_unprocessed', now_epoch, payment_id, 'monitoring')])
+    db_utils.get_confirmed_unprocessed_payments()
+    db_utils.release_stale_finalization_claims(timeout_seconds=0)
+    db_utils.claim_confirmed_payments()
+    db_utils.begin_payment_finalization(payment_id, tx_id)
+    db_utils.get_payment_finalization(payment_id)
+    db_utils.finish_payment_finalization(payment_id, 'processed')
+    db_utils.get_pending_payment_by_transaction_id(tx_id)
+    db_utils.get_pending_payment_by_address('plan-check-address')
+    db_utils.get_stale_monitoring_payments()
+    db_utils.update_pending_payment_status(payment_id, 'processed')
+    db_utils.update_transaction_status(tx_id, 'completed')
+    db_utils.update_transaction_status(tx_id, 'completed', notes='plan check')
+    db_utils.credit_balance(user_id, 1000, 'balance_top_up')
+    db_utils.credit_balance(user_id, 1000, 'balance_top_up', transaction_id=tx_id, increment_transactions=True)
+    db_utils.debit_balance_if_sufficient(user_id, 500, 'purchase_balance', transaction_id=tx_id)
+    db_utils.debit_balance_allowing_shortfall(user_id, 3000, 'purchase_crypto', transaction_id=tx_id)
+    db_utils.create_balance_snapshots(min_new_entries=1)
+    db_utils.credit_balance(user_id, 250, 'balance_top_up')
+    db_utils.get_balance_at(user_id, now)
+    db_utils.reconcile_user_balance(user_id)
+    db_utils.find_balance_discrepancies()
+    db_utils.increment_user_transaction_count(user_id)
+    db_utils.get_user_transaction_history(user_id)
+    db_utils.get_user_transaction_history(user_id, older_than_tx_id=tx_id)
+    db_utils.get_user_transaction_history(user_id, newer_than_tx_id=tx_id)
+
+    ticket_id = db_utils.create_new_ticket(user_id, "plan check")
+    db_utils.get_open_ticket_for_user(user_id)
+    db_utils.add_message_to_ticket(ticket_id, 'admin', "reply")
+    db_utils.get_ticket_messages(ticket_id)
+    db_utils.search_admin("reply")
+    db_utils.search_admin("plan check", limit=5, offset=5)
+    db_utils.get_all_open_tickets_admin()
+    db_utils.get_ticket_details_by_id(ticket_id)
+    db_utils.update_admin_ticket_view_message_id(ticket_id, 1)
+    db_utils.update_ticket_status(ticket_id, 'closed_by_user')
+    db_utils.expire_old_tickets()
+
+    db_utils.update_transaction_status(tx_id, 'completed')
+    db_utils.get_rollup_summary(days=7)
+    db_utils.archive_finished_records(older_than_days=0, batch_size=2)
+    db_utils.get_user_transaction_history(user_id, older_than_tx_id=tx_id)
+
+    job_id = db_utils.enqueue_job('plan_check', {'n': 1}, dedupe_key='plan-check')
+    db_utils.enqueue_job('plan_check', dedupe_key='plan-check', keep_existing=True)
+    db_utils.enqueue_job('plan_check')
+    for job in db_utils.claim_due_jobs('plan-check-worker', limit=2):
+        db_utils.complete_job(job['job_id'], 'plan-check-worker', job['run_at'],
+                              next_run_at=job['run_at'] + 60 if job['job_id'] == job_id else None)
+    db_utils.enqueue_job('plan_check', dedupe_key='plan-check')
+    for job in db_utils.claim_due_jobs('plan-check-worker'):
+        db_utils.fail_job(job['job_id'], 'plan-check-worker', 'plan check', retry_at=job['run_at'] + 60)
+
+    db_utils.get_user_count()
+    db_utils.get_all_users_admin()
+    db_utils.get_all_users_admin(after_user_id=SEED_USERS // 2)
+    db_utils.get_all_users_admin(before_user_id=SEED_USERS // 2)
+
+
+def _full_scans(conn, sql: str) -> list[str]:
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    # Scanning a materialized CTE reads its (already bounded) result, not a table.
+    materialized = {f"SCAN {row[3][len('MATERIALIZE '):]}" for row in plan if row[3].startswith('MATERIALIZE ')}
+    scans = []
+    for row in plan:
+        detail = row[3]
+        if not detail.startswith('SCAN ') or detail.startswith(('SCAN CONSTANT ROW', 'SCAN (subquery')):
+            continue
+        if detail in materialized:
+            continue
+        if 'VIRTUAL TABLE INDEX' in detail and ':M' in detail: # FTS5 MATCH lookup through the full-text index
+            continue
+        scans.append(detail)
+    return scans
+
+
+def check_query_plans() -> list[tuple[str, list[str]]]:
+    """Returns (sql, scan details) for every captured statement that performs a disallowed full scan."""
+    captured = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        original_db = db_utils.DATABASE_NAME
+        db_utils.DATABASE_NAME = os.path.join(tmp_dir, 'plan_check.db')
+        try:
+            db_utils.initialize_database()
+            _seed_database()
+            with db_utils.db_connection() as conn:
+                conn.execute("ANALYZE")
+                conn.set_trace_callback(captured.append)
+                try:
+                    _exercise_db_utils()
+                finally:
+                    conn.set_trace_callback(None)
+
+                failures = []
+                seen = set()
+                for sql in captured:
+                    normalized = _normalize_sql(sql)
+                    if normalized in seen or not normalized.upper().startswith(_EXPLAINABLE_PREFIXES):
+                        continue
+                    seen.add(normalized)
+                    if any(normalized.startswith(prefix) for prefix in ALLOWED_SCANS):
+                        continue
+                    scans = _full_scans(conn, sql)
+                    if scans:
+                        failures.append((normalized, scans))
+            logger.info(f"Checked query plans for {len(seen)} distinct statements.")
+            return failures
+        finally:
+            db_utils.close_db_connections()
+            db_utils.DATABASE_NAME = original_db
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    failures = check_query_plans()
+    for sql, scans in failures:
+        print(f"FULL SCAN: {sql}")
+        for detail in scans:
+            print(f"    {detail}")
+    if failures:
+        print(f"{len(failures)} statement(s) fall back to a full table scan.")
+        sys.exit(1)
+    print("All db_utils statements use an index or primary key lookup.")
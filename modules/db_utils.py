@@ -1,9 +1,16 @@
 import sqlite3
-import json
 import config
 import os
 import datetime
 import logging
+import re
+import threading
+import contextlib
+import collections
+import json
+import time
+
+from modules import db_metrics, money
 
 logger = logging.getLogger(__name__)
 
@@ -17,170 +24,218 @@ except ImportError:
 
 DATABASE_NAME = config.DATABASE_NAME
 
-def get_db_connection():
-    db_dir = os.path.dirname(DATABASE_NAME)
-    logger.info(f"Attempting to connect to database at: {DATABASE_NAME}")
-    logger.info(f"Database directory is: {db_dir}")
-    logger.info(f"Database directory exists: {os.path.exists(db_dir)}")
-    if not os.path.exists(db_dir):
-        os.makedirs(db_dir, exist_ok=True)
-        logger.info(f"Created database directory: {db_dir}")
-    conn = sqlite3.connect(DATABASE_NAME)
+# --- Connection Pool ---
+# Each worker thread (bot polling, scheduler threads) keeps one long-lived connection
+# that is opened and configured once, then borrowed by every helper via db_connection().
+DB_BUSY_TIMEOUT_MS = getattr(config, 'DB_BUSY_TIMEOUT_MS', 5000)
+DB_CACHED_STATEMENTS = getattr(config, 'DB_CACHED_STATEMENTS', 256)
+
+# --- Hot/Cold Archive ---
+# Finished transactions and their payments are moved into a second database file, attached to every
+# pooled connection as schema 'archive'. Unqualified table names keep resolving to the small hot tables
+# in 'main'; history reads go through the per-connection TEMP view all_transactions (hot UNION ALL archive).
+ARCHIVE_DATABASE_NAME = getattr(config, 'ARCHIVE_DATABASE_NAME', None) # Default: archive.db next to DATABASE_NAME
+
+TRANSACTION_COLUMNS = ("transaction_id, user_id, item_details_json, type, eur_amount_cents, crypto_amount, currency, "
+                       "payment_status, original_add_balance_cents, notes, created_at, updated_at")
+PENDING_PAYMENT_COLUMNS = ("payment_id, transaction_id, user_id, address, coin_symbol, network, status, created_at, "
+                           "last_checked_at, expires_at, blockchain_tx_id, confirmations, paid_from_balance_cents, "
+                           "expected_crypto_units, received_crypto_units")
+
+def get_archive_path() -> str:
+    return ARCHIVE_DATABASE_NAME or os.path.join(os.path.dirname(DATABASE_NAME), 'archive.db')
+
+def _ensure_archive_schema(conn: sqlite3.Connection):
+    """Archive tables mirror the hot ones (see TRANSACTION_COLUMNS / PENDING_PAYMENT_COLUMNS) plus archived_at."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS archive.transactions (
+            transaction_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            item_details_json TEXT,
+            type TEXT NOT NULL,
+            eur_amount_cents INTEGER NOT NULL,
+            crypto_amount TEXT,
+            currency TEXT,
+            payment_status TEXT NOT NULL,
+            original_add_balance_cents INTEGER,
+            notes TEXT,
+            created_at DATETIME NOT NULL,
+            updated_at DATETIME NOT NULL,
+            archived_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_transactions_user_created ON transactions (user_id, created_at)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS archive.pending_crypto_payments (
+            payment_id INTEGER PRIMARY KEY,
+            transaction_id INTEGER UNIQUE NOT NULL,
+            user_id INTEGER NOT NULL,
+            address TEXT NOT NULL,
+            coin_symbol TEXT NOT NULL,
+            network TEXT,
+            status TEXT NOT NULL,
+            created_at INTEGER NOT NULL, -- Unix epoch seconds, like the hot table
+            last_checked_at INTEGER,
+            expires_at INTEGER NOT NULL,
+            blockchain_tx_id TEXT,
+            confirmations INTEGER NOT NULL,
+            paid_from_balance_cents INTEGER NOT NULL,
+            expected_crypto_units INTEGER NOT NULL,
+            received_crypto_units INTEGER,
+            archived_at TEXT NOT NULL
+        )
+    """)
+    conn.commit()
+
+_pool_lock = threading.Lock()
+_pool_configured_for = None # Database path the one-time setup (directory, WAL) was done for
+_pool_connections = {} # thread ident -> sqlite3.Connection, so they can be closed on shutdown
+_thread_local = threading.local()
+
+def _open_connection(create_views: bool = True) -> sqlite3.Connection:
+    factory = db_metrics.InstrumentedConnection if db_metrics.DB_QUERY_METRICS_ENABLED else sqlite3.Connection
+    conn = sqlite3.connect(DATABASE_NAME, cached_statements=DB_CACHED_STATEMENTS, check_same_thread=False, factory=factory)
     conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT_MS)}")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("ATTACH DATABASE ? AS archive", (get_archive_path(),))
+    if not create_views: # Schema migrations: ALTER TABLE re-validates every view, including TEMP ones
+        return conn
+    conn.execute(f"""
+        CREATE TEMP VIEW IF NOT EXISTS all_transactions AS
+        SELECT {TRANSACTION_COLUMNS} FROM main.transactions
+        UNION ALL
+        SELECT {TRANSACTION_COLUMNS} FROM archive.transactions
+    """)
     return conn
 
-def initialize_database():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    logger.info("Initializing database schema for HD wallet integration...")
+def configure_db_pool():
+    """One-time database setup: ensures the directory exists, switches both files to WAL journaling and creates the archive tables."""
+    global _pool_configured_for
+    with _pool_lock:
+        if _pool_configured_for == DATABASE_NAME:
+            return
+        db_dir = os.path.dirname(DATABASE_NAME)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+            logger.info(f"Created database directory: {db_dir}")
+        conn = _open_connection(create_views=False)
+        try:
+            # Only takes effect on a brand-new file; existing ones are converted with python -m modules.db_backup --enable-incremental-vacuum
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("PRAGMA archive.auto_vacuum = INCREMENTAL")
+            journal_mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+            conn.execute("PRAGMA archive.journal_mode = WAL")
+            _ensure_archive_schema(conn)
+        finally:
+            conn.close()
+        _pool_configured_for = DATABASE_NAME
+        logger.info(f"Database pool configured for {DATABASE_NAME} (journal_mode={journal_mode}, busy_timeout={DB_BUSY_TIMEOUT_MS}ms, synchronous=NORMAL, archive={get_archive_path()}).")
+
+def _get_thread_connection() -> sqlite3.Connection:
+    conn = getattr(_thread_local, 'conn', None)
+    if conn is not None and getattr(_thread_local, 'db_path', None) == DATABASE_NAME:
+        return conn
+    if conn is not None: # DATABASE_NAME was repointed (e.g. offline tooling); drop the stale connection
+        _discard_thread_connection()
+    if _pool_configured_for != DATABASE_NAME:
+        configure_db_pool()
+    conn = _open_connection()
+    _thread_local.conn = conn
+    _thread_local.db_path = DATABASE_NAME
+    _thread_local.depth = 0
+    with _pool_lock:
+        _pool_connections[threading.get_ident()] = conn
+    logger.debug(f"Opened pooled database connection for thread {threading.current_thread().name}.")
+    return conn
 
-    conn.execute('BEGIN')
+def _discard_thread_connection():
+    conn = getattr(_thread_local, 'conn', None)
+    if conn is None:
+        return
+    with _pool_lock:
+        _pool_connections.pop(threading.get_ident(), None)
+    try: conn.close()
+    except sqlite3.Error as e: logger.warning(f"Error closing pooled connection: {e}")
+    _thread_local.conn = None
+    _thread_local.db_path = None
+
+@contextlib.contextmanager
+def db_connection():
+    """
+    Borrows the calling thread's pooled connection for the duration of the block.
+    Nested use on the same thread shares the connection; any transaction still open
+    when the outermost block exits (or raises) is rolled back so the connection is
+    always handed back clean.
+    """
+    conn = _get_thread_connection()
+    _thread_local.depth = getattr(_thread_local, 'depth', 0) + 1
     try:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                balance REAL DEFAULT 0.0,
-                transaction_count INTEGER DEFAULT 0
-            )
-        ''')
-        logger.debug("Users table ensured.")
-
-        # Remove 'products' table as products are now managed by filesystem
-        cursor.execute("DROP TABLE IF EXISTS products")
-        logger.info("'products' table dropped as it's replaced by filesystem product management.")
-        # Remove 'product_instances' table if it existed (it wasn't in the provided schema but good to ensure)
-        cursor.execute("DROP TABLE IF EXISTS product_instances")
-        logger.info("'product_instances' table (if existed) dropped.")
-
-
-        # Adjust 'transactions' table:
-        # - Remove product_id FOREIGN KEY
-        # - Add item_details_json TEXT to store product info for purchases
-
-        # Check if transactions table exists and needs migration for item_details_json
-        transactions_table_exists = False
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='transactions';")
-        if cursor.fetchone():
-            transactions_table_exists = True
-
-        temp_transactions_name = "transactions_old_for_fs_item_migration"
-        cursor.execute(f"DROP TABLE IF EXISTS {temp_transactions_name}")
-
-        if transactions_table_exists:
-            logger.info(f"Existing 'transactions' table found. Renaming to '{temp_transactions_name}' for schema adjustment.")
-            cursor.execute(f"ALTER TABLE transactions RENAME TO {temp_transactions_name}")
-        else:
-            logger.info("'transactions' table not found, will be created with new schema.")
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS transactions (
-                transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                item_details_json TEXT, -- Stores JSON of item details for purchase type
-                type TEXT NOT NULL, -- e.g., 'purchase_crypto', 'purchase_balance', 'balance_top_up'
-                eur_amount REAL NOT NULL,
-                crypto_amount TEXT, -- For crypto payments
-                currency TEXT, -- For crypto payments
-                payment_status TEXT DEFAULT 'pending' NOT NULL,
-                original_add_balance_amount REAL, -- For balance_top_up type
-                notes TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-                -- Removed FOREIGN KEY (product_id)
-            )
-        ''')
-        logger.info("'transactions' table created/ensured with item_details_json and no product_id FK.")
-
-        # Data migration from old transactions table (if it existed) could be added here if necessary
-        # For now, we are just creating the new schema. User would lose old transaction product links.
-        # If temp_transactions_name table exists, log that manual migration might be needed.
-        cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{temp_transactions_name}';")
-        if cursor.fetchone():
-            logger.warning(f"Table '{temp_transactions_name}' exists. Old transaction data is there. "
-                           "Manual migration to the new 'transactions' table structure (especially for product details) "
-                           "would be needed to preserve full history if desired. Product FK is removed.")
-
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS hd_address_indices (
-                coin_symbol TEXT PRIMARY KEY,
-                last_used_index INTEGER DEFAULT -1 NOT NULL
-            )
-        ''')
-        logger.debug("hd_address_indices table ensured.")
-        initial_coins = ['BTC', 'LTC', 'TRX']
-        for coin in initial_coins:
-            cursor.execute("INSERT OR IGNORE INTO hd_address_indices (coin_symbol, last_used_index) VALUES (?, -1)", (coin,))
-        logger.info(f"Seeded hd_address_indices with: {', '.join(initial_coins)} (if not already present).")
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS pending_crypto_payments (
-                payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                transaction_id INTEGER UNIQUE NOT NULL,
-                user_id INTEGER NOT NULL,
-                address TEXT UNIQUE NOT NULL,
-                coin_symbol TEXT NOT NULL,
-                network TEXT,
-                expected_crypto_amount TEXT NOT NULL,
-                received_crypto_amount TEXT,
-                status TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
-                last_checked_at DATETIME,
-                expires_at DATETIME NOT NULL,
-                blockchain_tx_id TEXT,
-                confirmations INTEGER DEFAULT 0 NOT NULL,
-                paid_from_balance_eur REAL DEFAULT 0.0 NOT NULL,
-                FOREIGN KEY (transaction_id) REFERENCES transactions (transaction_id) ON DELETE CASCADE,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-        logger.debug("pending_crypto_payments table ensured.")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_status ON pending_crypto_payments (status);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_address ON pending_crypto_payments (address);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_transaction_id ON pending_crypto_payments (transaction_id);")
-        logger.debug("Indexes for pending_crypto_payments ensured.")
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS support_tickets (
-                ticket_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                status TEXT DEFAULT 'open' NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_message_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                messages_json TEXT,
-                admin_chat_id INTEGER,
-                admin_ticket_view_message_id INTEGER,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-        logger.debug("Support tickets table ensured.")
-
-        conn.commit()
-        logger.info("Database schema initialization and HD wallet table setup complete.")
-    except sqlite3.Error as e:
-        logger.exception("Error during database schema initialization for HD wallet integration. Rolling back.")
-        conn.rollback()
+        yield conn
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
     finally:
-        conn.close()
+        _thread_local.depth -= 1
+        if _thread_local.depth == 0 and conn.in_transaction:
+            logger.warning("Pooled connection returned with an uncommitted transaction. Rolling back.")
+            conn.rollback()
 
+def close_db_connections(thread_idents=None, except_thread_idents=()):
+    """
+    Closes the pooled connections of the given threads (threading.get_ident() values), or of every thread
+    if none are given, skipping except_thread_idents (threads that may still be using theirs).
+    Call on shutdown, after those threads have stopped using the database.
+    """
+    with _pool_lock:
+        if thread_idents is None:
+            thread_idents = list(_pool_connections)
+        thread_idents = [ident for ident in thread_idents if ident not in except_thread_idents]
+        connections = [_pool_connections.pop(ident) for ident in thread_idents if ident in _pool_connections]
+    for conn in connections:
+        try: conn.close()
+        except sqlite3.Error as e: logger.warning(f"Error closing pooled connection on shutdown: {e}")
+    if threading.get_ident() in thread_idents:
+        _thread_local.conn = None
+        _thread_local.db_path = None
+    logger.info(f"Closed {len(connections)} pooled database connection(s).")
+
+def get_db_connection(create_views: bool = True):
+    """
+    Opens a standalone connection configured like the pooled ones. The caller owns it and must close it.
+    Request paths should use db_connection() instead.
+    """
+    if _pool_configured_for != DATABASE_NAME:
+        configure_db_pool()
+    return _open_connection(create_views=create_views)
 
-def print_users_table_schema():
-    conn = None
+def initialize_database():
+    """
+    Brings the schema up to date via the versioned migrations in modules.db_migrations.
+    On an up-to-date database this is a single schema_version lookup.
+    Raises sqlite3.Error if a migration fails: nothing else works against an outdated schema.
+    """
+    from modules import db_migrations # Local import: db_migrations imports this module
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        logger.info("Fetching schema for 'users' table...")
-        cursor.execute("PRAGMA table_info(users);")
-        schema = cursor.fetchall()
-        logger.info("Schema for 'users' table:")
-        for col in schema:
-            logger.info(f"  CID: {col['cid']}, Name: {col['name']}, Type: {col['type']}, NotNull: {col['notnull']}, DfltValue: {col['dflt_value']}, PK: {col['pk']}")
+        db_migrations.run_pending_migrations()
     except sqlite3.Error as e:
-        logger.exception(f"Error fetching schema for 'users' table: {e}")
-    finally:
-        if conn:
-            conn.close()
+        logger.exception(f"Database schema migration failed: {e}")
+        raise
+
+
+def print_users_table_schema():
+    with db_connection() as conn:
+        try:
+            cursor = conn.cursor()
+            logger.info("Fetching schema for 'users' table...")
+            cursor.execute("PRAGMA table_info(users);")
+            schema = cursor.fetchall()
+            logger.info("Schema for 'users' table:")
+            for col in schema:
+                logger.info(f"  CID: {col['cid']}, Name: {col['name']}, Type: {col['type']}, NotNull: {col['notnull']}, DfltValue: {col['dflt_value']}, PK: {col['pk']}")
+        except sqlite3.Error as e:
+            logger.exception(f"Error fetching schema for 'users' table: {e}")
 
 
 if __name__ == '__main__':
@@ -191,20 +246,19 @@ if __name__ == '__main__':
 
 
 def get_or_create_user(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    # Explicitly select columns to ensure they are included in the result
-    cursor.execute("SELECT user_id, balance, transaction_count FROM users WHERE user_id = ?", (user_id,))
-    user = cursor.fetchone()
-    if user is None:
-        logger.info(f"User {user_id} not found, creating new user.")
-        cursor.execute("INSERT INTO users (user_id, balance, transaction_count) VALUES (?, 0.0, 0)", (user_id,))
-        conn.commit()
-        # Fetch the newly created user with explicit column selection
-        cursor.execute("SELECT user_id, balance, transaction_count FROM users WHERE user_id = ?", (user_id,))
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        # Explicitly select columns to ensure they are included in the result
+        cursor.execute("SELECT user_id, balance_cents, transaction_count FROM users WHERE user_id = ?", (user_id,))
         user = cursor.fetchone()
-    conn.close()
-    return user
+        if user is None:
+            logger.info(f"User {user_id} not found, creating new user.")
+            cursor.execute("INSERT INTO users (user_id, balance_cents, transaction_count) VALUES (?, 0, 0)", (user_id,))
+            conn.commit()
+            # Fetch the newly created user with explicit column selection
+            cursor.execute("SELECT user_id, balance_cents, transaction_count FROM users WHERE user_id = ?", (user_id,))
+            user = cursor.fetchone()
+        return user
 
 # clear_user_process seems to be a duplicate or alternative way to call clear_user_state.
 # clear_user_state itself is imported (or dummied) from modules.utils.
@@ -218,448 +272,1118 @@ def clear_user_process(user_id):
 
 # --- HD Wallet Specific Functions ---
 def get_next_address_index(coin_symbol: str) -> int:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        # Use INSERT OR IGNORE to ensure the row exists, then proceed with update
-        cursor.execute("INSERT OR IGNORE INTO hd_address_indices (coin_symbol, last_used_index) VALUES (?, -1)", (coin_symbol,))
-        conn.commit() # Commit the insert if it happened
-
-        # Now get the current index and update it within a transaction
-        conn.execute('BEGIN IMMEDIATE') # Start a new transaction for the update
-        cursor.execute("SELECT last_used_index FROM hd_address_indices WHERE coin_symbol = ?", (coin_symbol,))
-        row = cursor.fetchone()
-        if row is None:
-            logger.critical(f"HD Wallet Index: Coin symbol {coin_symbol} still not found after INSERT OR IGNORE.")
-            conn.rollback()
-            raise sqlite3.OperationalError(f"Could not find or initialize index for coin {coin_symbol}. Critical error.")
-        current_index = row['last_used_index']
-        new_index = current_index + 1
-        cursor.execute("UPDATE hd_address_indices SET last_used_index = ? WHERE coin_symbol = ?", (new_index, coin_symbol))
-        conn.commit() # Commit the update
-        logger.info(f"HD Wallet Index: Next index for {coin_symbol} is {new_index} (old was {current_index}).")
-        return new_index
-    except sqlite3.Error as e:
-        logger.exception(f"HD Wallet Index: Database error for {coin_symbol}: {e}")
-        if conn:
-            try: conn.rollback()
-            except sqlite3.Error as rb_err:
-                logger.exception(f"HD Wallet Index: Error during rollback for {coin_symbol}: {rb_err}")
-        raise
-    finally:
-        if conn: conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            # Use INSERT OR IGNORE to ensure the row exists, then proceed with update
+            cursor.execute("INSERT OR IGNORE INTO hd_address_indices (coin_symbol, last_used_index) VALUES (?, -1)", (coin_symbol,))
+            conn.commit() # Commit the insert if it happened
+
+            # Now get the current index and update it within a transaction
+            conn.execute('BEGIN IMMEDIATE') # Start a new transaction for the update
+            cursor.execute("SELECT last_used_index FROM hd_address_indices WHERE coin_symbol = ?", (coin_symbol,))
+            row = cursor.fetchone()
+            if row is None:
+                logger.critical(f"HD Wallet Index: Coin symbol {coin_symbol} still not found after INSERT OR IGNORE.")
+                conn.rollback()
+                raise sqlite3.OperationalError(f"Could not find or initialize index for coin {coin_symbol}. Critical error.")
+            current_index = row['last_used_index']
+            new_index = current_index + 1
+            cursor.execute("UPDATE hd_address_indices SET last_used_index = ? WHERE coin_symbol = ?", (new_index, coin_symbol))
+            conn.commit() # Commit the update
+            logger.info(f"HD Wallet Index: Next index for {coin_symbol} is {new_index} (old was {current_index}).")
+            return new_index
+        except sqlite3.Error as e:
+            logger.exception(f"HD Wallet Index: Database error for {coin_symbol}: {e}")
+            if conn:
+                try: conn.rollback()
+                except sqlite3.Error as rb_err:
+                    logger.exception(f"HD Wallet Index: Error during rollback for {coin_symbol}: {rb_err}")
+            raise
+
+# --- Row Cache ---
+# Small LRU of transaction and pending-payment rows, which are re-read several times while one payment
+# is checked. Every helper that writes those rows drops them from the cache after its commit; a
+# generation counter keeps a read that raced such a write from re-inserting the old row.
+# Finalization passes fresh=True and always reads the database.
+ROW_CACHE_SIZE = getattr(config, 'ROW_CACHE_SIZE', 512) # Rows kept; 0 disables the cache
+
+class _RowCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._rows = collections.OrderedDict() # ('transaction' | 'payment', transaction_id) -> sqlite3.Row
+        self._payment_keys = {}                # payment_id -> transaction_id of a cached 'payment' row
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = self.misses = self.bypasses = self.invalidations = 0
+
+    def lookup(self, key: tuple, fresh: bool) -> tuple[sqlite3.Row | None, int]:
+        with self._lock:
+            if fresh or self.max_entries <= 0:
+                self.bypasses += 1
+                return None, self._generation
+            row = self._rows.get(key)
+            if row is None:
+                self.misses += 1
+            else:
+                self._rows.move_to_end(key)
+                self.hits += 1
+            return row, self._generation
+
+    def store(self, key: tuple, row: sqlite3.Row | None, generation: int):
+        if row is None or self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation != self._generation: # A write committed while this row was being read
+                return
+            self._rows[key] = row
+            self._rows.move_to_end(key)
+            if key[0] == 'payment':
+                self._payment_keys[row['payment_id']] = key[1]
+            while len(self._rows) > self.max_entries:
+                self._forget(*self._rows.popitem(last=False))
+
+    def _forget(self, key: tuple, row: sqlite3.Row):
+        if key[0] == 'payment':
+            self._payment_keys.pop(row['payment_id'], None)
+
+    def invalidate(self, transaction_ids=(), payment_ids=()):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            keys = [('payment', self._payment_keys[pid]) for pid in payment_ids if pid in self._payment_keys]
+            for transaction_id in transaction_ids:
+                keys += [('transaction', transaction_id), ('payment', transaction_id)]
+            for key in keys:
+                row = self._rows.pop(key, None)
+                if row is not None:
+                    self._forget(key, row)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._rows), 'max_entries': self.max_entries, 'hits': self.hits, 'misses': self.misses,
+                    'bypasses': self.bypasses, 'invalidations': self.invalidations,
+                    'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0}
+
+_row_cache = _RowCache(ROW_CACHE_SIZE)
+
+def _cached_row(key: tuple, fresh: bool, load):
+    row, generation = _row_cache.lookup(key, fresh)
+    if row is None:
+        row = load()
+        _row_cache.store(key, row, generation)
+    return row
+
+def invalidate_row_cache(transaction_ids=(), payment_ids=()):
+    """For code that writes transactions / pending_crypto_payments itself. Call after the commit."""
+    _row_cache.invalidate(transaction_ids, payment_ids)
+
+def get_row_cache_stats() -> dict:
+    return _row_cache.stats()
 
 # --- Pending Crypto Payments CRUD ---
-def create_pending_payment(transaction_id: int, user_id: int, address: str, coin_symbol: str,
-                           network: str | None, expected_crypto_amount: str, expires_at: datetime.datetime,
-                           paid_from_balance_eur: float = 0.0, status: str = 'monitoring') -> int | None:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    now_iso = datetime.datetime.utcnow().isoformat()
-    expires_at_iso = expires_at.isoformat()
-    try:
-        cursor.execute("""
-            INSERT INTO pending_crypto_payments
-            (transaction_id, user_id, address, coin_symbol, network, expected_crypto_amount, paid_from_balance_eur, status, created_at, last_checked_at, expires_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (transaction_id, user_id, address, coin_symbol, network, expected_crypto_amount, paid_from_balance_eur, status, now_iso, now_iso, expires_at_iso))
-        payment_id = cursor.lastrowid
-        conn.commit()
-        logger.info(f"Created pending payment record ID {payment_id} for main tx {transaction_id}, address {address}, paid_from_balance_eur: {paid_from_balance_eur}.")
-        return payment_id
-    except sqlite3.IntegrityError as e:
-        logger.error(f"Integrity Error: Attempted to create duplicate pending payment for main tx {transaction_id}, address {address}. This transaction ID likely already has a pending payment entry. Error: {e}")
-        conn.rollback()
-        return None
-    except sqlite3.Error as e:
-        logger.exception(f"Failed to create pending payment for main tx {transaction_id}, address {address}: {e}")
-        conn.rollback()
-        return None
-    finally:
-        conn.close()
+# Payment and ticket times are INTEGER Unix epoch seconds (UTC), so range filters compare plain integers on
+# (status, time) indexes. Transactions, ledger and ticket message times stay ISO text.
+MONITOR_RECHECK_SECONDS = getattr(config, 'MONITOR_RECHECK_SECONDS', 60) # A monitored payment is re-queried no sooner than this
 
-def get_pending_payments_to_monitor(limit: int = 100) -> list[sqlite3.Row]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            SELECT * FROM pending_crypto_payments
-            WHERE status = 'monitoring' AND datetime('now', 'utc') < expires_at
-            ORDER BY last_checked_at ASC NULLS FIRST, created_at ASC
-            LIMIT ?
-        """, (limit,))
-        payments = cursor.fetchall()
-        logger.debug(f"Fetched {len(payments)} pending payments to monitor.")
-        return payments
-    except sqlite3.Error as e:
-        logger.exception(f"Failed to fetch pending payments to monitor: {e}")
-        return []
-    finally:
-        conn.close()
+def to_epoch(dt: datetime.datetime) -> int:
+    """Epoch seconds of a datetime. Naive values are UTC, as produced by datetime.utcnow()."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp())
 
-def update_pending_payment_check_details(payment_id: int, confirmations: int, received_amount: str | None = None, blockchain_tx_id: str | None = None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    now_iso = datetime.datetime.utcnow().isoformat()
-    try:
-        if received_amount is not None and blockchain_tx_id is not None:
+def from_epoch(seconds: int) -> datetime.datetime:
+    """Naive UTC datetime for an epoch-seconds column, comparable with datetime.utcnow()."""
+    return datetime.datetime.utcfromtimestamp(seconds)
+
+def create_pending_payment(transaction_id: int, user_id: int, address: str, coin_symbol: str,
+                           network: str | None, expected_crypto_units: int, expires_at: datetime.datetime,
+                           paid_from_balance_cents: int = 0, status: str = 'monitoring') -> int | None:
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        now = int(time.time())
+        try:
             cursor.execute("""
-                UPDATE pending_crypto_payments
-                SET last_checked_at = ?, confirmations = ?, received_crypto_amount = ?, blockchain_tx_id = ?
-                WHERE payment_id = ?
-            """, (now_iso, confirmations, received_amount, blockchain_tx_id, payment_id))
-        else:
+                INSERT INTO pending_crypto_payments
+                (transaction_id, user_id, address, coin_symbol, network, expected_crypto_units, paid_from_balance_cents, status,
+                 created_at, last_checked_at, next_check_at, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (transaction_id, user_id, address, coin_symbol, network, expected_crypto_units, paid_from_balance_cents, status,
+                  now, now, now, to_epoch(expires_at)))
+            payment_id = cursor.lastrowid
+            conn.commit()
+            _row_cache.invalidate(transaction_ids=(transaction_id,))
+            logger.info(f"Created pending payment record ID {payment_id} for main tx {transaction_id}, address {address}, paid_from_balance_cents: {paid_from_balance_cents}.")
+            return payment_id
+        except sqlite3.IntegrityError as e:
+            logger.error(f"Integrity Error: Attempted to create duplicate pending payment for main tx {transaction_id}, address {address}. This transaction ID likely already has a pending payment entry. Error: {e}")
+            conn.rollback()
+            return None
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to create pending payment for main tx {transaction_id}, address {address}: {e}")
+            conn.rollback()
+            return None
+
+def get_pending_payments_to_monitor(limit: int = 100) -> list[sqlite3.Row]:
+    """Unexpired 'monitoring' payments due for a blockchain check, longest-waiting first (a range of idx_pending_payments_status_next_check)."""
+    now = int(time.time())
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
             cursor.execute("""
-                UPDATE pending_crypto_payments
-                SET last_checked_at = ?, confirmations = ?
-                WHERE payment_id = ?
-            """, (now_iso, confirmations, payment_id))
-        conn.commit()
-        logger.info(f"Updated check details for pending payment ID {payment_id}. Confirmations: {confirmations}.")
-        return cursor.rowcount > 0
-    except sqlite3.Error as e:
-        logger.exception(f"Failed to update check details for pending payment ID {payment_id}: {e}")
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+                SELECT * FROM pending_crypto_payments
+                WHERE status = 'monitoring' AND next_check_at <= ? AND expires_at > ?
+                ORDER BY next_check_at ASC
+                LIMIT ?
+            """, (now, now, limit))
+            payments = cursor.fetchall()
+            logger.debug(f"Fetched {len(payments)} pending payments to monitor.")
+            return payments
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to fetch pending payments to monitor: {e}")
+            return []
+
+def update_pending_payment_check_details(payment_id: int, confirmations: int, received_units: int | None = None, blockchain_tx_id: str | None = None):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        now = int(time.time())
+        try:
+            if received_units is not None and blockchain_tx_id is not None:
+                cursor.execute("""
+                    UPDATE pending_crypto_payments
+                    SET last_checked_at = ?, next_check_at = ?, confirmations = ?, received_crypto_units = ?, blockchain_tx_id = ?
+                    WHERE payment_id = ?
+                """, (now, now + MONITOR_RECHECK_SECONDS, confirmations, received_units, blockchain_tx_id, payment_id))
+            else:
+                cursor.execute("""
+                    UPDATE pending_crypto_payments
+                    SET last_checked_at = ?, next_check_at = ?, confirmations = ?
+                    WHERE payment_id = ?
+                """, (now, now + MONITOR_RECHECK_SECONDS, confirmations, payment_id))
+            conn.commit()
+            _row_cache.invalidate(payment_ids=(payment_id,))
+            logger.info(f"Updated check details for pending payment ID {payment_id}. Confirmations: {confirmations}.")
+            return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to update check details for pending payment ID {payment_id}: {e}")
+            conn.rollback()
+            return False
 
-def update_pending_payment_status(payment_id: int, new_status: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    now_iso = datetime.datetime.utcnow().isoformat()
-    try:
-        cursor.execute("""
-            UPDATE pending_crypto_payments
-            SET status = ?, last_checked_at = ?
-            WHERE payment_id = ?
-        """, (new_status, now_iso, payment_id))
-        conn.commit()
-        if cursor.rowcount > 0:
-            logger.info(f"Updated status for pending payment ID {payment_id} to {new_status}.")
-        else:
-            logger.warning(f"No pending payment found with ID {payment_id} to update status to {new_status}.")
-        return cursor.rowcount > 0
-    except sqlite3.Error as e:
-        logger.exception(f"Failed to update status for pending payment ID {payment_id}: {e}")
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+def update_pending_payment_status(payment_id: int, new_status: str, expected_status: str | None = None):
+    """
+    Sets the payment's status. With expected_status the update only applies while the row is still in
+    that status, so a status another worker set in the meantime is not overwritten.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            sql = "UPDATE pending_crypto_payments SET status = ?, last_checked_at = ? WHERE payment_id = ?"
+            params = [new_status, int(time.time()), payment_id]
+            if expected_status is not None:
+                sql += " AND status = ?"
+                params.append(expected_status)
+            cursor.execute(sql, params)
+            conn.commit()
+            _row_cache.invalidate(payment_ids=(payment_id,))
+            if cursor.rowcount > 0:
+                logger.info(f"Updated status for pending payment ID {payment_id} to {new_status}.")
+            elif expected_status is not None:
+                logger.info(f"Pending payment ID {payment_id} is no longer '{expected_status}'; not setting it to {new_status}.")
+            else:
+                logger.warning(f"No pending payment found with ID {payment_id} to update status to {new_status}.")
+            return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to update status for pending payment ID {payment_id}: {e}")
+            conn.rollback()
+            return False
+
+def apply_pending_payment_updates(check_updates: list[tuple], status_updates: list[tuple]) -> bool:
+    """
+    Applies a batch of monitor bookkeeping writes in a single transaction.
+    check_updates: (last_checked_at, next_check_at, confirmations, received_units | None, blockchain_tx_id | None, payment_id)
+    status_updates: (new_status, last_checked_at, payment_id, expected_current_status)
+    Times are epoch seconds.
+    Status changes are only applied while the row is still in the status the monitor read, so a
+    concurrent on-demand check that already moved the payment on is not overwritten.
+    """
+    if not check_updates and not status_updates:
+        return True
+    with db_connection() as conn:
+        try:
+            if check_updates:
+                conn.executemany("""
+                    UPDATE pending_crypto_payments
+                    SET last_checked_at = ?, next_check_at = ?, confirmations = ?,
+                        received_crypto_units = COALESCE(?, received_crypto_units),
+                        blockchain_tx_id = COALESCE(?, blockchain_tx_id)
+                    WHERE payment_id = ?
+                """, check_updates)
+            if status_updates:
+                conn.executemany("""
+                    UPDATE pending_crypto_payments
+                    SET status = ?, last_checked_at = ?
+                    WHERE payment_id = ? AND status = ?
+                """, status_updates)
+            conn.commit()
+            _row_cache.invalidate(payment_ids=[u[5] for u in check_updates] + [u[2] for u in status_updates])
+            logger.info(f"Flushed {len(check_updates)} check detail update(s) and {len(status_updates)} status update(s) for pending payments.")
+            return True
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to flush batched pending payment updates: {e}")
+            conn.rollback()
+            return False
 
 def get_confirmed_unprocessed_payments(limit: int = 100) -> list[sqlite3.Row]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            SELECT * FROM pending_crypto_payments
-            WHERE status = 'confirmed_unprocessed'
-            ORDER BY created_at ASC
-            LIMIT ?
-        """, (limit,))
-        payments = cursor.fetchall()
-        logger.debug(f"Fetched {len(payments)} confirmed_unprocessed payments.")
-        return payments
-    except sqlite3.Error as e:
-        logger.exception(f"Failed to fetch confirmed_unprocessed payments: {e}")
-        return []
-    finally:
-        conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT * FROM pending_crypto_payments
+                WHERE status = 'confirmed_unprocessed'
+                ORDER BY created_at ASC
+                LIMIT ?
+            """, (limit,))
+            payments = cursor.fetchall()
+            logger.debug(f"Fetched {len(payments)} confirmed_unprocessed payments.")
+            return payments
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to fetch confirmed_unprocessed payments: {e}")
+            return []
+
+# --- Payment Finalization Claims ---
+# A confirmed payment is finalized by exactly one worker. claim_confirmed_payments() atomically moves
+# it to 'finalizing', so only one thread or process gets it. begin_payment_finalization() then records
+# it in payment_finalizations before any side effect; that insert can succeed only once per payment_id.
+# A claim whose worker died before that point is handed back after FINALIZATION_CLAIM_TIMEOUT_SECONDS.
+# One that died after it stays 'finalizing' for manual review, because the credit or item move may
+# already have happened.
+FINALIZATION_CLAIM_TIMEOUT_SECONDS = getattr(config, 'FINALIZATION_CLAIM_TIMEOUT_SECONDS', 600)
+
+def claim_confirmed_payments(limit: int = 20) -> list[sqlite3.Row]:
+    """Moves up to `limit` 'confirmed_unprocessed' payments (oldest first) to 'finalizing' and returns them."""
+    now = int(time.time())
+    with db_connection() as conn:
+        try:
+            claimed = conn.execute("""
+                UPDATE pending_crypto_payments SET status = 'finalizing', last_checked_at = ?
+                WHERE status = 'confirmed_unprocessed' AND payment_id IN (
+                    SELECT payment_id FROM pending_crypto_payments
+                    WHERE status = 'confirmed_unprocessed'
+                    ORDER BY created_at ASC
+                    LIMIT ?
+                )
+                RETURNING *
+            """, (now, limit)).fetchall()
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to claim confirmed payments: {e}")
+            conn.rollback()
+            return []
+    if claimed:
+        _row_cache.invalidate(payment_ids=[row['payment_id'] for row in claimed])
+        logger.info(f"Claimed {len(claimed)} confirmed payment(s) for finalization.")
+    return sorted(claimed, key=lambda row: row['created_at'])
+
+def begin_payment_finalization(payment_id: int, transaction_id: int) -> bool:
+    """Records that payment_id is being finalized. False if it already was (or the record could not be written): do nothing."""
+    with db_connection() as conn:
+        try:
+            cursor = conn.execute("""
+                INSERT INTO payment_finalizations (payment_id, transaction_id, started_at) VALUES (?, ?, ?)
+                ON CONFLICT (payment_id) DO NOTHING
+            """, (payment_id, transaction_id, datetime.datetime.utcnow().isoformat()))
+            conn.commit()
+            return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to record finalization start for payment {payment_id}: {e}")
+            conn.rollback()
+            return False
 
-def get_pending_payment_by_transaction_id(transaction_id: int) -> sqlite3.Row | None:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT * FROM pending_crypto_payments WHERE transaction_id = ?", (transaction_id,))
-        payment = cursor.fetchone()
-        return payment
-    except sqlite3.Error as e:
-        logger.exception(f"Failed to fetch pending payment by transaction_id {transaction_id}: {e}")
-        return None
-    finally:
-        conn.close()
+def finish_payment_finalization(payment_id: int, final_status: str) -> bool:
+    """Sets the payment's final status and closes its finalization record in one transaction."""
+    now_iso = datetime.datetime.utcnow().isoformat()
+    with db_connection() as conn:
+        try:
+            conn.execute("UPDATE payment_finalizations SET finished_at = ?, outcome = ? WHERE payment_id = ?",
+                         (now_iso, final_status, payment_id))
+            conn.execute("UPDATE pending_crypto_payments SET status = ?, last_checked_at = ? WHERE payment_id = ?",
+                         (final_status, int(time.time()), payment_id))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to finish finalization of payment {payment_id} as '{final_status}': {e}")
+            conn.rollback()
+            return False
+    _row_cache.invalidate(payment_ids=(payment_id,))
+    return True
+
+def get_payment_finalization(payment_id: int) -> sqlite3.Row | None:
+    with db_connection() as conn:
+        try:
+            return conn.execute("SELECT * FROM payment_finalizations WHERE payment_id = ?", (payment_id,)).fetchone()
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to fetch finalization record for payment {payment_id}: {e}")
+            return None
+
+def release_stale_finalization_claims(timeout_seconds: int = FINALIZATION_CLAIM_TIMEOUT_SECONDS) -> int:
+    """Returns abandoned claims (no finalization record, claimed longer than timeout_seconds ago) to the queue."""
+    cutoff = int(time.time()) - timeout_seconds
+    with db_connection() as conn:
+        try:
+            released = conn.execute("""
+                UPDATE pending_crypto_payments SET status = 'confirmed_unprocessed'
+                WHERE status = 'finalizing' AND last_checked_at < ?
+                  AND NOT EXISTS (SELECT 1 FROM payment_finalizations f WHERE f.payment_id = pending_crypto_payments.payment_id)
+                RETURNING payment_id
+            """, (cutoff,)).fetchall()
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to release stale finalization claims: {e}")
+            conn.rollback()
+            return 0
+    if released:
+        _row_cache.invalidate(payment_ids=[row['payment_id'] for row in released])
+        logger.warning(f"Released {len(released)} abandoned finalization claim(s): {[row['payment_id'] for row in released]}")
+    return len(released)
+
+def get_pending_payment_by_transaction_id(transaction_id: int, fresh: bool = False) -> sqlite3.Row | None:
+    """Served from the row cache unless fresh=True."""
+    def load():
+        with db_connection() as conn:
+            try:
+                return conn.execute("SELECT * FROM pending_crypto_payments WHERE transaction_id = ?", (transaction_id,)).fetchone()
+            except sqlite3.Error as e:
+                logger.exception(f"Failed to fetch pending payment by transaction_id {transaction_id}: {e}")
+                return None
+    return _cached_row(('payment', transaction_id), fresh, load)
 
 def get_pending_payment_by_address(address: str) -> sqlite3.Row | None:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT * FROM pending_crypto_payments WHERE address = ?", (address,))
-        payment = cursor.fetchone()
-        return payment
-    except sqlite3.Error as e:
-        logger.exception(f"Failed to fetch pending payment by address {address}: {e}")
-        return None
-    finally:
-        conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT * FROM pending_crypto_payments WHERE address = ?", (address,))
+            payment = cursor.fetchone()
+            return payment
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to fetch pending payment by address {address}: {e}")
+            return None
 
 def get_stale_monitoring_payments(limit: int = 100) -> list[sqlite3.Row]:
-    """Fetches 'monitoring' payments that have passed their 'expires_at' time."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        # Using datetime('now', 'utc') for SQLite to compare with stored ISO8601 strings
-        # Ensure expires_at is stored in a format comparable by SQLite's datetime functions
-        cursor.execute("""
-            SELECT payment_id, user_id, transaction_id, address
-            FROM pending_crypto_payments
-            WHERE status = 'monitoring' AND datetime('now', 'utc') >= expires_at
-            ORDER BY created_at ASC
-            LIMIT ?
-        """, (limit,))
-        payments = cursor.fetchall()
-        logger.debug(f"Fetched {len(payments)} stale monitoring payments.")
-        return payments
-    except sqlite3.Error as e:
-        logger.exception(f"Failed to fetch stale monitoring payments: {e}")
-        return []
-    finally:
-        conn.close()
+    """Fetches 'monitoring' payments that have passed their 'expires_at' time, earliest expiry first."""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT payment_id, user_id, transaction_id, address
+                FROM pending_crypto_payments
+                WHERE status = 'monitoring' AND expires_at <= ?
+                ORDER BY expires_at ASC
+                LIMIT ?
+            """, (int(time.time()), limit))
+            payments = cursor.fetchall()
+            logger.debug(f"Fetched {len(payments)} stale monitoring payments.")
+            return payments
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to fetch stale monitoring payments: {e}")
+            return []
 
 # --- General Transaction Functions (Product functions removed/to be removed) ---
 
 # get_cities_with_available_items, get_available_items_in_city, get_product_details_by_id
 # are removed as they relied on the 'products' table. Product listing is now FS based.
 
-def update_user_balance(user_id, new_balance, increment_transactions=True):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    if increment_transactions:
-        cursor.execute("""
-            UPDATE users
-            SET balance = ?, transaction_count = transaction_count + 1
-            WHERE user_id = ?
-        """, (new_balance, user_id))
+def _apply_balance_delta(user_id: int, delta_cents: int, reason: str, transaction_id: int | None,
+                         increment_transactions: bool, require_sufficient: bool) -> int | None:
+    """
+    One conditional UPDATE ... RETURNING plus its ledger_entries row, committed together. The read-modify-write
+    happens inside SQLite, so concurrent deltas never overwrite each other, and the ledger never misses a change.
+    """
+    query = """
+        UPDATE users
+        SET balance_cents = balance_cents + ?, transaction_count = transaction_count + ?
+        WHERE user_id = ?
+    """
+    params = [delta_cents, 1 if increment_transactions else 0, user_id]
+    if require_sufficient:
+        query += " AND balance_cents + ? >= 0"
+        params.append(delta_cents)
+    query += " RETURNING balance_cents"
+    with db_connection() as conn:
+        try:
+            row = conn.execute(query, params).fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+            conn.execute("""
+                INSERT INTO ledger_entries (user_id, delta_cents, balance_after_cents, reason, transaction_id, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (user_id, delta_cents, row['balance_cents'], reason, transaction_id, datetime.datetime.utcnow().isoformat()))
+            conn.commit()
+            return row['balance_cents']
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to apply balance delta {delta_cents} ({reason}) for user {user_id}: {e}")
+            conn.rollback()
+            return None
+
+def credit_balance(user_id: int, delta_cents: int, reason: str, transaction_id: int | None = None,
+                   increment_transactions: bool = False) -> int | None:
+    """
+    Adds delta_cents to the user's balance and records a ledger entry (reason, optional transaction_id).
+    Returns the new balance in cents, or None if the user does not exist or on error.
+    """
+    if delta_cents < 0:
+        raise ValueError(f"credit_balance expects a non-negative amount, got {delta_cents}")
+    new_balance = _apply_balance_delta(user_id, delta_cents, reason, transaction_id, increment_transactions, require_sufficient=False)
+    if new_balance is not None:
+        logger.info(f"Credited {money.format_eur(delta_cents)} EUR to user {user_id} ({reason}, TXID {transaction_id}). New balance: {money.format_eur(new_balance)}. Transactions incremented: {increment_transactions}")
+    return new_balance
+
+def debit_balance_if_sufficient(user_id: int, delta_cents: int, reason: str, transaction_id: int | None = None,
+                                increment_transactions: bool = False) -> int | None:
+    """
+    Subtracts delta_cents from the user's balance only if the balance covers it, recording a ledger entry.
+    Returns the new balance in cents, or None if the balance is insufficient, the user does not exist, or on error.
+    """
+    if delta_cents < 0:
+        raise ValueError(f"debit_balance_if_sufficient expects a non-negative amount, got {delta_cents}")
+    new_balance = _apply_balance_delta(user_id, -delta_cents, reason, transaction_id, increment_transactions, require_sufficient=True)
+    if new_balance is None:
+        logger.warning(f"Debit of {money.format_eur(delta_cents)} EUR for user {user_id} ({reason}, TXID {transaction_id}) not applied (insufficient balance or unknown user).")
     else:
-        cursor.execute("UPDATE users SET balance = ? WHERE user_id = ?", (new_balance, user_id))
-    conn.commit()
-    conn.close()
-    logger.info(f"User {user_id} balance updated to {new_balance:.2f}. Transactions incremented: {increment_transactions}")
+        logger.info(f"Debited {money.format_eur(delta_cents)} EUR from user {user_id} ({reason}, TXID {transaction_id}). New balance: {money.format_eur(new_balance)}. Transactions incremented: {increment_transactions}")
+    return new_balance
 
-def record_transaction(user_id: int, type: str, eur_amount: float,
+def debit_balance_allowing_shortfall(user_id: int, delta_cents: int, reason: str, transaction_id: int | None = None) -> int | None:
+    """
+    Subtracts delta_cents even if the balance no longer covers it, for charges that are already owed (e.g. the
+    balance part of a purchase whose crypto part is confirmed). The covered part is recorded under `reason`; any
+    part that takes the balance below zero is recorded as a separate '<reason>_shortfall' ledger entry.
+    Returns the new (possibly negative) balance in cents, or None if the user does not exist or on error.
+    """
+    if delta_cents < 0:
+        raise ValueError(f"debit_balance_allowing_shortfall expects a non-negative amount, got {delta_cents}")
+    with db_connection() as conn:
+        try:
+            row = conn.execute("UPDATE users SET balance_cents = balance_cents - ? WHERE user_id = ? RETURNING balance_cents",
+                               (delta_cents, user_id)).fetchone()
+            if row is None:
+                conn.rollback()
+                logger.warning(f"Debit of {money.format_eur(delta_cents)} EUR for unknown user {user_id} ({reason}, TXID {transaction_id}) not applied.")
+                return None
+            new_balance = row['balance_cents']
+            shortfall = min(delta_cents, max(0, -new_balance))
+            covered = delta_cents - shortfall
+            now = datetime.datetime.utcnow().isoformat()
+            entries = []
+            if covered or not shortfall:
+                entries.append((user_id, -covered, new_balance + shortfall, reason, transaction_id, now))
+            if shortfall:
+                entries.append((user_id, -shortfall, new_balance, f"{reason}_shortfall", transaction_id, now))
+            conn.executemany("""
+                INSERT INTO ledger_entries (user_id, delta_cents, balance_after_cents, reason, transaction_id, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, entries)
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to debit {delta_cents} ({reason}) for user {user_id}: {e}")
+            conn.rollback()
+            return None
+    if shortfall:
+        logger.warning(f"Debited {money.format_eur(delta_cents)} EUR from user {user_id} ({reason}, TXID {transaction_id}); "
+                       f"balance short by {money.format_eur(shortfall)} EUR. New balance: {money.format_eur(new_balance)}.")
+    else:
+        logger.info(f"Debited {money.format_eur(delta_cents)} EUR from user {user_id} ({reason}, TXID {transaction_id}). New balance: {money.format_eur(new_balance)}.")
+    return new_balance
+
+# --- Balance Ledger ---
+# ledger_entries is append-only; balance_snapshots periodically records each user's balance as of a
+# given entry, so point-in-time balances and audits only sum the entries after the nearest snapshot.
+LEDGER_SNAPSHOT_MIN_ENTRIES = getattr(config, 'LEDGER_SNAPSHOT_MIN_ENTRIES', 20)
+
+def _latest_snapshot(conn: sqlite3.Connection, user_id: int, as_of_iso: str | None = None) -> sqlite3.Row | None:
+    if as_of_iso is None:
+        return conn.execute("""
+            SELECT last_entry_id, balance_cents FROM balance_snapshots
+            WHERE user_id = ? ORDER BY last_entry_id DESC LIMIT 1
+        """, (user_id,)).fetchone()
+    return conn.execute("""
+        SELECT last_entry_id, balance_cents FROM balance_snapshots
+        WHERE user_id = ? AND created_at <= ? ORDER BY created_at DESC, last_entry_id DESC LIMIT 1
+    """, (user_id, as_of_iso)).fetchone()
+
+def get_balance_at(user_id: int, as_of: datetime.datetime) -> int | None:
+    """Recomputes the user's balance in cents as of `as_of` (UTC) from the nearest earlier snapshot plus later ledger entries."""
+    as_of_iso = as_of.isoformat()
+    with db_connection() as conn:
+        try:
+            snapshot = _latest_snapshot(conn, user_id, as_of_iso)
+            base_cents, after_entry_id = (snapshot['balance_cents'], snapshot['last_entry_id']) if snapshot else (0, 0)
+            row = conn.execute("""
+                SELECT COALESCE(SUM(delta_cents), 0) AS delta_cents FROM ledger_entries
+                WHERE user_id = ? AND entry_id > ? AND created_at <= ?
+            """, (user_id, after_entry_id, as_of_iso)).fetchone()
+            return base_cents + row['delta_cents']
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to compute balance at {as_of_iso} for user {user_id}: {e}")
+            return None
+
+def reconcile_user_balance(user_id: int) -> tuple[int, int] | None:
+    """
+    Returns (materialized users.balance_cents, balance recomputed from the latest snapshot and the entries after it).
+    The two differ only if the balance was changed outside the credit_balance/debit_balance_* helpers. None if unknown user or on error.
+    """
+    with db_connection() as conn:
+        try:
+            user_row = conn.execute("SELECT balance_cents FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if user_row is None:
+                return None
+            snapshot = _latest_snapshot(conn, user_id)
+            base_cents, after_entry_id = (snapshot['balance_cents'], snapshot['last_entry_id']) if snapshot else (0, 0)
+            row = conn.execute("""
+                SELECT COALESCE(SUM(delta_cents), 0) AS delta_cents FROM ledger_entries
+                WHERE user_id = ? AND entry_id > ?
+            """, (user_id, after_entry_id)).fetchone()
+            recomputed = base_cents + row['delta_cents']
+            if recomputed != user_row['balance_cents']:
+                logger.warning(f"Balance mismatch for user {user_id}: stored {user_row['balance_cents']} cents, ledger {recomputed} cents.")
+            return user_row['balance_cents'], recomputed
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to reconcile balance for user {user_id}: {e}")
+            return None
+
+def create_balance_snapshots(min_new_entries: int = LEDGER_SNAPSHOT_MIN_ENTRIES) -> int:
+    """
+    Writes a snapshot for every user with at least min_new_entries ledger entries since their last snapshot.
+    Each snapshot is the previous snapshot plus the summed deltas, so it is derived from the ledger alone. Returns the count written.
+    """
+    now_iso = datetime.datetime.utcnow().isoformat()
+    with db_connection() as conn:
+        try:
+            cursor = conn.execute("""
+                INSERT INTO balance_snapshots (user_id, last_entry_id, balance_cents, created_at)
+                SELECT u.user_id, MAX(e.entry_id), COALESCE(bs.balance_cents, 0) + SUM(e.delta_cents), ?
+                FROM users u
+                LEFT JOIN balance_snapshots bs ON bs.user_id = u.user_id
+                    AND bs.last_entry_id = (SELECT MAX(last_entry_id) FROM balance_snapshots WHERE user_id = u.user_id)
+                JOIN ledger_entries e ON e.user_id = u.user_id AND e.entry_id > COALESCE(bs.last_entry_id, 0)
+                GROUP BY u.user_id
+                HAVING COUNT(*) >= ?
+            """, (now_iso, max(1, min_new_entries)))
+            conn.commit()
+            logger.info(f"Created {cursor.rowcount} balance snapshot(s) (threshold {min_new_entries} new entries).")
+            return cursor.rowcount
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to create balance snapshots: {e}")
+            conn.rollback()
+            return 0
+
+def find_balance_discrepancies() -> list[dict]:
+    """Audit: users whose stored balance differs from latest snapshot + later ledger entries. Touches only post-snapshot entries."""
+    with db_connection() as conn:
+        try:
+            rows = conn.execute("""
+                SELECT u.user_id, u.balance_cents,
+                       COALESCE(bs.balance_cents, 0) + COALESCE((
+                           SELECT SUM(e.delta_cents) FROM ledger_entries e
+                           WHERE e.user_id = u.user_id AND e.entry_id > COALESCE(bs.last_entry_id, 0)
+                       ), 0) AS ledger_cents
+                FROM users u
+                LEFT JOIN balance_snapshots bs ON bs.user_id = u.user_id
+                    AND bs.last_entry_id = (SELECT MAX(last_entry_id) FROM balance_snapshots WHERE user_id = u.user_id)
+            """).fetchall()
+            discrepancies = [{'user_id': r['user_id'], 'balance_cents': r['balance_cents'], 'ledger_cents': r['ledger_cents']}
+                             for r in rows if r['balance_cents'] != r['ledger_cents']]
+            if discrepancies:
+                logger.warning(f"Balance audit found {len(discrepancies)} user(s) whose balance does not match the ledger.")
+            return discrepancies
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to audit balances against the ledger: {e}")
+            return []
+
+def record_transaction(user_id: int, type: str, eur_amount_cents: int,
                        item_details_json: str | None = None, # New field for FS-based item info
                        crypto_amount: str | None = None, currency: str | None = None,
                        payment_status: str = 'pending',
-                       original_add_balance_amount: float | None = None, notes: str | None = None) -> int | None:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            INSERT INTO transactions
-                (user_id, item_details_json, type, eur_amount, crypto_amount, currency,
-                 payment_status, original_add_balance_amount, notes, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-        """, (user_id, item_details_json, type, eur_amount, crypto_amount, currency,
-              payment_status, original_add_balance_amount, notes))
-        transaction_id = cursor.lastrowid
-        conn.commit()
-        item_info_log = f", ItemDetails: {item_details_json[:50]}..." if item_details_json else ""
-        logger.info(f"Transaction recorded: ID {transaction_id} for user {user_id}, type {type}, status {payment_status}{item_info_log}")
-        return transaction_id
-    except sqlite3.Error as e:
-        logger.exception(f"Failed to record transaction for user {user_id}, type {type}: {e}")
-        conn.rollback()
-        return None
-    finally:
-        conn.close()
+                       original_add_balance_cents: int | None = None, notes: str | None = None) -> int | None:
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                INSERT INTO transactions
+                    (user_id, item_details_json, type, eur_amount_cents, crypto_amount, currency,
+                     payment_status, original_add_balance_cents, notes, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+            """, (user_id, item_details_json, type, eur_amount_cents, crypto_amount, currency,
+                  payment_status, original_add_balance_cents, notes))
+            transaction_id = cursor.lastrowid
+            conn.commit()
+            item_info_log = f", ItemDetails: {item_details_json[:50]}..." if item_details_json else ""
+            logger.info(f"Transaction recorded: ID {transaction_id} for user {user_id}, type {type}, status {payment_status}{item_info_log}")
+            return transaction_id
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to record transaction for user {user_id}, type {type}: {e}")
+            conn.rollback()
+            return None
 
-def get_transaction_by_id(transaction_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM transactions WHERE transaction_id = ?", (transaction_id,))
-    transaction = cursor.fetchone()
-    conn.close()
-    return transaction
+def get_transaction_by_id(transaction_id, fresh: bool = False):
+    """Served from the row cache unless fresh=True."""
+    def load():
+        with db_connection() as conn:
+            return conn.execute("SELECT * FROM transactions WHERE transaction_id = ?", (transaction_id,)).fetchone()
+    return _cached_row(('transaction', transaction_id), fresh, load)
 
 def update_transaction_status(transaction_id, status, notes: str | None = None) -> bool:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        if notes is not None:
-            cursor.execute("""
-                UPDATE transactions
-                SET payment_status = ?, notes = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE transaction_id = ?
-            """, (status, notes, transaction_id))
-        else:
-            cursor.execute("""
-                UPDATE transactions
-                SET payment_status = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE transaction_id = ?
-            """, (status, transaction_id))
-        conn.commit()
-        if cursor.rowcount == 0:
-            logger.warning(f"update_transaction_status did not update any row for TXID {transaction_id}.")
-        else:
-            logger.info(f"Transaction {transaction_id} status updated to {status}" + (f" with notes: {notes[:30]}..." if notes else ""))
-        return cursor.rowcount > 0
-    except sqlite3.Error as e:
-        logger.exception(f"Failed to update transaction status for TXID {transaction_id}: {e}")
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            if notes is not None:
+                cursor.execute("""
+                    UPDATE transactions
+                    SET payment_status = ?, notes = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE transaction_id = ?
+                """, (status, notes, transaction_id))
+            else:
+                cursor.execute("""
+                    UPDATE transactions
+                    SET payment_status = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE transaction_id = ?
+                """, (status, transaction_id))
+            conn.commit()
+            _row_cache.invalidate(transaction_ids=(transaction_id,))
+            if cursor.rowcount == 0:
+                logger.warning(f"update_transaction_status did not update any row for TXID {transaction_id}.")
+            else:
+                logger.info(f"Transaction {transaction_id} status updated to {status}" + (f" with notes: {notes[:30]}..." if notes else ""))
+            return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to update transaction status for TXID {transaction_id}: {e}")
+            conn.rollback()
+            return False
 
 # --- Ticket System Functions ---
 def get_open_ticket_for_user(user_id):
     logger.debug(f"Checking for open ticket for user_id: {user_id}")
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT * FROM support_tickets WHERE user_id = ? AND status = 'open' ORDER BY created_at DESC LIMIT 1",
-        (user_id,)
-    )
-    ticket = cursor.fetchone()
-    conn.close()
-    if ticket: logger.debug(f"Open ticket for user {user_id}: {ticket['ticket_id']}")
-    else: logger.debug(f"No open ticket for user {user_id}")
-    return ticket
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT * FROM support_tickets WHERE user_id = ? AND status = 'open' ORDER BY created_at DESC LIMIT 1",
+            (user_id,)
+        )
+        ticket = cursor.fetchone()
+        if ticket: logger.debug(f"Open ticket for user {user_id}: {ticket['ticket_id']}")
+        else: logger.debug(f"No open ticket for user {user_id}")
+        return ticket
+
+# Preview kept on support_tickets so list views never read ticket_messages.
+TICKET_MESSAGE_PREVIEW_CHARS = 100
+
+def _insert_ticket_message(cursor: sqlite3.Cursor, ticket_id: int, sender_type: str, message_text: str, created_at_iso: str,
+                           user_tg_message_id=None, admin_tg_message_id=None):
+    cursor.execute("""
+        INSERT INTO ticket_messages (ticket_id, sender, text, user_tg_message_id, admin_tg_message_id, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (ticket_id, sender_type, message_text, user_tg_message_id, admin_tg_message_id, created_at_iso))
 
 def create_new_ticket(user_id, initial_message_text, user_tg_message_id=None):
     logger.info(f"Creating new ticket for user {user_id}. Initial message snippet: {initial_message_text[:50]}")
-    current_time_iso = datetime.datetime.utcnow().isoformat()
-    message_obj = {
-        "sender": "user", "text": initial_message_text, "timestamp": current_time_iso,
-    }
-    if user_tg_message_id is not None:
-         message_obj["user_tg_message_id"] = user_tg_message_id
-    messages_json_str = json.dumps([message_obj])
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            """INSERT INTO support_tickets (user_id, status, created_at, last_message_at, messages_json)
-               VALUES (?, 'open', ?, ?, ?)""",
-            (user_id, current_time_iso, current_time_iso, messages_json_str)
-        )
-        ticket_id = cursor.lastrowid
-        conn.commit()
-        logger.info(f"New ticket {ticket_id} created for user {user_id}.")
-        return ticket_id
-    except sqlite3.Error as e:
-        logger.exception(f"SQLite error creating new ticket for user {user_id}: {e}")
-        conn.rollback()
-        return None
-    finally:
-        conn.close()
+    now = time.time()
+    current_time_iso = datetime.datetime.utcfromtimestamp(now).isoformat()
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """INSERT INTO support_tickets (user_id, status, created_at, last_message_at, message_count, last_message_preview)
+                   VALUES (?, 'open', ?, ?, 1, ?)""",
+                (user_id, int(now), int(now), initial_message_text[:TICKET_MESSAGE_PREVIEW_CHARS])
+            )
+            ticket_id = cursor.lastrowid
+            _insert_ticket_message(cursor, ticket_id, 'user', initial_message_text, current_time_iso,
+                                   user_tg_message_id=user_tg_message_id)
+            conn.commit()
+            logger.info(f"New ticket {ticket_id} created for user {user_id}.")
+            return ticket_id
+        except sqlite3.Error as e:
+            logger.exception(f"SQLite error creating new ticket for user {user_id}: {e}")
+            conn.rollback()
+            return None
 
 def add_message_to_ticket(ticket_id, sender_type, message_text, user_tg_message_id=None, admin_tg_message_id=None):
     logger.info(f"Adding message to ticket {ticket_id}. Sender: {sender_type}, Text snippet: {message_text[:50]}")
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT messages_json FROM support_tickets WHERE ticket_id = ?", (ticket_id,))
-        row = cursor.fetchone()
-        if row is None:
-            logger.error(f"Ticket {ticket_id} not found when trying to add message.")
+    now = time.time()
+    current_time_iso = datetime.datetime.utcfromtimestamp(now).isoformat()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                UPDATE support_tickets
+                SET message_count = message_count + 1, last_message_preview = ?, last_message_at = ?
+                WHERE ticket_id = ?
+            """, (message_text[:TICKET_MESSAGE_PREVIEW_CHARS], int(now), ticket_id))
+            if cursor.rowcount == 0:
+                logger.error(f"Ticket {ticket_id} not found when trying to add message.")
+                conn.rollback()
+                return False
+            _insert_ticket_message(cursor, ticket_id, sender_type, message_text, current_time_iso,
+                                   user_tg_message_id=user_tg_message_id, admin_tg_message_id=admin_tg_message_id)
+            conn.commit()
+            logger.debug(f"Message added to ticket {ticket_id} and committed.")
+            return True
+        except sqlite3.Error as e:
+            logger.exception(f"SQLite error adding message to ticket {ticket_id}: {e}")
+            conn.rollback()
             return False
 
-        messages_list = json.loads(row['messages_json']) if row['messages_json'] else []
-        current_time_iso_msg = datetime.datetime.utcnow().isoformat()
-        new_message_obj = {"sender": sender_type, "text": message_text, "timestamp": current_time_iso_msg}
-        if user_tg_message_id: new_message_obj["user_tg_message_id"] = user_tg_message_id
-        if admin_tg_message_id: new_message_obj["admin_tg_message_id"] = admin_tg_message_id
-        messages_list.append(new_message_obj)
-
-        current_time_iso_ticket_update = datetime.datetime.utcnow().isoformat()
-        cursor.execute(
-            "UPDATE support_tickets SET messages_json = ?, last_message_at = ? WHERE ticket_id = ?",
-            (json.dumps(messages_list), current_time_iso_ticket_update, ticket_id)
-        )
-        conn.commit()
-        success = cursor.rowcount > 0
-        if success: logger.debug(f"Message added to ticket {ticket_id} and committed.")
-        else: logger.warning(f"Failed to add message to ticket {ticket_id} (rowcount 0 after update).")
-        return success
-    except sqlite3.Error as e:
-        logger.exception(f"SQLite error adding message to ticket {ticket_id}: {e}")
-        conn.rollback()
-        return False
-    except json.JSONDecodeError as e_json:
-        logger.exception(f"JSON error processing messages for ticket {ticket_id}: {e_json}")
-        return False
-    finally:
-        conn.close()
+def get_ticket_messages(ticket_id: int) -> list[sqlite3.Row]:
+    """Messages of a ticket, oldest first."""
+    with db_connection() as conn:
+        try:
+            return conn.execute("""
+                SELECT sender, text, user_tg_message_id, admin_tg_message_id, created_at
+                FROM ticket_messages
+                WHERE ticket_id = ?
+                ORDER BY created_at, message_id
+            """, (ticket_id,)).fetchall()
+        except sqlite3.Error as e:
+            logger.exception(f"Error fetching messages for ticket {ticket_id}: {e}")
+            return []
 
 def get_all_open_tickets_admin():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT ticket_id, user_id, messages_json, last_message_at, status FROM support_tickets WHERE status = 'open' ORDER BY last_message_at ASC")
-    tickets = cursor.fetchall()
-    conn.close()
-    logger.debug(f"Fetched {len(tickets)} open tickets for admin.")
-    return tickets
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT ticket_id, user_id, last_message_preview, message_count, last_message_at, status
+            FROM support_tickets WHERE status = 'open' ORDER BY last_message_at ASC
+        """)
+        tickets = cursor.fetchall()
+        logger.debug(f"Fetched {len(tickets)} open tickets for admin.")
+        return tickets
 
 def get_ticket_details_by_id(ticket_id: int) -> sqlite3.Row | None:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT * FROM support_tickets WHERE ticket_id = ?", (ticket_id,))
-        ticket = cursor.fetchone()
-        return ticket
-    except sqlite3.Error as e:
-        logger.exception(f"Error fetching ticket details for ticket_id {ticket_id}: {e}")
-        return None
-    finally:
-        if conn: conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT * FROM support_tickets WHERE ticket_id = ?", (ticket_id,))
+            ticket = cursor.fetchone()
+            return ticket
+        except sqlite3.Error as e:
+            logger.exception(f"Error fetching ticket details for ticket_id {ticket_id}: {e}")
+            return None
 
 
 def update_ticket_status(ticket_id, new_status):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    current_time_iso = datetime.datetime.utcnow().isoformat()
-    try:
-        cursor.execute("UPDATE support_tickets SET status = ?, last_message_at = ? WHERE ticket_id = ?", (new_status, current_time_iso, ticket_id))
-        conn.commit()
-        updated_rows = cursor.rowcount
-        if updated_rows > 0: logger.info(f"Ticket {ticket_id} status updated to {new_status}.")
-        else: logger.warning(f"No ticket found with ID {ticket_id} to update status to {new_status}.")
-        return updated_rows > 0
-    except sqlite3.Error as e:
-        logger.exception(f"SQLite error updating status for ticket {ticket_id}: {e}")
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("UPDATE support_tickets SET status = ?, last_message_at = ? WHERE ticket_id = ?", (new_status, int(time.time()), ticket_id))
+            conn.commit()
+            updated_rows = cursor.rowcount
+            if updated_rows > 0: logger.info(f"Ticket {ticket_id} status updated to {new_status}.")
+            else: logger.warning(f"No ticket found with ID {ticket_id} to update status to {new_status}.")
+            return updated_rows > 0
+        except sqlite3.Error as e:
+            logger.exception(f"SQLite error updating status for ticket {ticket_id}: {e}")
+            conn.rollback()
+            return False
 
 def update_admin_ticket_view_message_id(ticket_id, message_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("UPDATE support_tickets SET admin_ticket_view_message_id = ? WHERE ticket_id = ?", (message_id, ticket_id))
-        conn.commit()
-        if cursor.rowcount > 0: logger.debug(f"Admin view message ID {message_id} stored for ticket {ticket_id}.")
-        return cursor.rowcount > 0
-    except sqlite3.Error as e:
-        logger.exception(f"SQLite error updating admin_ticket_view_message_id for ticket {ticket_id}: {e}")
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("UPDATE support_tickets SET admin_ticket_view_message_id = ? WHERE ticket_id = ?", (message_id, ticket_id))
+            conn.commit()
+            if cursor.rowcount > 0: logger.debug(f"Admin view message ID {message_id} stored for ticket {ticket_id}.")
+            return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            logger.exception(f"SQLite error updating admin_ticket_view_message_id for ticket {ticket_id}: {e}")
+            conn.rollback()
+            return False
 
 # get_all_products_admin is removed as 'products' table is gone. Admin will interact with FS.
 
-def expire_old_tickets():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    twenty_four_hours_ago_iso = (datetime.datetime.utcnow() - datetime.timedelta(hours=24)).isoformat()
-    expired_details = []
-    try:
-        cursor.execute("SELECT ticket_id, user_id FROM support_tickets WHERE status = 'open' AND last_message_at < ?", (twenty_four_hours_ago_iso,))
-        tickets_to_expire = cursor.fetchall()
-        if tickets_to_expire:
-            logger.info(f"Found {len(tickets_to_expire)} tickets to auto-expire.")
-            closure_time = datetime.datetime.utcnow().isoformat()
-            for ticket in tickets_to_expire:
-                cursor.execute("UPDATE support_tickets SET status = 'auto_expired', last_message_at = ? WHERE ticket['ticket_id'] = ?", (closure_time, ticket['ticket_id']))
-                expired_details.append({'ticket_id': ticket['ticket_id'], 'user_id': ticket['user_id']})
+TICKET_EXPIRY_HOURS = getattr(config, 'TICKET_EXPIRY_HOURS', 24)
+
+def expire_old_tickets(inactive_hours: float = TICKET_EXPIRY_HOURS) -> list[dict]:
+    """
+    Auto-expires every open ticket idle for inactive_hours in one UPDATE (served by
+    idx_support_tickets_status_last_message). Returns [{'ticket_id', 'user_id'}] of the expired tickets.
+    """
+    now = int(time.time())
+    cutoff = now - int(inactive_hours * 3600)
+    with db_connection() as conn:
+        try:
+            rows = conn.execute("""
+                UPDATE support_tickets SET status = 'auto_expired', last_message_at = ?
+                WHERE status = 'open' AND last_message_at < ?
+                RETURNING ticket_id, user_id
+            """, (now, cutoff)).fetchall()
             conn.commit()
-    except sqlite3.Error as e:
-        logger.exception(f"SQLite error in expire_old_tickets: {e}")
+        except sqlite3.Error as e:
+            logger.exception(f"SQLite error in expire_old_tickets: {e}")
+            conn.rollback()
+            return []
+    if rows:
+        logger.info(f"Auto-expired {len(rows)} tickets idle for more than {inactive_hours}h.")
+    return sorted((dict(row) for row in rows), key=lambda t: t['ticket_id'])
+
+# --- Admin Search ---
+# ticket_messages_fts and transactions_fts are kept in sync by triggers (see db_migrations).
+
+def _fts_match_query(query_text: str) -> str | None:
+    """Turns free admin input into a safe FTS5 query: every word must match, the last one as a prefix."""
+    words = re.findall(r'\w+', query_text)
+    if not words:
+        return None
+    quoted = [f'"{word}"' for word in words]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+def search_admin(query_text: str, limit: int = 10, offset: int = 0) -> list[sqlite3.Row]:
+    """
+    Ranked hits across ticket messages and transactions (notes, item names, blockchain txids), best first.
+    Rows have kind ('ticket' or 'transaction'), ref_id (ticket_id or transaction_id), user_id, snippet, rank.
+    """
+    match_query = _fts_match_query(query_text)
+    if match_query is None:
+        return []
+    top_n = offset + limit # The best offset+limit overall are within the best offset+limit of each index.
+    with db_connection() as conn:
+        try:
+            return conn.execute("""
+                WITH ticket_hits AS MATERIALIZED (
+                    SELECT rowid AS message_id, snippet(ticket_messages_fts, 0, '«', '»', '…', 12) AS snippet, rank
+                    FROM ticket_messages_fts WHERE ticket_messages_fts MATCH ? ORDER BY rank LIMIT ?
+                ),
+                transaction_hits AS MATERIALIZED (
+                    SELECT rowid AS transaction_id, snippet(transactions_fts, -1, '«', '»', '…', 12) AS snippet, rank
+                    FROM transactions_fts WHERE transactions_fts MATCH ? ORDER BY rank LIMIT ?
+                )
+                SELECT 'ticket' AS kind, tm.ticket_id AS ref_id, st.user_id, ticket_hits.snippet, ticket_hits.rank
+                FROM ticket_hits
+                JOIN ticket_messages tm ON tm.message_id = ticket_hits.message_id
+                JOIN support_tickets st ON st.ticket_id = tm.ticket_id
+                UNION ALL
+                SELECT 'transaction', t.transaction_id, t.user_id, transaction_hits.snippet, transaction_hits.rank
+                FROM transaction_hits
+                JOIN all_transactions t ON t.transaction_id = transaction_hits.transaction_id
+                ORDER BY rank
+                LIMIT ? OFFSET ?
+            """, (match_query, top_n, match_query, top_n, limit, offset)).fetchall()
+        except sqlite3.Error as e:
+            logger.exception(f"Admin search failed for query {query_text!r}: {e}")
+            return []
+
+# --- Daily Rollups ---
+# daily_rollups is kept current by triggers on transactions (see db_migrations), so dashboard reads
+# cost O(days x dimensions) regardless of how many transactions exist.
+ROLLUP_DIMENSIONS = ('day', 'type', 'coin', 'city')
+
+def get_rollup_summary(days: int = 30) -> dict[str, list[sqlite3.Row]]:
+    """
+    Completed transactions over the last `days` UTC days (today included), totalled per day, type, coin and city.
+    Returns {dimension: [Row(key, tx_count, eur_cents), ...]}; days newest first, other dimensions by revenue.
+    """
+    since = (datetime.datetime.utcnow().date() - datetime.timedelta(days=max(1, days) - 1)).isoformat()
+    summary = {}
+    with db_connection() as conn:
+        try:
+            for dimension in ROLLUP_DIMENSIONS:
+                order_by = 'key DESC' if dimension == 'day' else 'eur_cents DESC, key'
+                summary[dimension] = conn.execute(f"""
+                    SELECT {dimension} AS key, SUM(tx_count) AS tx_count, SUM(eur_cents) AS eur_cents
+                    FROM daily_rollups
+                    WHERE day >= ?
+                    GROUP BY {dimension}
+                    ORDER BY {order_by}
+                """, (since,)).fetchall()
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to read daily rollups for the last {days} days: {e}")
+            return {}
+    return summary
+
+# --- Job Queue ---
+# Durable work items for modules.job_queue. A worker claims due jobs by taking a lease on them in one
+# UPDATE ... RETURNING, so concurrent workers (threads or processes) never run the same job twice
+# unless a lease expires. Jobs with a dedupe_key are unique per key: enqueueing again only pulls the
+# existing job forward, which is how recurring jobs and "recheck in 30s" follow-ups stay single.
+# Times are Unix epoch seconds.
+
+def enqueue_job(kind: str, payload: dict | None = None, delay_seconds: float = 0, priority: int = 100,
+                dedupe_key: str | None = None, max_attempts: int = 5, lease_seconds: int = 300,
+                keep_existing: bool = False) -> int | None:
+    """
+    Queues a job to run after delay_seconds and returns its job_id (None on error).
+    If a job with the same dedupe_key exists it is reused: it runs at the earlier of the two times (or at
+    the new time if it is running right now), and a dead one is revived. With keep_existing=True an
+    existing job is left exactly as it is.
+    """
+    now = time.time()
+    row = (kind, json.dumps(payload or {}), now + max(0, delay_seconds), priority, max_attempts, lease_seconds, dedupe_key, now)
+    with db_connection() as conn:
+        try:
+            if keep_existing:
+                inserted = conn.execute("""
+                    INSERT INTO jobs (kind, payload, run_at, priority, max_attempts, lease_seconds, dedupe_key, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (dedupe_key) DO NOTHING
+                    RETURNING job_id
+                """, row).fetchone()
+                if inserted is None:
+                    inserted = conn.execute("SELECT job_id FROM jobs WHERE dedupe_key = ?", (dedupe_key,)).fetchone()
+            else:
+                inserted = conn.execute("""
+                    INSERT INTO jobs (kind, payload, run_at, priority, max_attempts, lease_seconds, dedupe_key, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (dedupe_key) DO UPDATE SET
+                        payload = excluded.payload,
+                        priority = MIN(jobs.priority, excluded.priority),
+                        run_at = CASE WHEN jobs.state = 'dead' OR jobs.lease_owner IS NOT NULL THEN excluded.run_at
+                                      ELSE MIN(jobs.run_at, excluded.run_at) END,
+                        attempts = CASE WHEN jobs.state = 'dead' THEN 0 ELSE jobs.attempts END,
+                        state = 'queued'
+                    RETURNING job_id
+                """, row).fetchone()
+            conn.commit()
+            return inserted['job_id'] if inserted else None
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to enqueue job '{kind}' (dedupe_key={dedupe_key}): {e}")
+            conn.rollback()
+            return None
+
+def claim_due_jobs(owner: str, limit: int = 1) -> list[sqlite3.Row]:
+    """Leases up to `limit` due jobs (lowest priority value, then oldest run_at first) to `owner` and returns them."""
+    now = time.time()
+    with db_connection() as conn:
+        try:
+            claimed = conn.execute("""
+                UPDATE jobs SET lease_owner = ?, lease_expires_at = ? + lease_seconds, attempts = attempts + 1
+                WHERE state = 'queued' AND (lease_owner IS NULL OR lease_expires_at < ?) AND job_id IN (
+                    SELECT job_id FROM jobs
+                    WHERE state = 'queued' AND run_at <= ? AND (lease_owner IS NULL OR lease_expires_at < ?)
+                    ORDER BY priority ASC, run_at ASC
+                    LIMIT ?
+                )
+                RETURNING *
+            """, (owner, now, now, now, now, limit)).fetchall()
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to claim due jobs for {owner}: {e}")
+            conn.rollback()
+            return []
+    return sorted(claimed, key=lambda row: (row['priority'], row['run_at']))
+
+def complete_job(job_id: int, owner: str, claimed_run_at: float, next_run_at: float | None = None) -> bool:
+    """
+    Releases a finished job. A one-off job is deleted unless it was re-enqueued while running; a recurring
+    job (next_run_at given) is rescheduled, or kept at its re-enqueued time if that is earlier.
+    False if owner no longer holds the lease.
+    """
+    with db_connection() as conn:
+        try:
+            if next_run_at is None:
+                cursor = conn.execute("DELETE FROM jobs WHERE job_id = ? AND lease_owner = ? AND run_at = ?",
+                                      (job_id, owner, claimed_run_at))
+                if cursor.rowcount == 0:
+                    cursor = conn.execute("""
+                        UPDATE jobs SET lease_owner = NULL, lease_expires_at = NULL, attempts = 0, last_error = NULL
+                        WHERE job_id = ? AND lease_owner = ?
+                    """, (job_id, owner))
+            else:
+                cursor = conn.execute("""
+                    UPDATE jobs SET lease_owner = NULL, lease_expires_at = NULL, attempts = 0, last_error = NULL,
+                                    run_at = CASE WHEN run_at = ? THEN ? ELSE MIN(run_at, ?) END
+                    WHERE job_id = ? AND lease_owner = ?
+                """, (claimed_run_at, next_run_at, next_run_at, job_id, owner))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to complete job {job_id}: {e}")
+            conn.rollback()
+            return False
+    if cursor.rowcount == 0:
+        logger.warning(f"Job {job_id} finished after {owner} lost its lease; another worker may have run it again.")
+        return False
+    return True
+
+def fail_job(job_id: int, owner: str, error: str, retry_at: float | None = None) -> bool:
+    """Releases a failed job for another attempt at retry_at, or marks it 'dead' when retry_at is None."""
+    with db_connection() as conn:
+        try:
+            cursor = conn.execute("""
+                UPDATE jobs SET lease_owner = NULL, lease_expires_at = NULL, last_error = ?,
+                                state = CASE WHEN ? IS NULL THEN 'dead' ELSE 'queued' END,
+                                run_at = COALESCE(?, run_at)
+                WHERE job_id = ? AND lease_owner = ?
+            """, (error[:1000], retry_at, retry_at, job_id, owner))
+            conn.commit()
+            return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to record failure of job {job_id}: {e}")
+            conn.rollback()
+            return False
+
+# --- Archival ---
+ARCHIVE_AFTER_DAYS = getattr(config, 'ARCHIVE_AFTER_DAYS', 90)
+ARCHIVE_BATCH_SIZE = getattr(config, 'ARCHIVE_BATCH_SIZE', 500)
+# Terminal states only; error states stay hot until support has dealt with them.
+ARCHIVABLE_TRANSACTION_STATUSES = ('completed', 'cancelled_by_user', 'expired_payment_window', 'failed_insufficient_balance',
+                                   'failed_expired_notfound', 'failed_expired_unconfirmed')
+ARCHIVABLE_PAYMENT_STATUSES = ('processed', 'expired', 'user_cancelled')
+
+def _archive_batch(conn: sqlite3.Connection, cutoff: str, batch_size: int) -> int:
+    tx_placeholders = ','.join('?' * len(ARCHIVABLE_TRANSACTION_STATUSES))
+    payment_placeholders = ','.join('?' * len(ARCHIVABLE_PAYMENT_STATUSES))
+    conn.execute('BEGIN IMMEDIATE')
+    rows = conn.execute(f"""
+        SELECT t.transaction_id FROM transactions t
+        WHERE t.payment_status IN ({tx_placeholders}) AND t.updated_at < ?
+          AND NOT EXISTS (
+              SELECT 1 FROM pending_crypto_payments p
+              WHERE p.transaction_id = t.transaction_id AND p.status NOT IN ({payment_placeholders})
+          )
+        LIMIT ?
+    """, (*ARCHIVABLE_TRANSACTION_STATUSES, cutoff, *ARCHIVABLE_PAYMENT_STATUSES, batch_size)).fetchall()
+    if not rows:
         conn.rollback()
-    finally:
-        conn.close()
-    return expired_details
+        return 0
+
+    ids = [row['transaction_id'] for row in rows]
+    id_placeholders = ','.join('?' * len(ids))
+    archived_at = datetime.datetime.utcnow().isoformat()
+    # OR REPLACE keeps a re-run idempotent should the two files ever commit out of step.
+    conn.execute(f"""
+        INSERT OR REPLACE INTO archive.pending_crypto_payments ({PENDING_PAYMENT_COLUMNS}, archived_at)
+        SELECT {PENDING_PAYMENT_COLUMNS}, ? FROM main.pending_crypto_payments WHERE transaction_id IN ({id_placeholders})
+    """, (archived_at, *ids))
+    conn.execute(f"""
+        INSERT OR REPLACE INTO archive.transactions ({TRANSACTION_COLUMNS}, archived_at)
+        SELECT {TRANSACTION_COLUMNS}, ? FROM main.transactions WHERE transaction_id IN ({id_placeholders})
+    """, (archived_at, *ids))
+    conn.execute(f"DELETE FROM main.pending_crypto_payments WHERE transaction_id IN ({id_placeholders})", ids)
+    conn.execute(f"DELETE FROM main.transactions WHERE transaction_id IN ({id_placeholders})", ids)
+    conn.commit()
+    _row_cache.invalidate(transaction_ids=ids)
+    return len(ids)
+
+def archive_finished_records(older_than_days: int = ARCHIVE_AFTER_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Moves transactions in a terminal state, untouched for older_than_days, together with their finished payments,
+    into the archive database. Each batch is its own short write transaction. Returns the number of transactions moved.
+    """
+    # Same text format as CURRENT_TIMESTAMP, which fills transactions.updated_at.
+    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=older_than_days)).strftime('%Y-%m-%d %H:%M:%S')
+    total_moved = 0
+    with db_connection() as conn:
+        try:
+            while True:
+                moved = _archive_batch(conn, cutoff, batch_size)
+                total_moved += moved
+                if moved < batch_size:
+                    break
+        except sqlite3.Error as e:
+            logger.exception(f"Archival failed after moving {total_moved} transaction(s): {e}")
+            conn.rollback()
+    logger.info(f"Archived {total_moved} finished transaction(s) older than {older_than_days} days.")
+    return total_moved
 
 def periodic_filesystem_to_db_sync():
     # periodic_filesystem_to_db_sync is no longer needed as products table is removed.
@@ -682,51 +1406,48 @@ def periodic_filesystem_to_db_sync():
 
 
 def increment_user_transaction_count(user_id: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("UPDATE users SET transaction_count = transaction_count + 1 WHERE user_id = ?", (user_id,))
-        conn.commit()
-        if cursor.rowcount > 0:
-            logger.info(f"Incremented transaction count for user {user_id}.")
-        else:
-            logger.warning(f"Attempted to increment transaction count, but user {user_id} not found.")
-        return cursor.rowcount > 0
-    except sqlite3.Error as e:
-        logger.exception(f"DB error incrementing transaction count for user {user_id}: {e}")
-        conn.rollback()
-        return False
-    finally:
-        if conn: conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("UPDATE users SET transaction_count = transaction_count + 1 WHERE user_id = ?", (user_id,))
+            conn.commit()
+            if cursor.rowcount > 0:
+                logger.info(f"Incremented transaction count for user {user_id}.")
+            else:
+                logger.warning(f"Attempted to increment transaction count, but user {user_id} not found.")
+            return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            logger.exception(f"DB error incrementing transaction count for user {user_id}: {e}")
+            conn.rollback()
+            return False
 
 def update_main_transaction_for_hd_payment(transaction_id: int, status: str, crypto_amount: str, currency: str) -> bool:
     """
     Updates an existing main transaction record with crypto payment details for HD wallet payments.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            UPDATE transactions
-            SET payment_status = ?,
-                crypto_amount = ?,
-                currency = ?,
-                updated_at = CURRENT_TIMESTAMP
-            WHERE transaction_id = ?
-        """, (status, crypto_amount, currency, transaction_id))
-        conn.commit()
-        if cursor.rowcount == 0:
-            logger.warning(f"update_main_transaction_for_hd_payment: No transaction found with ID {transaction_id} to update.")
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                UPDATE transactions
+                SET payment_status = ?,
+                    crypto_amount = ?,
+                    currency = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE transaction_id = ?
+            """, (status, crypto_amount, currency, transaction_id))
+            conn.commit()
+            _row_cache.invalidate(transaction_ids=(transaction_id,))
+            if cursor.rowcount == 0:
+                logger.warning(f"update_main_transaction_for_hd_payment: No transaction found with ID {transaction_id} to update.")
+                return False
+            else:
+                logger.info(f"Main transaction {transaction_id} updated for HD payment. Status: {status}, Crypto: {crypto_amount} {currency}.")
+                return True
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to update main transaction {transaction_id} for HD payment: {e}")
+            conn.rollback()
             return False
-        else:
-            logger.info(f"Main transaction {transaction_id} updated for HD payment. Status: {status}, Crypto: {crypto_amount} {currency}.")
-            return True
-    except sqlite3.Error as e:
-        logger.exception(f"Failed to update main transaction {transaction_id} for HD payment: {e}")
-        conn.rollback()
-        return False
-    finally:
-        if conn: conn.close()
 
 def initial_sync_filesystem_to_db():
     # initial_sync_filesystem_to_db is obsolete as products table is removed.
@@ -735,41 +1456,70 @@ def initial_sync_filesystem_to_db():
     pass # Keep the function defined to avoid breaking existing calls in bot.py if any, but it does nothing.
 
 
-def get_user_transaction_history(user_id: int, limit: int = 5, offset: int = 0) -> list[sqlite3.Row]:
+def get_user_transaction_history(user_id: int, limit: int = 5, older_than_tx_id: int | None = None,
+                                 newer_than_tx_id: int | None = None) -> list[sqlite3.Row]:
     """
-    Fetches a paginated transaction history for a given user.
+    Fetches one page of a user's transaction history, newest first, using keyset pagination.
+    With older_than_tx_id the page continues after that transaction; with newer_than_tx_id it is the
+    page right before it. The anchor's (created_at, transaction_id) is resolved by primary key, so
+    every page costs the same regardless of how deep the user has paged. Reads hot and archived rows.
     Product name for purchases will need to be extracted from item_details_json if displayed.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        query = """
-            SELECT
+    columns = """
                 transaction_id,
                 type,
-                eur_amount,
+                eur_amount_cents,
                 crypto_amount,
                 currency,
                 payment_status,
                 notes,
                 created_at,
-                original_add_balance_amount,
+                original_add_balance_cents,
                 item_details_json -- Include this to potentially extract item name in calling code
-            FROM transactions
+    """
+    if newer_than_tx_id is not None:
+        query = f"""
+            SELECT {columns}
+            FROM all_transactions
             WHERE user_id = ?
-            ORDER BY created_at DESC
-            LIMIT ? OFFSET ?
+              AND (created_at, transaction_id) > (SELECT created_at, transaction_id FROM all_transactions WHERE transaction_id = ?)
+            ORDER BY created_at ASC, transaction_id ASC
+            LIMIT ?
         """
-        cursor.execute(query, (user_id, limit, offset))
-        transactions = cursor.fetchall()
-        logger.debug(f"Fetched {len(transactions)} transactions for user {user_id} with limit {limit}, offset {offset}.")
-        return transactions
-    except sqlite3.Error as e:
-        logger.exception(f"Failed to fetch transaction history for user {user_id}: {e}")
-        return []
-    finally:
-        if conn:
-            conn.close()
+        params = (user_id, newer_than_tx_id, limit)
+    elif older_than_tx_id is not None:
+        query = f"""
+            SELECT {columns}
+            FROM all_transactions
+            WHERE user_id = ?
+              AND (created_at, transaction_id) < (SELECT created_at, transaction_id FROM all_transactions WHERE transaction_id = ?)
+            ORDER BY created_at DESC, transaction_id DESC
+            LIMIT ?
+        """
+        params = (user_id, older_than_tx_id, limit)
+    else:
+        query = f"""
+            SELECT {columns}
+            FROM all_transactions
+            WHERE user_id = ?
+            ORDER BY created_at DESC, transaction_id DESC
+            LIMIT ?
+        """
+        params = (user_id, limit)
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(query, params)
+            transactions = cursor.fetchall()
+            if newer_than_tx_id is not None:
+                transactions.reverse()
+            logger.debug(f"Fetched {len(transactions)} transactions for user {user_id} with limit {limit} "
+                         f"(older than {older_than_tx_id}, newer than {newer_than_tx_id}).")
+            return transactions
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to fetch transaction history for user {user_id}: {e}")
+            return []
 
 # --- Admin Item Management DB Functions --- (These are now obsolete) ---
 # def add_product_type(...):
@@ -778,31 +1528,49 @@ def get_user_transaction_history(user_id: int, limit: int = 5, offset: int = 0)
 # All functions that directly manipulated the 'products' table are removed or commented out
 # as product management is now primarily filesystem-based.
 
-def get_all_users_admin(limit: int = 10, offset: int = 0) -> tuple[list[sqlite3.Row], int]:
+def get_user_count() -> int:
+    """Returns the number of users from the trigger-maintained row_counts table."""
+    with db_connection() as conn:
+        try:
+            row = conn.execute("SELECT row_count FROM row_counts WHERE table_name = 'users'").fetchone()
+            return row['row_count'] if row else 0
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to read user count: {e}")
+            return 0
+
+
+def get_all_users_admin(limit: int = 10, after_user_id: int = 0, before_user_id: int | None = None) -> tuple[list[sqlite3.Row], int]:
     """
-    Fetches a paginated list of all users for admin view.
+    Fetches one page of users for the admin view, ordered by user_id, using keyset pagination.
+    Pass the last user_id of the current page as after_user_id for the next page, or the first one
+    as before_user_id for the previous page.
     Returns a list of user rows and the total count of users.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    total_users = 0
-    try:
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-
-        query = """
-            SELECT user_id, balance, transaction_count
-            FROM users
-            ORDER BY user_id ASC
-            LIMIT ? OFFSET ?
-        """
-        cursor.execute(query, (limit, offset))
-        users = cursor.fetchall()
-        logger.debug(f"Fetched {len(users)} users for admin view. Total users: {total_users}.")
-        return users, total_users
-    except sqlite3.Error as e:
-        logger.exception(f"Failed to fetch all users for admin: {e}")
-        return [], 0
-    finally:
-        if conn:
-            conn.close()
+    total_users = get_user_count()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            if before_user_id is not None:
+                cursor.execute("""
+                    SELECT user_id, balance_cents, transaction_count
+                    FROM users
+                    WHERE user_id < ?
+                    ORDER BY user_id DESC
+                    LIMIT ?
+                """, (before_user_id, limit))
+                users = cursor.fetchall()
+                users.reverse()
+            else:
+                cursor.execute("""
+                    SELECT user_id, balance_cents, transaction_count
+                    FROM users
+                    WHERE user_id > ?
+                    ORDER BY user_id ASC
+                    LIMIT ?
+                """, (after_user_id, limit))
+                users = cursor.fetchall()
+            logger.debug(f"Fetched {len(users)} users for admin view. Total users: {total_users}.")
+            return users, total_users
+        except sqlite3.Error as e:
+            logger.exception(f"Failed to fetch all users for admin: {e}")
+            return [], 0
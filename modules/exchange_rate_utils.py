@@ -4,9 +4,13 @@ import time
 import json # For json.JSONDecodeError
 from decimal import Decimal, InvalidOperation
 
+from modules import http_sessions
+from modules import rate_limiter
+
 logger = logging.getLogger(__name__)
 
 COINGECKO_API_BASE_URL = "https://api.coingecko.com/api/v3"
+COINGECKO_PROVIDER = 'coingecko' # Rate limiter bucket and HTTP session key
 COINGECKO_COIN_IDS = {
     "BTC": "bitcoin",
     "LTC": "litecoin",
@@ -56,8 +60,12 @@ def get_current_exchange_rate(from_currency: str, to_currency: str) -> Decimal |
 
     logger.debug(f"Fetching live rate from CoinGecko: {api_url}")
 
+    if not rate_limiter.acquire(COINGECKO_PROVIDER):
+        logger.error(f"CoinGecko rate limit budget exhausted; not fetching rate for {cache_key}.")
+        return None
+
     try:
-        response = requests.get(api_url, timeout=10) # 10-second timeout
+        response = http_sessions.get_session(COINGECKO_PROVIDER).get(api_url, timeout=http_sessions.get_timeout(COINGECKO_PROVIDER))
         response.raise_for_status()  # Raises HTTPError for bad responses (4XX or 5XX)
         data = response.json()
 
@@ -80,6 +88,8 @@ def get_current_exchange_rate(from_currency: str, to_currency: str) -> Decimal |
     except requests.exceptions.Timeout:
         logger.error(f"Timeout while fetching exchange rate from CoinGecko for {cache_key}: {api_url}")
     except requests.exceptions.HTTPError as http_err:
+        if http_err.response is not None and http_err.response.status_code == 429:
+            rate_limiter.note_rate_limited(COINGECKO_PROVIDER, http_err.response.headers.get('Retry-After'))
         logger.error(f"HTTP error occurred while fetching exchange rate for {cache_key}: {http_err} - URL: {api_url}")
     except requests.exceptions.RequestException as req_err: # Catch other requests errors (network, etc.)
         logger.error(f"Request exception occurred while fetching exchange rate for {cache_key}: {req_err} - URL: {api_url}")
@@ -0,0 +1,79 @@
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# --- Shared HTTP Sessions ---
+# One requests.Session per provider (the same keys as modules/rate_limiter.py), created on first use and
+# shared by all threads. Its HTTPAdapter keeps keep-alive connections to the provider, so repeated calls
+# skip the TCP and TLS handshakes:
+#
+#     session = http_sessions.get_session('blockstream')
+#     response = session.get(url, timeout=http_sessions.get_timeout('blockstream'))
+#
+# A provider's pool holds the monitor's MONITOR_PROVIDER_CONCURRENCY for its coin plus HTTP_POOL_HEADROOM
+# connections for on-demand checks, so raising the monitor's concurrency grows the pool with it. Beyond the
+# pool size, extra connections are still opened but are not kept alive afterwards.
+
+# provider -> (connect timeout, read timeout) in seconds
+DEFAULT_HTTP_TIMEOUTS = {
+    'blockstream': (5, 15),
+    'blockcypher': (5, 20),
+    'trongrid': (5, 15),
+    'coingecko': (5, 10),
+}
+HTTP_TIMEOUTS = {**DEFAULT_HTTP_TIMEOUTS, **getattr(config, 'HTTP_TIMEOUTS', {})}
+HTTP_DEFAULT_TIMEOUT = (5, 15) # Providers without an entry above
+HTTP_POOL_MAXSIZE = getattr(config, 'HTTP_POOL_MAXSIZE', None) # Fixed pool size for every provider; overrides the derived sizes
+HTTP_POOL_HEADROOM = 2 # Connections on top of the monitor's concurrency (on-demand checks, chain tip refreshes)
+HTTP_POOL_DEFAULT_SIZE = 4 # Providers the monitor does not query (e.g. CoinGecko, called from handlers)
+
+# provider -> coin whose monitor concurrency it serves
+_PROVIDER_COINS = {'blockstream': 'BTC', 'blockcypher': 'LTC', 'trongrid': 'USDT_TRX'}
+
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_pool_size(provider: str) -> int:
+    """Keep-alive connections kept for the provider: HTTP_POOL_MAXSIZE if set, else the monitor's concurrency plus headroom."""
+    if HTTP_POOL_MAXSIZE:
+        return int(HTTP_POOL_MAXSIZE)
+    coin_symbol = _PROVIDER_COINS.get(provider)
+    if coin_symbol is None:
+        return HTTP_POOL_DEFAULT_SIZE
+    from modules import payment_monitor # Local import: payment_monitor -> blockchain_apis -> this module
+    return payment_monitor.provider_concurrency(coin_symbol) + HTTP_POOL_HEADROOM
+
+
+def get_session(provider: str) -> requests.Session:
+    """The provider's shared session, with a keep-alive pool of get_pool_size(provider) connections."""
+    with _sessions_lock:
+        session = _sessions.get(provider)
+        if session is None:
+            pool_size = get_pool_size(provider)
+            session = requests.Session()
+            # Retries stay with the callers (job backoff, monitor cycles); the adapter only pools connections.
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[provider] = session
+            logger.debug(f"HTTP session for '{provider}' created (pool size {pool_size}).")
+        return session
+
+
+def get_timeout(provider: str) -> tuple[float, float]:
+    return HTTP_TIMEOUTS.get(provider, HTTP_DEFAULT_TIMEOUT)
+
+
+def close_sessions():
+    """Closes every shared session and its pooled connections (on shutdown)."""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
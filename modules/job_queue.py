@@ -0,0 +1,174 @@
+import collections
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import config
+from modules import db_utils
+
+logger = logging.getLogger(__name__)
+
+# --- Durable Job Queue ---
+# Background work lives in the jobs table (see db_utils "Job Queue") instead of per-task sleep loops.
+# A pool of worker threads claims due jobs atomically, runs the registered handler and then deletes the
+# job, reschedules it (recurring jobs) or retries it with backoff. Because jobs are rows, they survive
+# restarts, several workers (or processes) share the load, and handlers can queue follow-up work:
+#
+#     job_queue.register_job('expire_tickets', handler, interval_seconds=3600)    # at startup
+#     job_queue.enqueue('recheck_payment', {'transaction_id': 42}, delay_seconds=30,
+#                       dedupe_key='recheck_payment:42')                          # from anywhere
+#     job_queue.run_soon('process_confirmed_payments')                            # pull a recurring job forward
+#
+# Handlers receive the job's payload dict. Anything they raise counts as a failed attempt.
+
+JOB_WORKER_THREADS = getattr(config, 'JOB_WORKER_THREADS', 3)
+JOB_POLL_SECONDS = getattr(config, 'JOB_POLL_SECONDS', 1.0) # Idle workers look for due jobs this often
+JOB_RETRY_BASE_SECONDS = getattr(config, 'JOB_RETRY_BASE_SECONDS', 15) # Doubles with every failed attempt
+JOB_RETRY_MAX_SECONDS = getattr(config, 'JOB_RETRY_MAX_SECONDS', 3600)
+JOB_STOP_TIMEOUT_SECONDS = getattr(config, 'JOB_STOP_TIMEOUT_SECONDS', 60) # How long shutdown waits for running jobs
+
+JobType = collections.namedtuple('JobType', 'kind handler interval_seconds initial_delay_seconds lease_seconds priority max_attempts')
+JobWorkers = collections.namedtuple('JobWorkers', 'stop_event threads')
+
+_job_types: dict[str, JobType] = {}
+_wakeup = threading.Event() # Set by enqueue() so idle workers pick up immediate jobs without waiting a poll
+
+
+def _recurring_key(kind: str) -> str:
+    return f"recurring:{kind}"
+
+
+def register_job(kind: str, handler, interval_seconds: float | None = None, initial_delay_seconds: float = 0,
+                 lease_seconds: int = 300, priority: int = 100, max_attempts: int = 5):
+    """
+    Registers the handler for a job kind. With interval_seconds the job is recurring: one instance is kept
+    queued and runs again interval_seconds after each run finishes. lease_seconds must exceed the handler's
+    longest run, otherwise another worker may start the same job while it is still running.
+    """
+    _job_types[kind] = JobType(kind, handler, interval_seconds, initial_delay_seconds, lease_seconds, priority, max_attempts)
+
+
+def schedule_recurring_jobs():
+    """Makes sure every recurring job is queued. A job already in the table (e.g. from before a restart) keeps its time."""
+    for job_type in _job_types.values():
+        if not job_type.interval_seconds:
+            continue
+        db_utils.enqueue_job(job_type.kind, delay_seconds=job_type.initial_delay_seconds, priority=job_type.priority,
+                             dedupe_key=_recurring_key(job_type.kind), max_attempts=job_type.max_attempts,
+                             lease_seconds=job_type.lease_seconds, keep_existing=True)
+        logger.info(f"Job '{job_type.kind}': every {job_type.interval_seconds}s, first run after {job_type.initial_delay_seconds}s if not already queued.")
+
+
+def enqueue(kind: str, payload: dict | None = None, delay_seconds: float = 0, dedupe_key: str | None = None,
+            priority: int | None = None) -> int | None:
+    """Queues a one-off job. Priority, lease and attempts default to the kind's registration."""
+    job_type = _job_types.get(kind)
+    if job_type is None:
+        logger.warning(f"Enqueueing job of unregistered kind '{kind}'; it fails unless a worker registers it.")
+        job_type = JobType(kind, None, None, 0, 300, 100, 5)
+    job_id = db_utils.enqueue_job(kind, payload, delay_seconds=delay_seconds,
+                                  priority=job_type.priority if priority is None else priority,
+                                  dedupe_key=dedupe_key, max_attempts=job_type.max_attempts,
+                                  lease_seconds=job_type.lease_seconds)
+    if job_id is not None and delay_seconds <= 0:
+        _wakeup.set()
+    return job_id
+
+
+def run_soon(kind: str) -> int | None:
+    """Runs a recurring job now instead of at its next interval (or once more right after, if it is running)."""
+    job_type = _job_types.get(kind)
+    if job_type is None or not job_type.interval_seconds:
+        logger.error(f"run_soon: '{kind}' is not a registered recurring job.")
+        return None
+    return enqueue(kind, dedupe_key=_recurring_key(kind))
+
+
+def _retry_delay(attempts: int) -> float:
+    return min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** max(0, attempts - 1))
+
+
+def _run_one(job, owner: str):
+    job_id, kind = job['job_id'], job['kind']
+    job_type = _job_types.get(kind)
+    if job_type is None:
+        logger.error(f"Job {job_id}: no handler registered for kind '{kind}'. Marking it dead.")
+        db_utils.fail_job(job_id, owner, f"No handler registered for kind '{kind}'")
+        return
+
+    started = time.monotonic()
+    try:
+        job_type.handler(json.loads(job['payload']))
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        if job_type.interval_seconds:
+            # Recurring jobs never die; after max_attempts they just wait for their next interval.
+            delay = job_type.interval_seconds
+            if job['attempts'] < job['max_attempts']:
+                delay = min(delay, _retry_delay(job['attempts']))
+            logger.exception(f"Job {job_id} '{kind}' failed (attempt {job['attempts']}); retrying in {delay:.0f}s.")
+            db_utils.fail_job(job_id, owner, error, retry_at=time.time() + delay)
+        elif job['attempts'] < job['max_attempts']:
+            delay = _retry_delay(job['attempts'])
+            logger.exception(f"Job {job_id} '{kind}' failed (attempt {job['attempts']}/{job['max_attempts']}); retrying in {delay:.0f}s.")
+            db_utils.fail_job(job_id, owner, error, retry_at=time.time() + delay)
+        else:
+            logger.exception(f"Job {job_id} '{kind}' failed {job['attempts']} times; giving up. Payload: {job['payload']}")
+            db_utils.fail_job(job_id, owner, error)
+        return
+
+    elapsed = time.monotonic() - started
+    if elapsed > job['lease_seconds']:
+        logger.warning(f"Job {job_id} '{kind}' ran {elapsed:.0f}s, longer than its {job['lease_seconds']}s lease.")
+    next_run_at = time.time() + job_type.interval_seconds if job_type.interval_seconds else None
+    db_utils.complete_job(job_id, owner, job['run_at'], next_run_at)
+    logger.debug(f"Job {job_id} '{kind}' finished in {elapsed:.2f}s.")
+
+
+def _worker_loop(stop_event: threading.Event):
+    owner = f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+    logger.info(f"Job worker {owner} started.")
+    while not stop_event.is_set():
+        jobs = db_utils.claim_due_jobs(owner)
+        if not jobs:
+            _wakeup.wait(JOB_POLL_SECONDS)
+            _wakeup.clear()
+            continue
+        for job in jobs:
+            _run_one(job, owner)
+    logger.info(f"Job worker {owner} stopped.")
+
+
+def start_workers(threads: int = JOB_WORKER_THREADS) -> JobWorkers:
+    """Queues the recurring jobs and starts the worker threads. Pass the result to stop_workers() on shutdown."""
+    schedule_recurring_jobs()
+    stop_event = threading.Event()
+    worker_threads = []
+    for n in range(max(1, threads)):
+        thread = threading.Thread(target=_worker_loop, args=(stop_event,), name=f"job-worker-{n + 1}", daemon=True)
+        thread.start()
+        worker_threads.append(thread)
+    logger.info(f"Started {len(worker_threads)} job worker thread(s) for {len(_job_types)} job kind(s).")
+    return JobWorkers(stop_event, worker_threads)
+
+
+def stop_workers(workers: JobWorkers, timeout: float = JOB_STOP_TIMEOUT_SECONDS) -> list[threading.Thread]:
+    """
+    Asks the workers to exit once their current job is done and waits up to `timeout` seconds for them.
+    Returns the threads still running a job; their database connections must stay open.
+    """
+    workers.stop_event.set()
+    _wakeup.set()
+    deadline = time.monotonic() + timeout
+    for thread in workers.threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+    still_running = [thread for thread in workers.threads if thread.is_alive()]
+    if still_running:
+        logger.warning(f"{len(still_running)} job worker(s) still running after {timeout}s: "
+                       f"{', '.join(thread.name for thread in still_running)}. Their jobs resume from the jobs table after the lease expires.")
+    else:
+        logger.info("All job workers stopped.")
+    return still_running
@@ -2,6 +2,9 @@ import telebot
 import logging
 import os
 import re
+import time
+
+import config
 
 # Configure logging for this module
 logger = logging.getLogger(__name__)
@@ -295,6 +298,60 @@ def send_loading_acknowledgment(bot, chat_id, callback_query_id=None, message_ob
     except Exception as e:
         logger.error(f"An unexpected error occurred in send_loading_acknowledgment: {e}", exc_info=True)
 
+# Telegram allows roughly 30 messages per second across all chats; stay below it for broadcasts.
+BULK_SEND_MESSAGES_PER_SECOND = getattr(config, 'BULK_SEND_MESSAGES_PER_SECOND', 25)
+BULK_SEND_MAX_RETRIES = 3
+TELEGRAM_TEXT_LIMIT = 4096
+
+def chunk_lines(lines, header="", limit=TELEGRAM_TEXT_LIMIT):
+    """
+    Joins lines into as few messages as possible, each at most `limit` characters and starting with header.
+    Used to turn per-item notices into a handful of digest messages.
+    """
+    chunks, current = [], header
+    for line in lines:
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit and current != header:
+            chunks.append(current)
+            candidate = f"{header}\n{line}" if header else line
+        current = candidate[:limit]
+    if current != header:
+        chunks.append(current)
+    return chunks
+
+def send_bulk_notifications(bot, notifications, messages_per_second=BULK_SEND_MESSAGES_PER_SECOND):
+    """
+    Sends plain-text (chat_id, text) notifications paced at messages_per_second.
+    A 429 response is retried after the retry_after Telegram reports; other errors (bot blocked,
+    chat not found) are logged and skipped so one bad chat never stops the batch.
+    Returns (sent_count, failed_count).
+    """
+    interval = 1.0 / messages_per_second if messages_per_second > 0 else 0.0
+    sent = failed = 0
+    next_send_at = time.monotonic()
+    for chat_id, text in notifications:
+        for attempt in range(BULK_SEND_MAX_RETRIES + 1):
+            wait = next_send_at - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            next_send_at = time.monotonic() + interval
+            try:
+                bot.send_message(chat_id, text)
+                sent += 1
+                break
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429 and attempt < BULK_SEND_MAX_RETRIES:
+                    retry_after = ((e.result_json or {}).get('parameters') or {}).get('retry_after', 1)
+                    logger.warning(f"Bulk send: rate limited by Telegram, pausing {retry_after}s (chat {chat_id}).")
+                    next_send_at = time.monotonic() + retry_after
+                    continue
+                logger.warning(f"Bulk send: could not notify chat {chat_id}: {e}")
+            except Exception as e:
+                logger.error(f"Bulk send: unexpected error notifying chat {chat_id}: {e}", exc_info=True)
+            failed += 1
+            break
+    return sent, failed
+
 # Example usage within the module (for illustration or direct testing if needed)
 if __name__ == '__main__':
     # ... (previous __main__ content for send_or_edit_message and delete_message) ...
@@ -0,0 +1,90 @@
+import logging
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP, ROUND_UP
+
+logger = logging.getLogger(__name__)
+
+# --- Money Representation ---
+# Euro amounts are stored and computed as integer cents, crypto amounts as integer smallest units
+# (satoshi, litoshi, USDT's 1e-6). Decimal only appears at the edges: parsing user input, applying
+# an exchange rate, and formatting for display.
+
+EurCents = int
+CryptoUnits = int
+
+CENTS_PER_EUR = 100
+
+# Decimal places of the smallest unit, keyed by both display and pending-payment coin symbols.
+COIN_DECIMALS = {
+    "BTC": 8,
+    "LTC": 8,
+    "USDT": 6,
+    "USDT_TRX": 6,
+}
+
+
+def coin_decimals(coin_symbol: str) -> int:
+    return COIN_DECIMALS.get(coin_symbol, 8)
+
+
+def eur_to_cents(amount) -> EurCents:
+    """Converts a EUR amount (str, int, float or Decimal) to cents, rounding half up. Raises ValueError if invalid."""
+    try:
+        value = Decimal(str(amount).strip().replace(',', '.'))
+    except (InvalidOperation, AttributeError) as e:
+        raise ValueError(f"Invalid EUR amount: {amount!r}") from e
+    if not value.is_finite():
+        raise ValueError(f"Invalid EUR amount: {amount!r}")
+    return int((value * CENTS_PER_EUR).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+def cents_to_eur(cents: EurCents) -> Decimal:
+    return Decimal(cents) / CENTS_PER_EUR
+
+
+def format_eur(cents: EurCents) -> str:
+    """Formats cents as a plain '12.34' string (no currency symbol, not Markdown-escaped)."""
+    sign = "-" if cents < 0 else ""
+    whole, fraction = divmod(abs(int(cents)), CENTS_PER_EUR)
+    return f"{sign}{whole}.{fraction:02d}"
+
+
+def parse_units(value) -> CryptoUnits:
+    """Parses an integer smallest-unit amount as returned by the blockchain APIs. Raises ValueError if invalid."""
+    if isinstance(value, int):
+        return value
+    try:
+        units = Decimal(str(value).strip())
+    except (InvalidOperation, AttributeError) as e:
+        raise ValueError(f"Invalid smallest-unit amount: {value!r}") from e
+    if not units.is_finite() or units != units.to_integral_value():
+        raise ValueError(f"Invalid smallest-unit amount: {value!r}")
+    return int(units)
+
+
+def units_to_crypto(units: CryptoUnits, coin_symbol: str) -> Decimal:
+    """Human-readable coin amount for display, e.g. 150000 satoshi -> Decimal('0.00150000')."""
+    decimals = coin_decimals(coin_symbol)
+    return (Decimal(units) / (Decimal(10) ** decimals)).quantize(Decimal(1).scaleb(-decimals))
+
+
+def eur_cents_to_crypto_units(cents: EurCents, eur_per_coin: Decimal, coin_symbol: str) -> CryptoUnits:
+    """Smallest units needed to cover `cents` at the given EUR-per-coin rate, rounded up so the invoice is never short."""
+    if eur_per_coin <= 0:
+        raise ValueError(f"Invalid exchange rate for {coin_symbol}: {eur_per_coin}")
+    scale = Decimal(10) ** coin_decimals(coin_symbol)
+    units = (Decimal(cents) * scale / (CENTS_PER_EUR * Decimal(eur_per_coin))).to_integral_value(rounding=ROUND_UP)
+    return int(units)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    assert eur_to_cents("12.345") == 1235
+    assert eur_to_cents("10,5") == 1050
+    assert eur_to_cents(0.1) == 10
+    assert format_eur(1235) == "12.35"
+    assert format_eur(-5) == "-0.05"
+    assert parse_units("150000") == 150000
+    assert str(units_to_crypto(150000, "BTC")) == "0.00150000"
+    assert eur_cents_to_crypto_units(10000, Decimal("50000"), "BTC") == 200000
+    assert eur_cents_to_crypto_units(1001, Decimal("0.92"), "USDT") == 10880435
+    logger.info("Money self-test passed.")
@@ -1,10 +1,13 @@
+import collections
+import concurrent.futures
 import logging
 import time
-import datetime
-from decimal import Decimal, InvalidOperation
+import threading
+import atexit
 import requests
 
 from modules import db_utils
+from modules import money
 from modules import blockchain_apis # Imports the module with custom exceptions
 from modules.blockchain_apis import ( # Import custom exceptions
     BlockchainAPIError, BlockchainAPITimeoutError,
@@ -12,6 +15,7 @@ from modules.blockchain_apis import ( # Import custom exceptions
     BlockchainAPIInvalidAddressError, BlockchainAPIBadResponseError
 )
 from modules import file_system_utils
+from modules import job_queue
 import config
 import sqlite3
 
@@ -23,6 +27,70 @@ logger = logging.getLogger(__name__)
 
 USDT_DECIMALS = 6
 
+# --- Write-behind buffer for monitor bookkeeping ---
+MONITOR_WRITE_BATCH_SIZE = getattr(config, 'MONITOR_WRITE_BATCH_SIZE', 200)
+MONITOR_WRITE_FLUSH_SECONDS = getattr(config, 'MONITOR_WRITE_FLUSH_SECONDS', 10.0)
+
+class PaymentWriteBuffer:
+    """
+    Collects last_checked_at/confirmation updates and status changes made during a monitor cycle
+    and writes them with executemany in one transaction. A flush happens once max_rows writes are
+    queued, once the oldest queued write is max_age_seconds old, at the end of each cycle, and on shutdown.
+    """
+    def __init__(self, max_rows: int = MONITOR_WRITE_BATCH_SIZE, max_age_seconds: float = MONITOR_WRITE_FLUSH_SECONDS):
+        self.max_rows = max_rows
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._check_updates = []
+        self._status_updates = []
+        self._oldest_write_at = None
+
+    def record_check(self, payment_id: int, confirmations: int, received_units: int | None = None, blockchain_tx_id: str | None = None):
+        now = int(time.time())
+        with self._lock:
+            self._check_updates.append((now, now + db_utils.MONITOR_RECHECK_SECONDS, confirmations, received_units, blockchain_tx_id, payment_id))
+            self._touch()
+        self._flush_if_due()
+
+    def record_status(self, payment_id: int, new_status: str, expected_status: str = 'monitoring'):
+        with self._lock:
+            self._status_updates.append((new_status, int(time.time()), payment_id, expected_status))
+            self._touch()
+        logger.info(f"Queued status change for pending payment ID {payment_id} to {new_status}.")
+        self._flush_if_due()
+
+    def _touch(self):
+        if self._oldest_write_at is None:
+            self._oldest_write_at = time.monotonic()
+
+    def _flush_if_due(self):
+        with self._lock:
+            queued = len(self._check_updates) + len(self._status_updates)
+            too_old = self._oldest_write_at is not None and time.monotonic() - self._oldest_write_at >= self.max_age_seconds
+        if queued >= self.max_rows or too_old:
+            self.flush()
+
+    def flush(self) -> bool:
+        with self._lock:
+            check_updates, self._check_updates = self._check_updates, []
+            status_updates, self._status_updates = self._status_updates, []
+            self._oldest_write_at = None
+            if db_utils.apply_pending_payment_updates(check_updates, status_updates):
+                return True
+            # Keep the writes queued (ahead of anything newer) so the next flush retries them.
+            self._check_updates[:0] = check_updates
+            self._status_updates[:0] = status_updates
+            self._touch()
+            return False
+
+_monitor_write_buffer = PaymentWriteBuffer()
+
+def flush_pending_writes() -> bool:
+    """Flushes any buffered monitor writes. Called at the end of each cycle and on shutdown."""
+    return _monitor_write_buffer.flush()
+
+atexit.register(flush_pending_writes)
+
 def _get_min_confirmations(coin_symbol_from_db: str) -> int:
     base_coin_symbol = coin_symbol_from_db.split('_')[0].upper()
     default_confirmations = 1
@@ -32,8 +100,13 @@ def _get_min_confirmations(coin_symbol_from_db: str) -> int:
         return default_confirmations
     return confirmations
 
-def _handle_api_error_for_payment_check(payment_id, address, coin_symbol, error):
-    """Specific error handling for check_pending_payments context."""
+def _handle_api_error_for_payment_check(payment_id, address, coin_symbol, error, write_buffer: PaymentWriteBuffer | None = None,
+                                        expected_status: str = 'monitoring'):
+    """
+    Specific error handling for check_pending_payments context.
+    Error statuses are only set while the payment is still in expected_status.
+    """
+    set_status = write_buffer.record_status if write_buffer else db_utils.update_pending_payment_status
     logger.error(f"API Error during payment check for payment_id {payment_id} ({coin_symbol} @ {address}): {type(error).__name__} - {error}")
 
     # Based on the error type, decide if the payment should be marked with a specific error status
@@ -49,187 +122,289 @@ def _handle_api_error_for_payment_check(payment_id, address, coin_symbol, error)
         # No status change, but admin should monitor logs for frequent rate limits
     elif isinstance(error, BlockchainAPIInvalidAddressError):
         logger.error(f"Invalid address for payment_id {payment_id} according to API. Marking payment as error.")
-        db_utils.update_pending_payment_status(payment_id, 'error_monitoring_invalid_address')
+        set_status(payment_id, 'error_monitoring_invalid_address', expected_status=expected_status)
     elif isinstance(error, BlockchainAPIBadResponseError):
         logger.error(f"Bad API response for payment_id {payment_id}. Marking payment as error.")
-        db_utils.update_pending_payment_status(payment_id, 'error_monitoring_bad_response')
+        set_status(payment_id, 'error_monitoring_bad_response', expected_status=expected_status)
     elif isinstance(error, BlockchainAPIError): # Generic custom API error
         logger.error(f"Generic BlockchainAPIError for payment_id {payment_id}. Marking as error.")
-        db_utils.update_pending_payment_status(payment_id, 'error_monitoring_api_generic')
+        set_status(payment_id, 'error_monitoring_api_generic', expected_status=expected_status)
     else: # Other unexpected exceptions
         logger.exception(f"Unhandled exception during API call for payment_id {payment_id}: {error}")
-        db_utils.update_pending_payment_status(payment_id, 'error_monitoring_unexpected')
-
-
-def check_pending_payments():
-    logger.info("Starting check_pending_payments cycle.")
-    pending_payments = db_utils.get_pending_payments_to_monitor()
-
-    if not pending_payments:
-        logger.info("No payments currently in 'monitoring' state and not expired.")
-        return
-
-    logger.info(f"Found {len(pending_payments)} payments to check.")
-
-    for payment in pending_payments:
-        payment_id = payment['payment_id']
-        address = payment['address']
-        coin_symbol = payment['coin_symbol']
-        expected_amount_str = payment['expected_crypto_amount']
-        created_at_dt = datetime.datetime.fromisoformat(payment['created_at'])
-        current_db_confirmations = payment['confirmations']
-        current_db_blockchain_tx_id = payment['blockchain_tx_id']
-        # current_db_received_amount = payment['received_crypto_amount'] # Not needed for direct check logic here
-
-        logger.debug(f"Checking payment_id: {payment_id}, address: {address}, coin: {coin_symbol}")
-
-        api_transactions = [] # Initialize to empty list
-        time.sleep(getattr(config, 'BLOCKCHAIN_API_CALL_DELAY_SECONDS', 2.0))
-
-        try:
-            if coin_symbol == "BTC":
-                api_transactions = blockchain_apis.get_address_transactions_btc(address)
-            elif coin_symbol == "LTC":
-                api_transactions = blockchain_apis.get_address_transactions_ltc(address)
-            elif coin_symbol == "USDT_TRX":
-                since_ts_ms = int(created_at_dt.timestamp() * 1000) - (60 * 1000 * 5)
-                api_transactions = blockchain_apis.get_trc20_transfers_usdt_trx(address, since_timestamp_ms=since_ts_ms)
-            else:
-                logger.warning(f"Unsupported coin_symbol '{coin_symbol}' for payment_id {payment_id}. Skipping.")
-                db_utils.update_pending_payment_status(payment_id, 'error_monitoring_unsupported')
+        set_status(payment_id, 'error_monitoring_unexpected', expected_status=expected_status)
+
+
+# --- Concurrent address checks ---
+# check_pending_payments() queries address histories on a thread pool. Every coin has its own provider
+# (Blockstream, BlockCypher, TronGrid), so concurrency is limited per coin: at most
+# MONITOR_PROVIDER_CONCURRENCY[coin] requests are in flight. Request rates are paced by the shared
+# per-provider token buckets in modules/rate_limiter.py. On-demand checks share the same slots.
+# LTC addresses are fetched LTC_BATCH_SIZE per BlockCypher request (blockchain_apis.get_address_transactions_ltc_batch).
+# Results are applied on the monitor thread, one payment at a time, through the write buffer. A cycle keeps
+# taking batches of due payments until none are left or MONITOR_TARGET_CYCLE_SECONDS has passed.
+MONITORED_COINS = ('BTC', 'LTC', 'USDT_TRX')
+MONITOR_PROVIDER_CONCURRENCY = getattr(config, 'MONITOR_PROVIDER_CONCURRENCY', {'BTC': 3, 'LTC': 2, 'USDT_TRX': 3})
+MONITOR_TARGET_CYCLE_SECONDS = getattr(config, 'MONITOR_TARGET_CYCLE_SECONDS', 60)
+MONITOR_BATCH_SIZE = getattr(config, 'MONITOR_BATCH_SIZE', 100)
+
+def provider_concurrency(coin_symbol: str) -> int:
+    """Parallel API requests allowed for the coin's provider (also sizes its keep-alive pool in http_sessions)."""
+    return max(1, int(MONITOR_PROVIDER_CONCURRENCY.get(coin_symbol, 1)))
+
+_provider_slots = {coin: threading.BoundedSemaphore(provider_concurrency(coin)) for coin in MONITORED_COINS}
+_check_executor = None
+_check_executor_lock = threading.Lock()
+
+def _get_check_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _check_executor
+    with _check_executor_lock:
+        if _check_executor is None:
+            workers = sum(provider_concurrency(coin) for coin in MONITORED_COINS)
+            _check_executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='monitor-check')
+        return _check_executor
+
+def _fetch_address_transactions(payment) -> list[dict]:
+    """Incoming transactions of the payment's address from its coin's provider. Raises on API errors."""
+    coin_symbol = payment['coin_symbol']
+    address = payment['address']
+    with _provider_slots[coin_symbol]:
+        if coin_symbol == "BTC":
+            return blockchain_apis.get_address_transactions_btc(address)
+        if coin_symbol == "LTC":
+            return blockchain_apis.get_address_transactions_ltc(address)
+        since_ts_ms = payment['created_at'] * 1000 - (60 * 1000 * 5)
+        return blockchain_apis.get_trc20_transfers_usdt_trx(address, since_timestamp_ms=since_ts_ms)
+
+def _apply_check_result(payment, api_transactions: list[dict]):
+    """Matches the API transactions against the payment and queues the resulting writes."""
+    payment_id = payment['payment_id']
+    address = payment['address']
+    coin_symbol = payment['coin_symbol']
+    expected_units = payment['expected_crypto_units']
+    current_db_confirmations = payment['confirmations']
+    current_db_blockchain_tx_id = payment['blockchain_tx_id']
+
+    found_matching_tx_for_confirmation = False
+    if api_transactions: # api_transactions is now guaranteed to be a list
+        logger.debug(f"Found {len(api_transactions)} API transactions for address {address} ({coin_symbol}).")
+        for tx_data_from_api in api_transactions:
+            tx_confirmations_api = tx_data_from_api.get('confirmations', 0)
+            blockchain_tx_id_api = tx_data_from_api.get('txid')
+
+            # Determine amount key based on coin_symbol more robustly
+            amount_key_map = {"BTC": "amount_satoshi", "LTC": "amount_litoshi", "USDT_TRX": "amount_smallest_unit"}
+            amount_key = amount_key_map.get(coin_symbol)
+            if not amount_key: # Should have been caught by unsupported coin_symbol earlier
+                logger.error(f"Logic error: Undefined amount key for coin_symbol {coin_symbol}, payment_id {payment_id}"); continue
+
+            received_amount_smallest_unit_api_str = tx_data_from_api.get(amount_key)
+
+            if not received_amount_smallest_unit_api_str or not blockchain_tx_id_api:
+                logger.warning(f"Skipping tx for payment_id {payment_id} due to missing amount or txid. Data: {tx_data_from_api}")
                 continue
-        except BlockchainAPIError as e_api: # Catch specific custom exceptions
-            _handle_api_error_for_payment_check(payment_id, address, coin_symbol, e_api)
-            continue
-        except Exception as e_generic: # Catch any other unexpected error from the API call layer
-             _handle_api_error_for_payment_check(payment_id, address, coin_symbol, e_generic)
-             continue
-
-
-        found_matching_tx_for_confirmation = False
-        if api_transactions: # api_transactions is now guaranteed to be a list
-            logger.debug(f"Found {len(api_transactions)} API transactions for address {address} ({coin_symbol}).")
-
-            for tx_data_from_api in api_transactions:
-                tx_confirmations_api = tx_data_from_api.get('confirmations', 0)
-                blockchain_tx_id_api = tx_data_from_api.get('txid')
 
-                # Determine amount key based on coin_symbol more robustly
-                amount_key_map = {"BTC": "amount_satoshi", "LTC": "amount_litoshi", "USDT_TRX": "amount_smallest_unit"}
-                amount_key = amount_key_map.get(coin_symbol)
-                if not amount_key: # Should have been caught by unsupported coin_symbol earlier
-                    logger.error(f"Logic error: Undefined amount key for coin_symbol {coin_symbol}, payment_id {payment_id}"); continue
-
-                received_amount_smallest_unit_api_str = tx_data_from_api.get(amount_key)
+            try:
+                received_units_api = money.parse_units(received_amount_smallest_unit_api_str)
+            except ValueError:
+                logger.error(f"Could not parse received amount for payment_id {payment_id}, tx {blockchain_tx_id_api}. API_RX: '{received_amount_smallest_unit_api_str}'. Skipping tx.")
+                continue
 
-                if not received_amount_smallest_unit_api_str or not blockchain_tx_id_api:
-                    logger.warning(f"Skipping tx for payment_id {payment_id} due to missing amount or txid. Data: {tx_data_from_api}")
-                    continue
+            if current_db_blockchain_tx_id and current_db_blockchain_tx_id == blockchain_tx_id_api:
+                found_matching_tx_for_confirmation = True
+                logger.info(f"Re-checking known tx {blockchain_tx_id_api} for payment_id {payment_id}. API_Confs: {tx_confirmations_api}, DB_Confs: {current_db_confirmations}")
 
-                try:
-                    received_decimal_api = Decimal(received_amount_smallest_unit_api_str)
-                    expected_decimal_db = Decimal(expected_amount_str)
-                except InvalidOperation:
-                    logger.error(f"Could not convert amounts to Decimal for payment_id {payment_id}, tx {blockchain_tx_id_api}. API_RX: '{received_amount_smallest_unit_api_str}', DB_EXP: '{expected_amount_str}'. Skipping tx.")
-                    continue
+                _monitor_write_buffer.record_check(payment_id, tx_confirmations_api, received_units_api, blockchain_tx_id_api)
 
-                if current_db_blockchain_tx_id and current_db_blockchain_tx_id == blockchain_tx_id_api:
+                min_confs_needed = _get_min_confirmations(coin_symbol)
+                if tx_confirmations_api >= min_confs_needed:
+                    logger.info(f"Payment {payment_id} (tx {blockchain_tx_id_api}) CONFIRMED with {tx_confirmations_api} confs.")
+                    _monitor_write_buffer.record_status(payment_id, 'confirmed_unprocessed')
+                break
+            elif not current_db_blockchain_tx_id:
+                if received_units_api >= expected_units:
+                    logger.info(f"Found NEW potential matching tx for payment_id {payment_id}: txid {blockchain_tx_id_api}, received {received_units_api}, expected {expected_units}.")
                     found_matching_tx_for_confirmation = True
-                    logger.info(f"Re-checking known tx {blockchain_tx_id_api} for payment_id {payment_id}. API_Confs: {tx_confirmations_api}, DB_Confs: {current_db_confirmations}")
+                    min_confs_needed = _get_min_confirmations(coin_symbol)
 
-                    db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, str(received_decimal_api), blockchain_tx_id_api)
+                    _monitor_write_buffer.record_check(payment_id, tx_confirmations_api, received_units_api, blockchain_tx_id_api)
+                    # current_db_blockchain_tx_id = blockchain_tx_id_api # No need to set here, will be re-fetched next cycle if not confirmed
 
-                    min_confs_needed = _get_min_confirmations(coin_symbol)
                     if tx_confirmations_api >= min_confs_needed:
                         logger.info(f"Payment {payment_id} (tx {blockchain_tx_id_api}) CONFIRMED with {tx_confirmations_api} confs.")
-                        db_utils.update_pending_payment_status(payment_id, 'confirmed_unprocessed')
+                        _monitor_write_buffer.record_status(payment_id, 'confirmed_unprocessed')
+                    else:
+                        logger.info(f"Payment {payment_id} (tx {blockchain_tx_id_api}) found, but only {tx_confirmations_api}/{min_confs_needed} confirmations. Now tracking this TX.")
                     break
-                elif not current_db_blockchain_tx_id:
-                    if received_decimal_api >= expected_decimal_db:
-                        logger.info(f"Found NEW potential matching tx for payment_id {payment_id}: txid {blockchain_tx_id_api}, received {received_decimal_api}, expected {expected_decimal_db}.")
-                        found_matching_tx_for_confirmation = True
-                        min_confs_needed = _get_min_confirmations(coin_symbol)
 
-                        db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, str(received_decimal_api), blockchain_tx_id_api)
-                        # current_db_blockchain_tx_id = blockchain_tx_id_api # No need to set here, will be re-fetched next cycle if not confirmed
+                elif received_units_api > 0:
+                    logger.warning(f"UNDERPAYMENT detected for payment_id {payment_id}, address {address}. Expected: {expected_units}, Received: {received_units_api} in tx {blockchain_tx_id_api}.")
+                    _monitor_write_buffer.record_check(payment_id, tx_confirmations_api, received_units_api, blockchain_tx_id_api)
+                    _monitor_write_buffer.record_status(payment_id, 'underpaid')
+                    found_matching_tx_for_confirmation = True
+                    break
 
-                        if tx_confirmations_api >= min_confs_needed:
-                            logger.info(f"Payment {payment_id} (tx {blockchain_tx_id_api}) CONFIRMED with {tx_confirmations_api} confs.")
-                            db_utils.update_pending_payment_status(payment_id, 'confirmed_unprocessed')
-                        else:
-                            logger.info(f"Payment {payment_id} (tx {blockchain_tx_id_api}) found, but only {tx_confirmations_api}/{min_confs_needed} confirmations. Now tracking this TX.")
-                        break
+    if not found_matching_tx_for_confirmation:
+        logger.debug(f"No new or tracked matching tx found for payment_id {payment_id}. Updating last_checked_at.")
+        _monitor_write_buffer.record_check(payment_id, current_db_confirmations)
 
-                    elif received_decimal_api > 0:
-                        logger.warning(f"UNDERPAYMENT detected for payment_id {payment_id}, address {address}. Expected: {expected_decimal_db}, Received: {received_decimal_api} in tx {blockchain_tx_id_api}.")
-                        db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, str(received_decimal_api), blockchain_tx_id_api)
-                        db_utils.update_pending_payment_status(payment_id, 'underpaid')
-                        found_matching_tx_for_confirmation = True
-                        break
+def _fetch_payment_group(payments) -> list:
+    """
+    Fetches a group of same-coin payments: one payment, or several LTC payments sharing one BlockCypher
+    batch request. Returns, aligned with `payments`, each one's API transactions or the exception raised.
+    """
+    if len(payments) == 1:
+        try:
+            return [_fetch_address_transactions(payments[0])]
+        except Exception as e:
+            return [e]
+    with _provider_slots['LTC']:
+        by_address = blockchain_apis.get_address_transactions_ltc_batch([p['address'] for p in payments])
+    return [by_address[p['address']] for p in payments]
+
+def _check_payment_batch(payments) -> int:
+    """
+    Checks a batch of payments, at most provider_concurrency(coin) requests at a time per coin. LTC addresses
+    are grouped LTC_BATCH_SIZE to a request. Returns how many payments were checked.
+    """
+    singles = collections.defaultdict(list)
+    for payment in payments:
+        if payment['coin_symbol'] in MONITORED_COINS:
+            singles[payment['coin_symbol']].append(payment)
+        else:
+            logger.warning(f"Unsupported coin_symbol '{payment['coin_symbol']}' for payment_id {payment['payment_id']}. Skipping.")
+            _monitor_write_buffer.record_status(payment['payment_id'], 'error_monitoring_unsupported')
+
+    queues = {}
+    for coin_symbol, coin_payments in singles.items():
+        group_size = blockchain_apis.LTC_BATCH_SIZE if coin_symbol == 'LTC' else 1
+        queues[coin_symbol] = collections.deque(coin_payments[i:i + group_size] for i in range(0, len(coin_payments), group_size))
+
+    executor = _get_check_executor()
+    in_flight = {}
+    def submit_next(coin_symbol):
+        if queues[coin_symbol]:
+            group = queues[coin_symbol].popleft()
+            logger.debug(f"Checking {coin_symbol} payment_id(s) {[p['payment_id'] for p in group]}")
+            in_flight[executor.submit(_fetch_payment_group, group)] = group
+
+    for coin_symbol in queues:
+        for _ in range(provider_concurrency(coin_symbol)):
+            submit_next(coin_symbol)
+
+    checked = 0
+    while in_flight:
+        done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            group = in_flight.pop(future)
+            submit_next(group[0]['coin_symbol'])
+            checked += len(group)
+            try:
+                results = future.result()
+            except Exception as e_group:
+                results = [e_group] * len(group)
+            for payment, result in zip(group, results):
+                if isinstance(result, Exception):
+                    _handle_api_error_for_payment_check(payment['payment_id'], payment['address'], payment['coin_symbol'], result, _monitor_write_buffer)
+                    # Push next_check_at forward so a failing provider is retried next cycle, not again in this one.
+                    _monitor_write_buffer.record_check(payment['payment_id'], payment['confirmations'])
+                else:
+                    _apply_check_result(payment, result)
+    return checked
 
-        if not found_matching_tx_for_confirmation:
-            logger.debug(f"No new or tracked matching tx found for payment_id {payment_id}. Updating last_checked_at.")
-            db_utils.update_pending_payment_check_details(payment_id, current_db_confirmations)
+def check_pending_payments():
+    logger.info("Starting check_pending_payments cycle.")
+    started = time.monotonic()
+    checked = 0
+    seen_payment_ids = set()
+    while True:
+        pending_payments = db_utils.get_pending_payments_to_monitor(MONITOR_BATCH_SIZE)
+        # Stop once only payments checked earlier in this cycle are due again.
+        pending_payments = [p for p in pending_payments if p['payment_id'] not in seen_payment_ids]
+        if not pending_payments:
+            break
+        logger.info(f"Found {len(pending_payments)} payments to check.")
+        seen_payment_ids.update(p['payment_id'] for p in pending_payments)
+        checked += _check_payment_batch(pending_payments)
+        if not flush_pending_writes(): # next_check_at must move before the next batch is read
+            logger.error("Could not write check results; ending this monitor cycle early.")
+            break
+        if time.monotonic() - started >= MONITOR_TARGET_CYCLE_SECONDS:
+            logger.warning(f"Monitor cycle reached its {MONITOR_TARGET_CYCLE_SECONDS}s target after {checked} checks; "
+                           "payments still due wait for the next cycle. Consider raising MONITOR_PROVIDER_CONCURRENCY.")
+            break
 
-    logger.info("Finished check_pending_payments cycle.")
+    if not checked:
+        logger.info("No payments currently in 'monitoring' state and not expired.")
+    logger.info(f"Finished check_pending_payments cycle: {checked} payment(s) checked in {time.monotonic() - started:.1f}s.")
 
 
 def process_confirmed_payments(bot_instance=None):
+    """
+    Finalizes confirmed payments. Safe to run from several threads or processes at once: each payment is
+    claimed by exactly one caller, and its side effects run only if its finalization record is new.
+    """
     logger.info("Starting process_confirmed_payments cycle.")
-    confirmed_payments = db_utils.get_confirmed_unprocessed_payments(limit=20)
+    db_utils.release_stale_finalization_claims()
+    confirmed_payments = db_utils.claim_confirmed_payments(limit=20)
 
     if not confirmed_payments:
         logger.info("No 'confirmed_unprocessed' payments to process.")
         return
 
-    logger.info(f"Found {len(confirmed_payments)} 'confirmed_unprocessed' payments to process.")
+    logger.info(f"Claimed {len(confirmed_payments)} 'confirmed_unprocessed' payments to process.")
 
     for payment in confirmed_payments:
         payment_id = payment['payment_id']
         user_id = payment['user_id']
         main_tx_id = payment['transaction_id']
         coin_symbol = payment['coin_symbol']
-        received_amount_str = payment['received_crypto_amount']
+        received_units = payment['received_crypto_units']
         blockchain_tx_id = payment['blockchain_tx_id']
-        paid_from_balance_eur_str_from_payment = str(payment.get('paid_from_balance_eur', '0.0'))
+        paid_from_balance_cents = payment['paid_from_balance_cents']
 
 
         logger.info(f"Processing confirmed payment_id {payment_id} for main_transaction_id {main_tx_id} (user {user_id}).")
 
-        main_tx_details = db_utils.get_transaction_by_id(main_tx_id)
+        if not db_utils.begin_payment_finalization(payment_id, main_tx_id):
+            record = db_utils.get_payment_finalization(payment_id)
+            logger.critical(f"Payment {payment_id} (main tx {main_tx_id}) already has a finalization record {dict(record) if record else None}; "
+                            f"not finalizing it again. It stays 'finalizing' until reviewed manually.")
+            continue
+
+        main_tx_details = db_utils.get_transaction_by_id(main_tx_id, fresh=True) # Never finalize from a cached row
 
         if not main_tx_details:
             logger.error(f"Main transaction {main_tx_id} not found for confirmed payment_id {payment_id}. Marking as error.")
-            db_utils.update_pending_payment_status(payment_id, 'error_processing_tx_missing')
+            db_utils.finish_payment_finalization(payment_id, 'error_processing_tx_missing')
             continue
 
-        if main_tx_details['payment_status'] == 'completed':
-            logger.warning(f"Main transaction {main_tx_id} already marked 'completed'. Pending payment {payment_id} might be a duplicate signal. Marking 'processed'.")
-            db_utils.update_pending_payment_status(payment_id, 'processed_tx_already_complete')
+        if main_tx_details['payment_status'].startswith('completed'):
+            logger.warning(f"Main transaction {main_tx_id} already marked '{main_tx_details['payment_status']}'. Pending payment {payment_id} might be a duplicate signal. Marking 'processed'.")
+            db_utils.finish_payment_finalization(payment_id, 'processed_tx_already_complete')
             continue
 
         processing_success = False
         finalization_notes = (f"Crypto payment confirmed. Coin: {coin_symbol}, "
                               f"Blockchain TXID: {blockchain_tx_id}, "
-                              f"Received (smallest unit): {received_amount_str}. "
+                              f"Received (smallest unit): {received_units}. "
                               f"Processed by payment_monitor.")
 
 
         if main_tx_details['type'] == 'balance_top_up':
-            amount_to_add_str = str(main_tx_details['original_add_balance_amount'])
-            if main_tx_details['original_add_balance_amount'] is None:
-                logger.error(f"Critical: original_add_balance_amount is NULL for balance_top_up tx {main_tx_id}, payment_id {payment_id}.")
+            amount_to_add_cents = main_tx_details['original_add_balance_cents']
+            if amount_to_add_cents is None:
+                logger.error(f"Critical: original_add_balance_cents is NULL for balance_top_up tx {main_tx_id}, payment_id {payment_id}.")
                 db_utils.update_transaction_status(main_tx_id, 'failed_data_error')
-                db_utils.update_pending_payment_status(payment_id, 'error_finalizing_data')
+                db_utils.finish_payment_finalization(payment_id, 'error_finalizing_data')
                 continue
 
-            logger.info(f"Calling finalize_successful_top_up for payment_id {payment_id}, main_tx_id {main_tx_id}, user {user_id}, amount {amount_to_add_str}.")
+            logger.info(f"Calling finalize_successful_top_up for payment_id {payment_id}, main_tx_id {main_tx_id}, user {user_id}, amount {money.format_eur(amount_to_add_cents)}.")
             processing_success = finalize_successful_top_up(
                 bot_instance=bot_instance,
                 main_transaction_id=main_tx_id,
                 user_id=user_id,
-                original_add_balance_amount_str=amount_to_add_str,
-                received_crypto_amount_str=received_amount_str,
+                original_add_balance_cents=amount_to_add_cents,
+                received_crypto_units=received_units,
                 coin_symbol=coin_symbol,
                 blockchain_tx_id=blockchain_tx_id
             )
@@ -239,21 +414,14 @@ def process_confirmed_payments(bot_instance=None):
 
 
         elif main_tx_details['type'] == 'purchase_crypto':
-            product_id = main_tx_details['product_id']
-            if product_id is None:
-                logger.error(f"Critical: product_id is NULL for purchase_crypto tx {main_tx_id}, payment_id {payment_id}.")
-                db_utils.update_transaction_status(main_tx_id, 'failed_data_error')
-                db_utils.update_pending_payment_status(payment_id, 'error_finalizing_data')
-                continue
-
-            logger.info(f"Calling finalize_successful_crypto_purchase for payment_id {payment_id}, main_tx_id {main_tx_id}, user {user_id}, product {product_id}.")
+            # The purchased item is described by the transaction's item_details_json, read by the finalizer.
+            logger.info(f"Calling finalize_successful_crypto_purchase for payment_id {payment_id}, main_tx_id {main_tx_id}, user {user_id}.")
             processing_success = finalize_successful_crypto_purchase(
                 bot_instance=bot_instance,
                 main_transaction_id=main_tx_id,
                 user_id=user_id,
-                product_id=product_id,
-                paid_from_balance_eur_str=paid_from_balance_eur_str_from_payment,
-                received_crypto_amount_str=received_amount_str,
+                paid_from_balance_cents=paid_from_balance_cents,
+                received_crypto_units=received_units,
                 coin_symbol=coin_symbol,
                 blockchain_tx_id=blockchain_tx_id
             )
@@ -262,24 +430,23 @@ def process_confirmed_payments(bot_instance=None):
                 db_utils.update_transaction_status(main_tx_id, 'failed_finalization_handler')
         else:
             logger.error(f"Unknown transaction type '{main_tx_details['type']}' for main_tx_id {main_tx_id}, payment_id {payment_id}. Payment: {payment}")
-            db_utils.update_pending_payment_status(payment_id, 'error_unknown_type')
+            db_utils.finish_payment_finalization(payment_id, 'error_unknown_type')
             continue
 
         if processing_success:
-            db_utils.update_pending_payment_status(payment_id, 'processed')
+            db_utils.finish_payment_finalization(payment_id, 'processed')
             updated_notes = (main_tx_details['notes'] + " | " + finalization_notes).strip(" | ") if main_tx_details['notes'] else finalization_notes
-            conn = db_utils.get_db_connection()
-            cursor = conn.cursor()
-            try:
-                cursor.execute("UPDATE transactions SET notes = ?, updated_at = CURRENT_TIMESTAMP WHERE transaction_id = ?", (updated_notes, main_tx_id))
-                conn.commit()
-            except sqlite3.Error as e_notes:
-                logger.error(f"Failed to update notes for main tx {main_tx_id}: {e_notes}")
-            finally:
-                conn.close()
+            with db_utils.db_connection() as conn:
+                try:
+                    conn.execute("UPDATE transactions SET notes = ?, updated_at = CURRENT_TIMESTAMP WHERE transaction_id = ?", (updated_notes, main_tx_id))
+                    conn.commit()
+                    db_utils.invalidate_row_cache(transaction_ids=(main_tx_id,))
+                except sqlite3.Error as e_notes:
+                    logger.error(f"Failed to update notes for main tx {main_tx_id}: {e_notes}")
+                    conn.rollback()
         else:
             logger.error(f"Failed to finalize main transaction {main_tx_id} (type: {main_tx_details['type']}) after payment {payment_id} was confirmed.")
-            db_utils.update_pending_payment_status(payment_id, 'error_finalizing')
+            db_utils.finish_payment_finalization(payment_id, 'error_finalizing')
 
     logger.info("Finished process_confirmed_payments cycle.")
 
@@ -303,8 +470,8 @@ def expire_stale_monitoring_payments(bot_instance=None):
 
         logger.info(f"Expiring stale payment_id {payment_id} (main_tx_id {main_tx_id}) for user {user_id}, address {address}.")
 
-        if not db_utils.update_pending_payment_status(payment_id, 'expired'):
-            logger.error(f"Failed to update pending payment {payment_id} status to 'expired'. Skipping associated main transaction update for now.")
+        if not db_utils.update_pending_payment_status(payment_id, 'expired', expected_status='monitoring'):
+            logger.error(f"Could not move pending payment {payment_id} from 'monitoring' to 'expired' (failed or changed concurrently). Skipping associated main transaction update.")
             continue
 
         main_tx_status_update = 'failed_expired_notfound'
@@ -336,9 +503,20 @@ def expire_stale_monitoring_payments(bot_instance=None):
 
     logger.info("Finished expire_stale_monitoring_payments cycle.")
 
+def _set_status_if_unchanged(payment_id: int, transaction_id: int, new_status: str, expected_status: str) -> str:
+    """
+    On-demand status change that only applies while the payment is still in expected_status (the API call
+    before it can take a while, during which the monitor or a worker may have moved it on).
+    Returns new_status, or the status actually in the DB if the payment changed in the meantime.
+    """
+    if db_utils.update_pending_payment_status(payment_id, new_status, expected_status=expected_status):
+        return new_status
+    current = db_utils.get_pending_payment_by_transaction_id(transaction_id, fresh=True)
+    return current['status'] if current else 'not_found'
+
 def check_specific_pending_payment(transaction_id: int) -> tuple[bool, str | None]:
     logger.info(f"On-demand check initiated for transaction_id: {transaction_id}")
-    pending_payment = db_utils.get_pending_payment_by_transaction_id(transaction_id)
+    pending_payment = db_utils.get_pending_payment_by_transaction_id(transaction_id, fresh=True) # Decides status changes; read it from the DB
 
     if not pending_payment:
         logger.warning(f"On-demand check: No pending_payment record found for transaction_id: {transaction_id}")
@@ -355,10 +533,11 @@ def check_specific_pending_payment(transaction_id: int) -> tuple[bool, str | Non
         logger.info(f"On-demand check: Payment {payment_id} (tx: {transaction_id}) is already in status '{current_status}'. No API check needed.")
         return False, current_status
 
-    expires_at_dt = datetime.datetime.fromisoformat(pending_payment['expires_at'])
-    if datetime.datetime.utcnow() >= expires_at_dt and current_status == 'monitoring':
+    if time.time() >= pending_payment['expires_at'] and current_status == 'monitoring':
         logger.info(f"On-demand check: Payment {payment_id} (tx: {transaction_id}) has expired. Updating status.")
-        db_utils.update_pending_payment_status(payment_id, 'expired')
+        status_now = _set_status_if_unchanged(payment_id, transaction_id, 'expired', current_status)
+        if status_now != 'expired':
+            return False, status_now
         status_to_set = 'failed_expired_notfound'
         if current_db_blockchain_tx_id: status_to_set = 'failed_expired_unconfirmed'
         db_utils.update_transaction_status(transaction_id, status_to_set)
@@ -366,32 +545,23 @@ def check_specific_pending_payment(transaction_id: int) -> tuple[bool, str | Non
 
     address = pending_payment['address']
     coin_symbol = pending_payment['coin_symbol']
-    expected_amount_str = pending_payment['expected_crypto_amount']
-    created_at_dt = datetime.datetime.fromisoformat(pending_payment['created_at'])
+    expected_units = pending_payment['expected_crypto_units']
 
     logger.debug(f"On-demand check: Performing blockchain API call for payment_id: {payment_id}, address: {address}, coin: {coin_symbol}")
 
-    api_call_delay = getattr(config, 'BLOCKCHAIN_API_CALL_DELAY_SECONDS', 2.0)
-    time.sleep(api_call_delay / 2 if api_call_delay > 1 else 0.5)
-
+    if coin_symbol not in MONITORED_COINS: # Should be caught by earlier validation
+        logger.error(f"On-demand check: Unsupported coin_symbol '{coin_symbol}' for payment_id {payment_id}.")
+        return False, 'error_config'
 
     api_transactions = []
     try:
-        if coin_symbol == "BTC":
-            api_transactions = blockchain_apis.get_address_transactions_btc(address)
-        elif coin_symbol == "LTC":
-            api_transactions = blockchain_apis.get_address_transactions_ltc(address)
-        elif coin_symbol == "USDT_TRX":
-            since_ts_ms = int(created_at_dt.timestamp() * 1000) - (60 * 1000 * 5)
-            api_transactions = blockchain_apis.get_trc20_transfers_usdt_trx(address, since_timestamp_ms=since_ts_ms)
-        else: # Should be caught by earlier validation
-            logger.error(f"On-demand check: Unsupported coin_symbol '{coin_symbol}' for payment_id {payment_id}.")
-            return False, 'error_config'
+        # Shares the provider slots and rate limits with the monitor cycle.
+        api_transactions = _fetch_address_transactions(pending_payment)
     except BlockchainAPIError as e_api:
-        _handle_api_error_for_payment_check(payment_id, address, coin_symbol, e_api)
+        _handle_api_error_for_payment_check(payment_id, address, coin_symbol, e_api, expected_status=current_status)
         return False, 'error_api' # Return a generic API error status for the caller
     except Exception as e_generic:
-        _handle_api_error_for_payment_check(payment_id, address, coin_symbol, e_generic)
+        _handle_api_error_for_payment_check(payment_id, address, coin_symbol, e_generic, expected_status=current_status)
         return False, 'error_api'
 
 
@@ -418,24 +588,21 @@ def check_specific_pending_payment(transaction_id: int) -> tuple[bool, str | Non
             continue
 
         try:
-            received_decimal_api = Decimal(received_amount_smallest_unit_api_str)
-            expected_decimal_db = Decimal(expected_amount_str)
-        except InvalidOperation:
+            received_units_api = money.parse_units(received_amount_smallest_unit_api_str)
+        except ValueError:
             continue
 
         if current_db_blockchain_tx_id and current_db_blockchain_tx_id == blockchain_tx_id_api:
-            db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, str(received_decimal_api), blockchain_tx_id_api)
+            db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, received_units_api, blockchain_tx_id_api)
             min_confs_needed = _get_min_confirmations(coin_symbol)
 
             if tx_confirmations_api >= min_confs_needed:
                 if current_status == 'monitoring':
-                     if received_decimal_api >= expected_decimal_db:
-                        db_utils.update_pending_payment_status(payment_id, 'confirmed_unprocessed')
-                        newly_confirmed_this_check = True
-                        status_after_check = 'confirmed_unprocessed'
+                     if received_units_api >= expected_units:
+                        status_after_check = _set_status_if_unchanged(payment_id, transaction_id, 'confirmed_unprocessed', current_status)
+                        newly_confirmed_this_check = status_after_check == 'confirmed_unprocessed'
                      else:
-                        db_utils.update_pending_payment_status(payment_id, 'underpaid')
-                        status_after_check = 'underpaid'
+                        status_after_check = _set_status_if_unchanged(payment_id, transaction_id, 'underpaid', current_status)
                 elif current_status == 'underpaid':
                     status_after_check = 'underpaid'
             else:
@@ -443,21 +610,19 @@ def check_specific_pending_payment(transaction_id: int) -> tuple[bool, str | Non
             break
 
         elif not current_db_blockchain_tx_id:
-            if received_decimal_api >= expected_decimal_db:
+            if received_units_api >= expected_units:
                 min_confs_needed = _get_min_confirmations(coin_symbol)
-                db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, str(received_decimal_api), blockchain_tx_id_api)
+                db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, received_units_api, blockchain_tx_id_api)
                 if tx_confirmations_api >= min_confs_needed:
-                    db_utils.update_pending_payment_status(payment_id, 'confirmed_unprocessed')
-                    newly_confirmed_this_check = True
-                    status_after_check = 'confirmed_unprocessed'
+                    status_after_check = _set_status_if_unchanged(payment_id, transaction_id, 'confirmed_unprocessed', current_status)
+                    newly_confirmed_this_check = status_after_check == 'confirmed_unprocessed'
                 else:
                     status_after_check = 'monitoring_updated'
                 break
-            elif received_decimal_api > 0:
-                logger.warning(f"On-demand check: Potential UNDERPAYMENT for payment_id {payment_id}. Expected: {expected_decimal_db}, Received: {received_decimal_api} in tx {blockchain_tx_id_api}.")
-                db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, str(received_decimal_api), blockchain_tx_id_api)
-                db_utils.update_pending_payment_status(payment_id, 'underpaid')
-                status_after_check = 'underpaid'
+            elif received_units_api > 0:
+                logger.warning(f"On-demand check: Potential UNDERPAYMENT for payment_id {payment_id}. Expected: {expected_units}, Received: {received_units_api} in tx {blockchain_tx_id_api}.")
+                db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, received_units_api, blockchain_tx_id_api)
+                status_after_check = _set_status_if_unchanged(payment_id, transaction_id, 'underpaid', current_status)
                 break
 
     if not newly_confirmed_this_check and status_after_check == current_status :
@@ -466,8 +631,24 @@ def check_specific_pending_payment(transaction_id: int) -> tuple[bool, str | Non
     return newly_confirmed_this_check, status_after_check
 
 
+# --- Follow-up rechecks ---
+PAYMENT_RECHECK_DELAY_SECONDS = getattr(config, 'PAYMENT_RECHECK_DELAY_SECONDS', 30)
+PAYMENT_RECHECK_STATUSES = ('monitoring', 'monitoring_updated', 'underpaid', 'error_api')
+
+def schedule_payment_recheck(transaction_id: int, status_info: str | None) -> bool:
+    """
+    Queues a 'recheck_payment' job (registered in bot.py) after an on-demand check left the payment
+    unconfirmed, so it is checked again soon instead of at the next full monitor cycle. One per transaction.
+    """
+    if status_info not in PAYMENT_RECHECK_STATUSES:
+        return False
+    return job_queue.enqueue('recheck_payment', {'transaction_id': transaction_id}, delay_seconds=PAYMENT_RECHECK_DELAY_SECONDS,
+                             dedupe_key=f"recheck_payment:{transaction_id}") is not None
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     logger.info("Payment Monitor module - Self-Test Mode")
     logger.info("Self-test placeholders finished.")
 
+
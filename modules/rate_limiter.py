@@ -0,0 +1,151 @@
+import email.utils
+import logging
+import threading
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# --- Per-Provider Rate Limiting ---
+# Every outbound API call takes a token from its provider's bucket first:
+#
+#     if not rate_limiter.acquire('blockstream'):
+#         ...  # no token within API_RATE_LIMIT_MAX_WAIT_SECONDS; treat it like an HTTP 429
+#
+# A bucket refills at `rate` tokens per second and holds at most `burst`, so idle time is saved up for a
+# short burst and sustained traffic settles at the configured quota. The buckets are shared by all threads
+# (monitor pool, job workers, handlers), so background and on-demand calls draw from the same budget.
+# When a provider answers 429 (or 503 with Retry-After), report it with note_rate_limited(); the bucket
+# is emptied and blocked until the Retry-After time has passed.
+
+# provider -> (tokens per second, burst). Defaults stay below the providers' documented free-tier limits.
+DEFAULT_API_RATE_LIMITS = {
+    'blockstream': (5.0, 5),
+    'blockcypher': (3.0, 3),   # Free tier is also capped per hour; lower the rate if you run without a token
+    'trongrid': (10.0, 10),
+    'coingecko': (0.5, 5),     # ~30 calls per minute on the public API
+}
+API_RATE_LIMITS = {**DEFAULT_API_RATE_LIMITS, **getattr(config, 'API_RATE_LIMITS', {})}
+API_RATE_LIMIT_MAX_WAIT_SECONDS = getattr(config, 'API_RATE_LIMIT_MAX_WAIT_SECONDS', 30)
+API_RATE_LIMIT_DEFAULT_BACKOFF_SECONDS = getattr(config, 'API_RATE_LIMIT_DEFAULT_BACKOFF_SECONDS', 10) # 429 without Retry-After
+API_RATE_LIMIT_MAX_BACKOFF_SECONDS = 600 # Ignore absurd Retry-After values beyond this
+
+
+class TokenBucket:
+    """Thread-safe token bucket. Waiters are served roughly in arrival order through the shared lock."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = max(float(rate), 1e-6)
+        self.burst = max(1, int(burst))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def acquire(self, max_wait: float | None = None, tokens: int = 1) -> bool:
+        """
+        Takes `tokens` tokens, sleeping until they are available. False if that would take longer than max_wait.
+        A request for more than the burst size goes ahead once the bucket is full and leaves it in debt,
+        so later callers wait until the whole amount has been refilled.
+        """
+        tokens = max(1, tokens)
+        needed = min(tokens, self.burst)
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._blocked_until:
+                    self._refill(now)
+                    if self._tokens >= needed:
+                        self._tokens -= tokens
+                        return True
+                    wait = (needed - self._tokens) / self.rate
+                else:
+                    wait = self._blocked_until - now
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def block_for(self, seconds: float):
+        """Empties the bucket and hands out no tokens for `seconds`."""
+        with self._lock:
+            now = time.monotonic()
+            self._blocked_until = max(self._blocked_until, now + seconds)
+            self._tokens = 0.0
+            self._updated = self._blocked_until
+
+
+_buckets: dict[str, TokenBucket] = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(provider: str) -> TokenBucket:
+    with _buckets_lock:
+        bucket = _buckets.get(provider)
+        if bucket is None:
+            rate, burst = API_RATE_LIMITS.get(provider, (1.0, 1))
+            bucket = _buckets[provider] = TokenBucket(rate, burst)
+        return bucket
+
+
+def acquire(provider: str, max_wait: float | None = API_RATE_LIMIT_MAX_WAIT_SECONDS, tokens: int = 1) -> bool:
+    """
+    Waits for the provider's next call slot. False if none is free within max_wait seconds.
+    Batch requests that the provider bills per item pass the item count as `tokens`.
+    """
+    started = time.monotonic()
+    granted = get_bucket(provider).acquire(max_wait, tokens)
+    waited = time.monotonic() - started
+    if not granted:
+        logger.warning(f"Rate limiter: no '{provider}' call slot within {max_wait}s.")
+    elif waited >= 1:
+        logger.debug(f"Rate limiter: waited {waited:.1f}s for a '{provider}' call slot.")
+    return granted
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date), or None if absent/invalid."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def note_rate_limited(provider: str, retry_after: str | None = None) -> float:
+    """Records a 429 from the provider; its bucket pauses for Retry-After (or the default backoff). Returns the pause."""
+    pause = parse_retry_after(retry_after)
+    if pause is None:
+        pause = API_RATE_LIMIT_DEFAULT_BACKOFF_SECONDS
+    pause = min(pause, API_RATE_LIMIT_MAX_BACKOFF_SECONDS)
+    get_bucket(provider).block_for(pause)
+    logger.warning(f"Rate limiter: '{provider}' asked us to back off; pausing its calls for {pause:.1f}s.")
+    return pause
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    # A batch of N billed items must cost N tokens, also beyond the burst size.
+    bucket = TokenBucket(rate=10.0, burst=3)
+    assert bucket.acquire(max_wait=0, tokens=20)
+    assert not bucket.acquire(max_wait=1.0), "a 20-token batch must leave the bucket ~17 tokens in debt"
+    started = time.monotonic()
+    assert bucket.acquire()
+    waited = time.monotonic() - started
+    assert 1.6 <= waited <= 2.2, f"expected ~1.8s to repay the debt, waited {waited:.2f}s"
+    logger.info(f"Self-test passed: 20 tokens on a burst-3 bucket at 10/s delayed the next call by {waited:.2f}s.")